@@ -9,6 +9,7 @@ from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_discord import DiscordOAuth2Session
 from apps.authentication.esi import EsiAuth
+from apps.startup import get_report
 
 
 db = SQLAlchemy()
@@ -24,6 +25,7 @@ def register_extensions(app):
     db.init_app(app)
     login_manager.init_app(app)
     esi.init_app(app)
+    import_module("apps.market").init_app(app)
 
 
 def register_blueprints(app):
@@ -55,9 +57,16 @@ def create_app(config):
     print("Starting App")
     app = Flask(__name__)
     app.config.from_object(config)
-    configure_discord(app)
-    register_extensions(app)
-    register_blueprints(app)
-    configure_database(app)
-    configure_tasks(app)
+    report = get_report(app)
+    with report.step("discord"):
+        configure_discord(app)
+    with report.step("extensions"):
+        register_extensions(app)
+    with report.step("blueprints"):
+        register_blueprints(app)
+    with report.step("database"):
+        configure_database(app)
+    with report.step("tasks"):
+        configure_tasks(app)
+    print(report.format())
     return app
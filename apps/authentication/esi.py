@@ -1,7 +1,22 @@
 """Eve Online ESI(API) Interface"""
 
 import esipy
-from esipy import EsiApp
+from flask import current_app
+
+from esi_tools.cache import EsiResponseCache, DEFAULT_CACHE_PATH, expires_at
+from esi_tools.swagger import SpecStore, DEFAULT_SPEC_PATH
+from esi_tools.standin import StandInAdapter
+from esi_tools.async_client import (
+    ESI_BASE_URL,
+    AsyncEsiClient,
+    ErrorLimitGovernor,
+    RequestMeter,
+    iterate,
+    operations_from_app,
+    run,
+)
+from apps.authentication.tokens import TokenManager
+from apps.startup import get_report
 
 
 class EsiAuth:
@@ -11,6 +26,13 @@ class EsiAuth:
         self.esisecurity = None
         self.esiclient = None
         self.esiapp = None
+        self.spec = None
+        self.cache = None
+        self.tokens = None
+        self.operations = {}
+        self.governor = ErrorLimitGovernor()
+        self.meter = RequestMeter()
+        self.async_settings = {}
 
     def init_app(self, app):
         """Initialize the ESI App with the Flask App
@@ -18,26 +40,218 @@ class EsiAuth:
         Args:
             app (obj): The Flask App object
         """
-        # init our ESI App
-        esi_app = EsiApp()
-        self.esiapp = esi_app.get_latest_swagger
-
-        # init the security object
-        self.esisecurity = esipy.EsiSecurity(
-            app=self.esiapp,
-            redirect_uri=app.config["ESI_CALLBACK"],
-            client_id=app.config["ESI_CLIENT_ID"],
-            secret_key=app.config["ESI_SECRET_KEY"],
-            headers={"User-Agent": "merriam@gmail.com"},
+        report = get_report(app)
+
+        # init our ESI App from the local spec, only the first boot downloads it
+        self.spec = SpecStore(
+            app.config.get("ESI_SPEC_PATH", DEFAULT_SPEC_PATH),
+            app.config.get("ESI_SWAGGER_JSON"),
+            user_agent=app.config["ESI_USER_AGENT"],
+        )
+        self.esiapp = self.spec.load_app()
+        for step, seconds in self.spec.timings.items():
+            report.add(f"esi spec {step}", seconds)
+
+        # init the security object, SSO endpoints and keys come with the spec
+        with report.step("esi security"):
+            self.esisecurity = esipy.EsiSecurity(
+                app=self.esiapp,
+                redirect_uri=app.config["ESI_CALLBACK"],
+                client_id=app.config["ESI_CLIENT_ID"],
+                secret_key=app.config["ESI_SECRET_KEY"],
+                headers={"User-Agent": "merriam@gmail.com"},
+                **self.spec.sso_kwargs(),
+            )
+
+        # a local stand-in (esi_tools.standin) answers ESI and SSO calls instead
+        base_url = app.config.get("ESI_BASE_URL", ESI_BASE_URL)
+        adapter = StandInAdapter(base_url) if base_url != ESI_BASE_URL else None
+
+        # per-character tokens, the client asks it for the bearer of each call
+        self.tokens = TokenManager(
+            self.esisecurity,
+            headers={"User-Agent": app.config["ESI_USER_AGENT"]},
+            workers=app.config.get("ESI_TOKEN_WORKERS", 4),
+            transport_adapter=adapter,
+        )
+
+        # on-disk cache, shared with the other workers and the market scripts
+        self.cache = EsiResponseCache(
+            app.config.get("ESI_CACHE_PATH", DEFAULT_CACHE_PATH),
+            max_bytes=app.config.get("ESI_CACHE_MAX_MB", 512) * 1024 * 1024,
         )
 
         # init the client
         self.esiclient = esipy.EsiClient(
-            security=self.esisecurity,
-            cache=None,
+            security=self.tokens,
+            cache=self.cache,
             headers={"User-Agent": app.config["ESI_USER_AGENT"]},
+            transport_adapter=adapter,
+        )
+
+        # the async client calls the same operations without pyswagger
+        self.operations = operations_from_app(self.esiapp)
+        self.async_settings = {
+            "base_url": base_url,
+            "concurrency": app.config.get("ESI_CONCURRENCY", 20),
+            "user_agent": app.config["ESI_USER_AGENT"],
+        }
+
+        app.cli.add_command(self._spec_cli())
+
+    def _spec_cli(self):
+        """``flask esi-spec refresh|show`` to manage the local swagger spec"""
+        import click
+        from flask.cli import AppGroup
+
+        group = AppGroup("esi-spec", help="Manage the local ESI swagger spec.")
+
+        @group.command("refresh")
+        @click.option("--force", is_flag=True, help="Download even if unchanged.")
+        def refresh(force):
+            changed = self.refresh_spec(force=force)
+            print(f"ESI spec {self.spec.version} {'updated' if changed else 'unchanged'}")
+
+        @group.command("show")
+        def show():
+            print(f"ESI spec {self.spec.version} at {self.spec.path}")
+
+        return group
+
+    def refresh_spec(self, force: bool = False) -> bool:
+        """Download a newer swagger spec if there is one.
+
+        Running workers keep the spec they booted with, the new one is picked
+        up on their next start.
+
+        Returns:
+            bool: True if a new spec was stored.
+        """
+        return self.spec.refresh(force=force)
+
+    def async_client(self, **kwargs) -> AsyncEsiClient:
+        """Asyncio ESI client sharing our operations, cache and error limit state
+
+        Args:
+            **kwargs: Overrides for AsyncEsiClient (concurrency, retries...)
+        """
+        settings = dict(self.async_settings, **kwargs)
+        return AsyncEsiClient(
+            operations=self.operations,
+            cache=self.cache,
+            governor=self.governor,
+            meter=self.meter,
+            **settings,
+        )
+
+    def get_esi_many(self, character, schema, params_list, converters=None, **kwargs) -> list:
+        """Run the same operation for many parameter sets concurrently.
+
+        Usable from the scheduler threads, the requests share one event loop
+        instead of blocking a thread each.
+
+        Args:
+            character (UsersModel): Character whose token is used, None for public data.
+            schema: The ESI operation to execute.
+            params_list (list): One kwargs dict per request.
+            converters (dict): field -> callable, e.g. ``{"date": parse_date}``.
+            **kwargs: Overrides for AsyncEsiClient.
+
+        Returns:
+            list: EsiResponse (status, headers, data, url) or the exception
+            raised, in the order of params_list.
+        """
+        return self.get_esi_calls(
+            character, [(schema, params) for params in params_list], converters, **kwargs
         )
 
+    def get_esi_calls(self, character, calls, converters=None, **kwargs) -> list:
+        """Run different operations concurrently, on one event loop and client.
+
+        Args:
+            character (UsersModel): Character whose token is used, None for public data.
+            calls (list): (schema, params) per request.
+            converters (dict): field -> callable for the list responses.
+            **kwargs: Overrides for AsyncEsiClient.
+
+        Returns:
+            list: EsiResponse or the exception raised, in the order of calls.
+        """
+        token = self.tokens.access_token(character) if character is not None else None
+
+        async def fetch():
+            async with self.async_client(**kwargs) as client:
+                return await client.gather(calls, token=token, converters=converters)
+
+        return run(fetch())
+
+    def get_esi_pages(self, character, schema, converters=None, **kwargs):
+        """Stream every page of a paginated ESI list.
+
+        The first page gives ``X-Pages``, the others are fetched concurrently
+        and yielded as they arrive. If ESI rolls over to a new snapshot half
+        way the walk starts over, so pages can repeat: save them with upserts
+        or use ``get_esi_all``.
+
+        Args:
+            character (UsersModel): Character whose token is used, None for public data.
+            schema: The ESI operation to execute.
+            converters (dict): field -> callable, e.g. ``{"date": parse_date}``.
+            **kwargs: Parameters to pass to the ESI operation.
+
+        Yields:
+            EsiPage: page, pages, data (list of dicts), headers, snapshot, attempt.
+
+        Raises:
+            RuntimeError: If the token refresh or a page request fails.
+        """
+        token = self.tokens.access_token(character) if character is not None else None
+
+        async def pages():
+            async with self.async_client() as client:
+                async for page in client.paginate(
+                    schema, token=token, converters=converters, **kwargs
+                ):
+                    yield page
+
+        return iterate(pages)
+
+    def get_esi_all(self, character, schema, converters=None, **kwargs) -> list:
+        """Rows of every page of a paginated ESI list, from one consistent snapshot.
+
+        Same arguments as ``get_esi_pages``.
+        """
+        return self.get_esi_all_expires(character, schema, converters=converters, **kwargs)[0]
+
+    def get_esi_all_expires(self, character, schema, converters=None, **kwargs) -> tuple:
+        """``get_esi_all`` and when ESI's cache of the list expires.
+
+        Same arguments as ``get_esi_pages``.
+
+        Returns:
+            tuple: (rows, expires), expires is a naive UTC datetime or None
+            when ESI sent no Expires header.
+        """
+        token = self.tokens.access_token(character) if character is not None else None
+
+        async def fetch():
+            async with self.async_client() as client:
+                return await client.fetch_pages(
+                    schema, token=token, converters=converters, **kwargs
+                )
+
+        pages = run(fetch())
+        expires = expires_at(pages[0].headers) if pages else None
+        return [row for page in pages for row in page.data], expires
+
+    def get_cache_stats(self) -> dict:
+        """Hit/miss/byte counters of the shared response cache"""
+        return self.cache.stats()
+
+    def flush_tokens(self, app) -> int:
+        """Persist tokens refreshed since the last flush in one write"""
+        return self.tokens.flush(app)
+
     def get_wallet(self, current_user):
         """Get a users wallet transactions
 
@@ -47,12 +261,15 @@ class EsiAuth:
         Returns:
             string: json of wallet transactions
         """
-        self.esisecurity.update_token(current_user.get_sso_data())
+        user = current_user._get_current_object()
+        with self.tokens.bind(self.tokens.access_token(user)):
+            request = self.esiapp.op["get_characters_character_id_wallet"](
+                character_id=user.character_id
+            )
+            response = self.esiclient.request(request)
 
-        request = self.esiapp.op["get_characters_character_id_wallet"](
-            character_id=current_user.character_id
-        )
-        return self.esiclient.request(request)
+        self.flush_tokens(current_app)
+        return response
 
     def get_esi(self, character, schema, **kwargs):
         """Get ESI Data with token refresh.
@@ -68,17 +285,20 @@ class EsiAuth:
         Raises:
             RuntimeError: If the token refresh or ESI request fails.
         """
+        access_token = None
         if character is not None:
             try:
-                self.esisecurity.update_token(character.get_sso_data())
+                access_token = self.tokens.access_token(character)
             except Exception as error:
                 message = f"Error refreshing token for {character.character_name}, error: {error}"
                 print(message)
                 raise RuntimeError(message) from error
 
+        self.meter.add()
         try:
-            request = self.esiapp.op[schema](**kwargs)
-            return self.esiclient.request(request)
+            with self.tokens.bind(access_token):
+                request = self.esiapp.op[schema](**kwargs)
+                return self.esiclient.request(request)
         except Exception as error:
             message = (
                 f"Error executing ESI request for schema '{schema}', error: {error}"
@@ -7,6 +7,7 @@ import time
 from datetime import datetime
 from flask_login import UserMixin
 from sqlalchemy import BigInteger, Column, Integer, ForeignKey, Boolean, func
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.ext.declarative import declared_attr
 
@@ -35,6 +36,49 @@ class Contract(db.Model):
     title = db.Column(db.Text, nullable=True)
     type = db.Column(db.Text, nullable=False)
     volume = db.Column(db.Float, nullable=True)
+    region_id = db.Column(db.Integer, nullable=True, index=True)
+    first_seen = db.Column(db.DateTime, nullable=True)
+    # set when the contract is missing from its region's latest snapshot
+    gone_at = db.Column(db.DateTime, nullable=True)
+
+
+class JobMixin:
+    """Columns of a job row in a work queue table, see apps.tasks.work_queue"""
+
+    state = db.Column(db.String(16), nullable=False, default="pending")
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claim_token = db.Column(db.String(32), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+
+class ContractItemJob(JobMixin, db.Model):
+    """A public contract whose items still have to be fetched"""
+    __tablename__ = "contract_item_jobs"
+    __table_args__ = (
+        db.Index("ix_contract_item_jobs_claim", "state", "priority", "next_attempt_at"),
+    )
+
+    contract_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    region_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ContractRegionSnapshot(db.Model):
+    """Last public contract snapshot swept per region"""
+    __tablename__ = "contract_region_snapshots"
+
+    region_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # ESI Last-Modified of the snapshot
+    snapshot = db.Column(db.String(64), nullable=True)
+    swept_at = db.Column(db.DateTime, nullable=False)
+    contracts = db.Column(db.Integer, nullable=False, default=0)
+    new = db.Column(db.Integer, nullable=False, default=0)
+    gone = db.Column(db.Integer, nullable=False, default=0)
+
 
 class BlueprintLongDurationOrder(db.Model):
     __tablename__ = "blueprint_long_duration_orders"
@@ -71,8 +115,8 @@ class BlueprintLongDurationOrder(db.Model):
 class ContractItem(db.Model):
     __tablename__ = "contract_items"
     id = db.Column(db.Integer, primary_key=True)
-    contract_id = db.Column(db.BigInteger, nullable=False)
-    record_id = db.Column(db.BigInteger, nullable=False)
+    contract_id = db.Column(db.BigInteger, nullable=False, index=True)
+    record_id = db.Column(db.BigInteger, nullable=False, unique=True)
     is_blueprint_copy = db.Column(db.Boolean, nullable=True)
     is_included = db.Column(db.Boolean, nullable=False)
     item_id = db.Column(db.BigInteger, nullable=True)
@@ -80,7 +124,8 @@ class ContractItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     runs = db.Column(db.Integer, nullable=True)
     time_efficiency = db.Column(db.Integer, nullable=True)
-    type_id = db.Column(db.Integer, nullable=False)
+    # looked up when a new watch is matched against the stored items
+    type_id = db.Column(db.Integer, nullable=False, index=True)
 
 
 class ContractTrack(db.Model):
@@ -94,11 +139,41 @@ class ContractTrack(db.Model):
 
 class ContractNotify(db.Model):
     __tablename__ = "contract_notify"
+    __table_args__ = (
+        db.UniqueConstraint("character_id", "contract_id", name="uq_contract_notify"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, nullable=False)
     contract_id = db.Column(db.BigInteger, nullable=True)
 
 
+class NotificationOutbox(JobMixin, db.Model):
+    """A notification waiting to be sent, see apps.tasks.work_queue"""
+    __tablename__ = "notification_outbox"
+    __table_args__ = (
+        db.Index("ix_notification_outbox_claim", "state", "priority", "next_attempt_at"),
+    )
+
+    # kind and what it is about, e.g. "contract-match:<character>:<contract>",
+    # so the same event is only queued once
+    key = db.Column(db.String(128), primary_key=True)
+    character_id = db.Column(db.BigInteger, nullable=False, index=True)
+    kind = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.JSON, nullable=True)
+    # set when the recipient is known up front, else looked up from character_id
+    discord_user_id = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class DiscordDmChannel(db.Model):
+    """The DM channel the bot opened with a Discord user, opened once"""
+    __tablename__ = "discord_dm_channels"
+
+    discord_user_id = db.Column(db.String(64), primary_key=True)
+    channel_id = db.Column(db.String(64), nullable=False)
+    opened_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
 class Features(db.Model):
     __tablename__ = "features"
 
@@ -122,11 +197,34 @@ class SkillSet(db.Model):
     __tablename__ = "skillsets"
 
     id = db.Column(db.Integer, primary_key=True)
-    character_id = db.Column(db.Integer, nullable=False)
+    character_id = db.Column(db.Integer, nullable=False, unique=True)
     total_sp = db.Column(db.Integer, nullable=False)
     unallocated_sp = db.Column(db.Integer, nullable=False)
 
 
+class SkillProjection(db.Model):
+    """When a character's skill queue takes it over the SP farm threshold"""
+    __tablename__ = "skill_projections"
+
+    character_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    total_sp = db.Column(db.BigInteger, nullable=False)
+    # None when already over the threshold or the queue stops short of it
+    threshold_at = db.Column(db.DateTime, nullable=True)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+
+class SkillPointHistory(db.Model):
+    """Skill points of a character at the last skill sync of each day"""
+    __tablename__ = "skill_point_history"
+    __table_args__ = (db.UniqueConstraint("character_id", "date"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    character_id = db.Column(db.BigInteger, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    total_sp = db.Column(db.BigInteger, nullable=False)
+    unallocated_sp = db.Column(db.Integer, nullable=True)
+
+
 class CharacterNotifications(db.Model):
     __tablename__ = "character_notifications"
     id = db.Column(db.Integer, primary_key=True)
@@ -146,6 +244,7 @@ class SentNotifications(db.Model):
 
 class MarketHistory(db.Model):
     __tablename__ = "market_history"
+    __table_args__ = (db.Index("ix_market_history_series", "regionID", "typeID", "date"),)
 
     id = Column(db.Integer, primary_key=True, autoincrement=True)
     typeID = db.Column(db.BigInteger)
@@ -159,6 +258,51 @@ class MarketHistory(db.Model):
     updated_date = db.Column(db.DateTime, nullable=False, default=func.now())
 
 
+class MarketHistoryIndex(db.Model):
+    """Newest stored history day and last fetch, per (region, type)"""
+    __tablename__ = "market_history_index"
+
+    region_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    type_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    last_date = db.Column(db.Date, nullable=True)
+    checked_at = db.Column(db.DateTime, nullable=False)
+
+
+class MarketSeries(db.Model):
+    """Market history of one (region, type) as packed columns, see apps.market.series"""
+    __tablename__ = "market_series"
+
+    region_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    type_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    first_date = db.Column(db.Date, nullable=False)
+    last_date = db.Column(db.Date, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    # MySQL's BLOB stops at 64 KB, about 3.7 years of days
+    data = db.Column(
+        db.LargeBinary().with_variant(mysql.MEDIUMBLOB(), "mysql", "mariadb"), nullable=False
+    )
+
+
+class MarketStats(db.Model):
+    """Precomputed price statistics per (region, type), see apps.market.stats"""
+    __tablename__ = "market_stats"
+
+    region_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    type_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    as_of = db.Column(db.Date, nullable=False)
+    ma_7 = db.Column(db.Float)
+    ma_30 = db.Column(db.Float)
+    vwap_30 = db.Column(db.Float)
+    volatility_30 = db.Column(db.Float)
+    trend_30 = db.Column(db.Float)
+    p10_90 = db.Column(db.Float)
+    p50_90 = db.Column(db.Float)
+    p90_90 = db.Column(db.Float)
+    volume_30 = db.Column(db.Float)
+    days_90 = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
 class InvType(db.Model):
     __tablename__ = "invTypes"
 
@@ -193,6 +337,39 @@ class Blueprints(db.Model):
     type_id = db.Column(db.BigInteger)
 
 
+class CharacterSyncState(db.Model):
+    """Last synced ESI payload of a character, per endpoint"""
+    __tablename__ = "character_sync_state"
+    __table_args__ = (db.UniqueConstraint("character_id", "endpoint"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    character_id = db.Column(db.BigInteger, nullable=False)
+    endpoint = db.Column(db.String(64), nullable=False)
+    payload_hash = db.Column(db.String(64), nullable=True)
+    # newest date seen, for endpoints that are synced incrementally
+    high_water = db.Column(db.Date, nullable=True)
+    synced_at = db.Column(db.DateTime, nullable=True)
+
+
+class RefreshSchedule(db.Model):
+    """When a character's ESI endpoint is due for its next refresh"""
+    __tablename__ = "refresh_schedules"
+    __table_args__ = (
+        db.UniqueConstraint("character_id", "endpoint"),
+        db.Index("ix_refresh_schedules_due", "endpoint", "next_refresh_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    character_id = db.Column(db.BigInteger, nullable=False)
+    endpoint = db.Column(db.String(64), nullable=False)
+    next_refresh_at = db.Column(db.DateTime, nullable=False)
+    # ESI's Expires header of the last response, nothing new before it
+    expires_at = db.Column(db.DateTime, nullable=True)
+    # last refresh that found different data
+    changed_at = db.Column(db.DateTime, nullable=False)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+
 class Transactions(db.Model):
     __tablename__ = "Transactions"
 
@@ -213,7 +390,13 @@ class Transactions(db.Model):
 
 class MiningLedger(db.Model):
     __tablename__ = "MiningLedger"
-    id = db.Column(db.BigInteger, primary_key=True)
+    __table_args__ = (
+        db.UniqueConstraint(
+            "character_id", "date", "solar_system_id", "type_id", name="uq_mining_ledger_entry"
+        ),
+    )
+    # SQLite only auto-increments INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
     character_id = db.Column(db.BigInteger)
     date = db.Column(db.Date())
     quantity = db.Column(db.BigInteger)
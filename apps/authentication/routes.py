@@ -10,12 +10,13 @@ import urllib.parse
 import json
 import esipy
 from apps.authentication.util import verify_pass
-from flask import render_template, redirect, request, url_for, session
+from flask import current_app, render_template, redirect, request, url_for, session
 from flask_login import current_user, login_user, logout_user, login_required
 from apps import db, login_manager, esi
 from apps.authentication import blueprint
 from apps.authentication.forms import LoginForm, CreateAccountForm
 from apps.authentication.models import Users, Characters
+from apps.tasks.outbox import WELCOME, enqueue, notification
 from sqlalchemy.orm.exc import NoResultFound
 from cryptography.fernet import Fernet
 from esipy.exceptions import APIException
@@ -286,21 +287,25 @@ def discord_callback():
 
         db.session.merge(user_data)
         db.session.commit()
+        welcome_user(user)
     else:
         print("user not found")
-    welcome_user(user)
     return redirect(url_for("home_blueprint.index"))
 
 
 def welcome_user(user):
-    print("sending welcome")
-    dm_channel = discord_client.bot_request(
-        "/users/@me/channels", "POST", json={"recipient_id": user.id}
-    )
-    return discord_client.bot_request(
-        f"/channels/{dm_channel['id']}/messages",
-        "POST",
-        json={"content": "Thanks for authorizing the app!"},
+    print("queueing welcome")
+    enqueue(
+        current_app,
+        [
+            notification(
+                WELCOME,
+                current_user.character_id,
+                user.id,
+                {"content": "Thanks for authorizing the app!"},
+                discord_user_id=str(user.id),
+            )
+        ],
     )
 
 
@@ -0,0 +1,207 @@
+"""Per-character SSO tokens for ESI calls.
+
+One ``EsiSecurity`` holds the token of a single character, so sharing it
+between threads means every call has to swap tokens in and out. The
+``TokenManager`` keeps a small context per character instead and acts as the
+security hook of the shared ``EsiClient``: whatever token is bound to the
+calling thread is the one applied to the request.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import requests
+
+
+class TokenContext:
+    """Token state for one character"""
+
+    def __init__(self, character):
+        self.key = (type(character).__name__, character.character_id)
+        self.character_id = character.character_id
+        self.character_name = character.character_name
+        self.model = type(character)
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = 0.0
+        self.adopt(character)
+
+    def adopt(self, character) -> None:
+        """Take the stored token of ``character`` if it outlives ours"""
+        expires_at = time.time() + character.get_sso_data()["expires_in"]
+        if expires_at > self.expires_at:
+            self.access_token = character.access_token
+            self.refresh_token = character.refresh_token
+            self.expires_at = expires_at
+
+
+class TokenManager:
+    """Caches access tokens per character and refreshes them ahead of time.
+
+    Args:
+        esisecurity (EsiSecurity): Provides the SSO endpoint and client credentials.
+        headers (dict): Extra headers for the SSO requests (User-Agent).
+        workers (int): Size of the background refresh pool.
+        refresh_margin (int): Seconds before expiry a token stops being used.
+        prefetch_window (int): Seconds before expiry a token is refreshed in
+            the background.
+        transport_adapter (HTTPAdapter): Optional adapter for the SSO requests,
+            used to reach the local ESI stand-in.
+    """
+
+    def __init__(
+        self,
+        esisecurity,
+        headers=None,
+        workers=4,
+        refresh_margin=60,
+        prefetch_window=300,
+        transport_adapter=None,
+    ):
+        self.esisecurity = esisecurity
+        self.refresh_margin = refresh_margin
+        self.prefetch_window = prefetch_window
+
+        self._contexts = {}
+        self._inflight = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sso-refresh")
+        self._session = requests.Session()
+        self._session.headers.update(headers or {})
+        if transport_adapter is not None:
+            self._session.mount("https://", transport_adapter)
+
+    def context(self, character) -> TokenContext:
+        """Get the context of ``character``, creating it on first use.
+
+        Users and Characters rows hold separate refresh tokens, so they get
+        separate contexts even for the same character id.
+        """
+        key = (type(character).__name__, character.character_id)
+        with self._lock:
+            ctx = self._contexts.get(key)
+            if ctx is None:
+                ctx = self._contexts[key] = TokenContext(character)
+            else:
+                # another worker may have refreshed and saved a newer token
+                ctx.adopt(character)
+        return ctx
+
+    def access_token(self, character) -> str:
+        """A valid access token for ``character``, refreshing it if needed.
+
+        Raises:
+            RuntimeError: If the SSO refresh fails.
+        """
+        ctx = self.context(character)
+        left = ctx.expires_at - time.time()
+        if left > self.refresh_margin:
+            if left < self.prefetch_window:
+                self._refresh(ctx)
+            return ctx.access_token
+        return self._refresh(ctx).result()
+
+    def prefetch(self, characters) -> None:
+        """Refresh in the background every token about to expire"""
+        now = time.time()
+        for character in characters:
+            ctx = self.context(character)
+            if ctx.expires_at - now < self.prefetch_window:
+                self._refresh(ctx)
+
+    def _refresh(self, ctx):
+        """Start a refresh, or join the one already running for this character.
+
+        Finished futures are left in place and replaced on the next refresh.
+        """
+        with self._lock:
+            future = self._inflight.get(ctx.key)
+            if future is None or future.done():
+                future = self._pool.submit(self._do_refresh, ctx)
+                self._inflight[ctx.key] = future
+        return future
+
+    def _do_refresh(self, ctx) -> str:
+        res = self._session.post(
+            self.esisecurity.oauth_token,
+            data={"grant_type": "refresh_token", "refresh_token": ctx.refresh_token},
+            auth=(self.esisecurity.client_id, self.esisecurity.secret_key),
+            timeout=30,
+        )
+        if res.status_code != 200:
+            raise RuntimeError(
+                f"Error refreshing token for {ctx.character_name}, "
+                f"error: {res.status_code} {res.text}"
+            )
+        token = res.json()
+
+        with self._lock:
+            ctx.access_token = token["access_token"]
+            ctx.refresh_token = token.get("refresh_token", ctx.refresh_token)
+            ctx.expires_at = time.time() + token["expires_in"]
+            self._dirty[ctx.key] = ctx
+        return ctx.access_token
+
+    @contextmanager
+    def bind(self, access_token):
+        """Use ``access_token`` for ESI requests made by this thread"""
+        previous = getattr(self._local, "access_token", None)
+        self._local.access_token = access_token
+        try:
+            yield
+        finally:
+            self._local.access_token = previous
+
+    def __call__(self, request):
+        """pyswagger security hook, adds the thread's bearer token if required"""
+        access_token = getattr(self._local, "access_token", None)
+        if request._security and access_token is not None:
+            request._p["header"].update({"Authorization": f"Bearer {access_token}"})
+        return request
+
+    def flush(self, app) -> int:
+        """Save refreshed tokens back to their rows in one batched write.
+
+        Args:
+            app (object): The Flask app instance.
+
+        Returns:
+            int: Number of rows written.
+        """
+        from sqlalchemy import update
+        from apps import db
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        by_model = {}
+        for ctx in dirty.values():
+            by_model.setdefault(ctx.model, []).append(
+                {
+                    "character_id": ctx.character_id,
+                    "access_token": ctx.access_token,
+                    "access_token_expires": datetime.fromtimestamp(ctx.expires_at),
+                    "refresh_token": ctx.refresh_token,
+                }
+            )
+
+        with app.app_context():
+            try:
+                for model, rows in by_model.items():
+                    db.session.execute(update(model), rows)
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                with self._lock:
+                    for key, ctx in dirty.items():
+                        self._dirty.setdefault(key, ctx)
+                print(f"Failed to save refreshed tokens, error: {error}")
+                return 0
+        return len(dirty)
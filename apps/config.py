@@ -4,7 +4,11 @@ Copyright (c) 2019 - present AppSeed.us
 """
 
 import os
-from decouple import config
+from decouple import Csv, config
+
+from esi_tools.cache import DEFAULT_CACHE_PATH
+from esi_tools.swagger import DEFAULT_SPEC_PATH
+from esi_tools.async_client import ESI_BASE_URL
 
 
 class Config(object):
@@ -21,10 +25,45 @@ class Config(object):
     ESI_CALLBACK = config("ESI_CALLBACK")
     ESI_USER_AGENT = config("ESI_USER_AGENT")
     ESI_SWAGGER_JSON = config("ESI_SWAGGER_JSON")
+    ESI_BASE_URL = config("ESI_BASE_URL", default=ESI_BASE_URL)
+    ESI_SPEC_PATH = config("ESI_SPEC_PATH", default=DEFAULT_SPEC_PATH)
+    ESI_SPEC_REFRESH_HOURS = config("ESI_SPEC_REFRESH_HOURS", default=24, cast=int)
+    ESI_CACHE_PATH = config("ESI_CACHE_PATH", default=DEFAULT_CACHE_PATH)
+    ESI_CACHE_MAX_MB = config("ESI_CACHE_MAX_MB", default=512, cast=int)
+    ESI_TOKEN_WORKERS = config("ESI_TOKEN_WORKERS", default=4, cast=int)
+    ESI_CONCURRENCY = config("ESI_CONCURRENCY", default=20, cast=int)
+    TASK_WRITE_CHUNK_SIZE = config("TASK_WRITE_CHUNK_SIZE", default=1000, cast=int)
+    # empty MARKET_HISTORY_TYPES means every type in the mining ledger
+    MARKET_HISTORY_REGIONS = config("MARKET_HISTORY_REGIONS", default="10000002", cast=Csv(int))
+    MARKET_HISTORY_TYPES = config("MARKET_HISTORY_TYPES", default="", cast=Csv(int))
+    MARKET_HISTORY_MAX_AGE_HOURS = config("MARKET_HISTORY_MAX_AGE_HOURS", default=24, cast=int)
+    MARKET_HISTORY_BATCH_SIZE = config("MARKET_HISTORY_BATCH_SIZE", default=1000, cast=int)
+    # rows (market_history), packed (market_series) or both
+    MARKET_HISTORY_STORAGE = config("MARKET_HISTORY_STORAGE", default="rows")
+    CONTRACT_SWEEP_WORKERS = config("CONTRACT_SWEEP_WORKERS", default=8, cast=int)
+    CONTRACT_ITEM_WORKERS = config("CONTRACT_ITEM_WORKERS", default=4, cast=int)
+    CONTRACT_ITEM_BATCH_SIZE = config("CONTRACT_ITEM_BATCH_SIZE", default=100, cast=int)
+    # item fetches per run, contracts scored under LAZY_SCORE only get what is left
+    CONTRACT_ITEM_BUDGET = config("CONTRACT_ITEM_BUDGET", default=2000, cast=int)
+    CONTRACT_ITEM_LAZY_SCORE = config("CONTRACT_ITEM_LAZY_SCORE", default=300, cast=int)
+    CONTRACT_ITEM_REGIONS = config("CONTRACT_ITEM_REGIONS", default="10000002", cast=Csv(int))
+    SP_FARM_THRESHOLD = config("SP_FARM_THRESHOLD", default=5500000, cast=int)
+    # character tasks poll for due refreshes, idle characters back off to REFRESH_MAX_HOURS
+    REFRESH_POLL_SECONDS = config("REFRESH_POLL_SECONDS", default=300, cast=int)
+    REFRESH_MIN_MINUTES = config("REFRESH_MIN_MINUTES", default=15, cast=int)
+    REFRESH_MAX_HOURS = config("REFRESH_MAX_HOURS", default=24, cast=int)
+    # each character comes up on one tick of the poll window, jobs get up to this much jitter
+    TASK_TICK_SECONDS = config("TASK_TICK_SECONDS", default=30, cast=int)
+    TASK_JITTER_SECONDS = config("TASK_JITTER_SECONDS", default=10, cast=int)
+    TASK_METRICS_MINUTES = config("TASK_METRICS_MINUTES", default=10, cast=int)
+    CHARACTER_TASK_WORKERS = config("CHARACTER_TASK_WORKERS", default=8, cast=int)
+    MINING_LEDGER_REVISION_DAYS = config("MINING_LEDGER_REVISION_DAYS", default=2, cast=int)
     DISCORD_CLIENT_ID = config("DISCORD_CLIENT_ID")
     DISCORD_CLIENT_SECRET = config("DISCORD_CLIENT_SECRET")
     DISCORD_REDIRECT_URI = config("DISCORD_REDIRECT_URI")
     DISCORD_BOT_TOKEN = config("DISCORD_BOT_TOKEN")
+    DISCORD_API_URL = config("DISCORD_API_URL", default="https://discord.com/api/v10")
+    DISCORD_DISPATCH_INTERVAL = config("DISCORD_DISPATCH_INTERVAL", default=5, cast=int)
     OAUTHLIB_INSECURE_TRANSPORT = config("OAUTHLIB_INSECURE_TRANSPORT")
 
 
@@ -0,0 +1,90 @@
+"""Server side downsampling for the dashboard charts.
+
+A chart is a few hundred pixels wide, so sending years of daily rows only
+costs bandwidth and browser time. Both methods return the indices of the
+points to keep, so every column of a series can be picked the same way.
+
+* ``lttb``    Largest-Triangle-Three-Buckets, keeps the visual shape of
+              a line (peaks, trend changes) with one point per bucket.
+* ``minmax``  The lowest and highest point of every bucket, for spiky
+              data like traded volume where an extreme must not vanish.
+"""
+
+import hashlib
+
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+DEFAULT_POINTS = 300
+MAX_POINTS = 2000
+
+
+def _boundaries(count: int, buckets: int) -> np.ndarray:
+    """Start index of each of ``buckets`` near-equal buckets over ``count`` points, plus the end"""
+    return np.linspace(0, count, buckets + 1).astype(np.int64)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of ``points`` samples chosen with Largest-Triangle-Three-Buckets.
+
+    The first and last samples are always kept. Each bucket in between
+    keeps the sample forming the largest triangle with the previously kept
+    sample and the mean of the next bucket.
+    """
+    count = len(y)
+    if points >= count or points < 3:
+        return np.arange(count)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # buckets over the samples between the fixed first and last ones
+    bounds = _boundaries(count - 2, points - 2) + 1
+    # mean of every bucket in one pass, the last "next bucket" is the last sample
+    sizes = np.diff(bounds)
+    mean_x = np.append(np.add.reduceat(x[1:-1], bounds[:-1] - 1) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(y[1:-1], bounds[:-1] - 1) / sizes, y[-1])
+
+    kept = np.empty(points, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, stop = bounds[bucket], bounds[bucket + 1]
+        area = np.abs(
+            (x[previous] - mean_x[bucket + 1]) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (mean_y[bucket + 1] - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def minmax(y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the minimum and maximum of ``points // 2`` buckets, in order"""
+    count = len(y)
+    buckets = points // 2
+    if points >= count or buckets < 1:
+        return np.arange(count)
+
+    y = np.asarray(y)
+    starts = _boundaries(count, buckets)[:-1]
+    sizes = np.diff(np.append(starts, count))
+    bucket_of = np.repeat(np.arange(buckets), sizes)
+    kept = []
+    for reduce in (np.minimum, np.maximum):
+        # samples equal to their bucket's extreme, then the first of them per bucket
+        hits = np.flatnonzero(y == np.repeat(reduce.reduceat(y, starts), sizes))
+        buckets_hit = bucket_of[hits]
+        kept.append(hits[np.flatnonzero(np.diff(buckets_hit, prepend=-1))])
+    return np.unique(np.concatenate(kept))
+
+
+def downsample(x: np.ndarray, y: np.ndarray, points: int, method: str = "lttb") -> np.ndarray:
+    """Indices to keep for ``method`` (see ``METHODS``), all of them for short series"""
+    if method == "minmax":
+        return minmax(y, points)
+    return lttb(x, y, points)
+
+
+def make_etag(*parts) -> str:
+    """ETag for a response that depends only on ``parts``"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
@@ -3,14 +3,16 @@
 Copyright (c) 2019 - present AppSeed.us
 """
 
-from flask import render_template, request, redirect, url_for, jsonify, flash
+from flask import current_app, render_template, request, redirect, url_for, jsonify, flash
 from flask_login import login_required, current_user
 from jinja2 import TemplateNotFound
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm import aliased
 from sqlalchemy import distinct, desc
 from apps import esi, db
-from apps.home import blueprint
+from apps.home import blueprint, charts
+from apps.market import series
+from apps.tasks.watch_index import WATCHES
 from apps.authentication.models import (
     Users,
     Characters,
@@ -23,8 +25,14 @@ from apps.authentication.models import (
     BlueprintLongDurationOrder,
     StaStation,
     ContractTrack,
+    MarketStats,
+    MarketHistoryIndex,
+    SkillPointHistory,
 )
 
+from datetime import date
+
+import numpy as np
 from dotenv import dotenv_values
 
 config = dotenv_values(".env")
@@ -133,6 +141,7 @@ def display_contract_selection():
                 )
                 db.session.add(new_tracking)
                 db.session.commit()
+                WATCHES.invalidate()
                 flash("Item successfully added to tracking.", "success")
 
         elif action == "remove":
@@ -144,6 +153,7 @@ def display_contract_selection():
             if tracked_item:
                 db.session.delete(tracked_item)
                 db.session.commit()
+                WATCHES.invalidate()
                 flash("Item removed from tracking.", "success")
             else:
                 flash("Item not found in tracking.", "warning")
@@ -177,6 +187,136 @@ def autocomplete():
     )
 
 
+def _chart_args():
+    """points, method, start and end of a chart request, or an error message"""
+    points = request.args.get("points", charts.DEFAULT_POINTS, type=int)
+    method = request.args.get("method", "lttb")
+    if method not in charts.METHODS:
+        return None, f"method must be one of {', '.join(charts.METHODS)}"
+    try:
+        start = date.fromisoformat(request.args["start"]) if request.args.get("start") else None
+        end = date.fromisoformat(request.args["end"]) if request.args.get("end") else None
+    except ValueError:
+        return None, "start and end must be YYYY-MM-DD"
+    return (max(3, min(points, charts.MAX_POINTS)), method, start, end), None
+
+
+def _chart_response(etag: str, build):
+    """JSON from ``build()``, or 304 when the client already has ``etag``"""
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@blueprint.route("/api/chart/market-history", methods=["GET"])
+@login_required
+def api_chart_market_history():
+    """Downsampled market history of one type for Chart.js.
+
+    Query: type_id, region_id, fields (comma separated, default average),
+    points, method (lttb or minmax), start and end (YYYY-MM-DD). The first
+    field decides which days are kept.
+    """
+    type_id = request.args.get("type_id", type=int)
+    region_id = request.args.get(
+        "region_id",
+        (current_app.config.get("MARKET_HISTORY_REGIONS") or [10000002])[0],
+        type=int,
+    )
+    fields = request.args.get("fields", "average").split(",")
+    if type_id is None:
+        return jsonify({"error": "type_id is required"}), 400
+    if any(field not in series.COLUMNS[1:] for field in fields):
+        return jsonify({"error": f"fields must be in {', '.join(series.COLUMNS[1:])}"}), 400
+    args, error = _chart_args()
+    if error:
+        return jsonify({"error": error}), 400
+    points, method, start, end = args
+
+    # days are only ever appended, the newest one identifies the data
+    last_date = db.session.query(MarketHistoryIndex.last_date).filter(
+        MarketHistoryIndex.region_id == region_id, MarketHistoryIndex.type_id == type_id
+    ).scalar()
+    etag = charts.make_etag("market", region_id, type_id, fields, args, last_date)
+
+    def build():
+        history = series.load_series(current_app, region_id, type_id, start, end)
+        days = history.date.astype(np.int64)
+        kept = charts.downsample(days, getattr(history, fields[0]), points, method)
+        return {
+            "type_id": type_id,
+            "region_id": region_id,
+            "method": method,
+            "total": len(history),
+            "x": np.datetime_as_string(history.date[kept]).tolist(),
+            **{field: getattr(history, field)[kept].tolist() for field in fields},
+        }
+
+    return _chart_response(etag, build)
+
+
+@blueprint.route("/api/chart/sp-history", methods=["GET"])
+@login_required
+def api_chart_sp_history():
+    """Downsampled skill point history of one of the user's characters.
+
+    Query: character_id, points, method, start and end like the market chart.
+    """
+    character_id = request.args.get("character_id", type=int)
+    owned = db.session.query(Characters.character_id).filter(
+        Characters.character_id == character_id,
+        Characters.master_character_id == current_user.character_id,
+    ).scalar()
+    if owned is None:
+        return jsonify({"error": "Unknown character"}), 404
+    args, error = _chart_args()
+    if error:
+        return jsonify({"error": error}), 400
+    points, method, start, end = args
+
+    query = db.session.query(SkillPointHistory).filter(
+        SkillPointHistory.character_id == character_id
+    )
+    if start:
+        query = query.filter(SkillPointHistory.date >= start)
+    if end:
+        query = query.filter(SkillPointHistory.date <= end)
+
+    # the sync rewrites today's point, so the newest total is part of the tag
+    count, last_date = query.with_entities(
+        db.func.count(), db.func.max(SkillPointHistory.date)
+    ).one()
+    last_sp = None
+    if last_date is not None:
+        last_sp = db.session.query(SkillPointHistory.total_sp).filter(
+            SkillPointHistory.character_id == character_id,
+            SkillPointHistory.date == last_date,
+        ).scalar()
+    etag = charts.make_etag("sp", character_id, args, count, last_date, last_sp)
+
+    def build():
+        rows = query.with_entities(
+            SkillPointHistory.date, SkillPointHistory.total_sp
+        ).order_by(SkillPointHistory.date).all()
+        days = np.array([row.date for row in rows], dtype="datetime64[D]")
+        total_sp = np.array([row.total_sp for row in rows], dtype=np.int64)
+        kept = charts.downsample(days.astype(np.int64), total_sp, points, method)
+        return {
+            "character_id": character_id,
+            "method": method,
+            "total": len(rows),
+            "x": np.datetime_as_string(days[kept]).tolist(),
+            "total_sp": total_sp[kept].tolist(),
+        }
+
+    return _chart_response(etag, build)
+
+
 @blueprint.route("/page-character.html", methods=["POST"])
 @login_required
 def page_character_post():
@@ -367,6 +507,21 @@ def page_miningledger():
 
             date_list.append(data_builder)
 
+        # Value the ore at the precomputed 30 day volume weighted price
+        region_id = (current_app.config.get("MARKET_HISTORY_REGIONS") or [10000002])[0]
+        type_ids = {row[4] for date_group in date_list for row in date_group}
+        prices = {
+            type_id: price
+            for type_id, price in db.session.query(MarketStats.type_id, MarketStats.vwap_30)
+            .filter(MarketStats.region_id == region_id)
+            .filter(MarketStats.type_id.in_(type_ids))
+            .all()
+        }
+        for date_group in date_list:
+            for row in date_group:
+                price = prices.get(row[4])
+                row.append(price * row[2] if price is not None else None)
+
     except Exception as e:
         print(f"Error: {e}")
         date_list = []
@@ -0,0 +1,38 @@
+"""Checks of the chart downsampling"""
+
+import numpy as np
+
+from apps.home.charts import _boundaries, lttb, minmax
+
+
+def _series(count: int = 1000):
+    rng = np.random.default_rng(3)
+    return np.arange(count, dtype=np.float64), np.cumsum(rng.normal(size=count))
+
+
+def test_lttb_keeps_endpoints_and_returns_points():
+    x, y = _series()
+    for points in (3, 10, 299, 999):
+        kept = lttb(x, y, points)
+        assert len(kept) == points
+        assert kept[0] == 0 and kept[-1] == len(y) - 1
+        assert (np.diff(kept) > 0).all()
+
+
+def test_lttb_short_series_kept_whole():
+    x, y = _series(20)
+    np.testing.assert_array_equal(lttb(x, y, 20), np.arange(20))
+    np.testing.assert_array_equal(lttb(x, y, 50), np.arange(20))
+
+
+def test_minmax_keeps_bucket_extremes():
+    _, y = _series()
+    points = 100
+    kept = minmax(y, points)
+    assert (np.diff(kept) > 0).all()
+    bounds = _boundaries(len(y), points // 2)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        in_bucket = kept[(kept >= start) & (kept < stop)]
+        assert 1 <= len(in_bucket) <= 2
+        assert y[in_bucket].min() == y[start:stop].min()
+        assert y[in_bucket].max() == y[start:stop].max()
@@ -0,0 +1,19 @@
+"""Market data storage and analytics on top of the history tasks"""
+
+
+def init_app(app) -> None:
+    """Register the ``flask market-series`` commands"""
+    import click
+    from flask.cli import AppGroup
+
+    from . import series
+
+    group = AppGroup("market-series", help="Manage the packed market history.")
+
+    @group.command("rebuild")
+    @click.option("--region", "regions", type=int, multiple=True, help="Only these regions.")
+    def rebuild(regions):
+        written = series.rebuild(app, regions or None)
+        print(f"Rebuilt {written} market series")
+
+    app.cli.add_command(group)
@@ -0,0 +1,263 @@
+"""Packed, columnar market history.
+
+``market_history`` keeps one row per (type, region, day). Reading a year of
+history for a few thousand types is millions of rows turned into ORM objects.
+Here each (region, type) series is a single ``market_series`` row whose
+``data`` blob holds the columns back to back as fixed-width arrays:
+
+    date (datetime64[D]) | average | highest | lowest (float64) | volume | order_count (int64)
+
+so a read is one row fetch and ``numpy.frombuffer`` views over the blob,
+without copying or parsing. Days are only ever appended: ESI publishes a
+day once, and ``append_days`` drops days not newer than the stored last day.
+
+The storage mode is picked with MARKET_HISTORY_STORAGE: ``rows`` (the
+market_history table only), ``packed`` (this table only) or ``both``.
+"""
+
+from collections import defaultdict, namedtuple
+from datetime import date
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+from apps import db
+from apps.authentication.models import MarketHistory, MarketSeries
+from apps.tasks.bulk import bulk_upsert
+
+COLUMNS = ("date", "average", "highest", "lowest", "volume", "order_count")
+DTYPES = (
+    np.dtype("datetime64[D]"),
+    np.dtype("<f8"),
+    np.dtype("<f8"),
+    np.dtype("<f8"),
+    np.dtype("<i8"),
+    np.dtype("<i8"),
+)
+# every column is 8 bytes wide, so column k of an n day series starts at k * 8 * n
+_WIDTH = 8
+
+STORAGE_MODES = ("rows", "packed", "both")
+
+
+class Series(namedtuple("Series", COLUMNS)):
+    """Columns of one (region, type) series as read-only numpy arrays"""
+
+    def __len__(self):
+        return len(self.date)
+
+    def between(self, start: Optional[date] = None, end: Optional[date] = None) -> "Series":
+        """Days from ``start`` to ``end`` inclusive, as views of the same buffer"""
+        dates = self.date
+        lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, "D")))
+        hi = len(dates) if end is None else int(
+            np.searchsorted(dates, np.datetime64(end, "D"), side="right")
+        )
+        return Series(*(column[lo:hi] for column in self))
+
+
+EMPTY = Series(*(np.empty(0, dtype) for dtype in DTYPES))
+
+
+def storage_mode(app: object) -> str:
+    """MARKET_HISTORY_STORAGE of ``app``, ``rows`` when unset or unknown"""
+    mode = app.config.get("MARKET_HISTORY_STORAGE", "rows")
+    return mode if mode in STORAGE_MODES else "rows"
+
+
+def pack(series: Series) -> bytes:
+    """Concatenate the columns of ``series`` into one blob"""
+    return b"".join(
+        np.ascontiguousarray(column, dtype).tobytes() for column, dtype in zip(series, DTYPES)
+    )
+
+
+def unpack(blob: bytes, length: int) -> Series:
+    """Zero-copy views over a blob made by ``pack``"""
+    if not length:
+        return EMPTY
+    return Series(
+        *(
+            np.frombuffer(blob, dtype, count=length, offset=index * _WIDTH * length)
+            for index, dtype in enumerate(DTYPES)
+        )
+    )
+
+
+def from_rows(rows: Iterable[dict]) -> Series:
+    """Series from history dicts (market_history columns or ESI rows), sorted by date"""
+    rows = sorted(rows, key=lambda row: row["date"])
+    return Series(
+        *(np.array([row[name] for row in rows], dtype) for name, dtype in zip(COLUMNS, DTYPES))
+    )
+
+
+def concat(old: Series, new: Series) -> Series:
+    """``old`` followed by the days of ``new`` after its last day"""
+    if len(old) and len(new):
+        new = new.between(start=(old.date[-1] + np.timedelta64(1, "D")).astype(date))
+    if not len(new):
+        return old
+    return Series(*(np.concatenate(pair) for pair in zip(old, new)))
+
+
+def _series_row(region_id: int, type_id: int, series: Series) -> dict:
+    return {
+        "region_id": region_id,
+        "type_id": type_id,
+        "first_date": series.date[0].astype(date),
+        "last_date": series.date[-1].astype(date),
+        "length": len(series),
+        "data": pack(series),
+    }
+
+
+def load_series(
+    app: object,
+    region_id: int,
+    type_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> Series:
+    """History of one (region, type), optionally limited to ``start``..``end``.
+
+    Reads market_history instead when MARKET_HISTORY_STORAGE is ``rows``.
+
+    Args:
+        app (object): The Flask app instance.
+        region_id (int): The region.
+        type_id (int): The type.
+        start, end (date): Inclusive bounds, open when None.
+
+    Returns:
+        Series: read-only arrays, empty when nothing is stored.
+    """
+    if storage_mode(app) == "rows":
+        return _load_rows(app, region_id, start, [type_id]).get(type_id, EMPTY).between(end=end)
+
+    with app.app_context():
+        row = db.session.execute(
+            db.select(MarketSeries.length, MarketSeries.data).where(
+                MarketSeries.region_id == region_id, MarketSeries.type_id == type_id
+            )
+        ).first()
+    if row is None:
+        return EMPTY
+    return unpack(row.data, row.length).between(start, end)
+
+
+def load_many(app: object, region_id: int, type_ids: Iterable[int] = None) -> Dict[int, Series]:
+    """type_id -> Series of a region, every stored type when ``type_ids`` is None"""
+    query = db.select(MarketSeries.type_id, MarketSeries.length, MarketSeries.data).where(
+        MarketSeries.region_id == region_id
+    )
+    if type_ids is not None:
+        query = query.where(MarketSeries.type_id.in_(list(type_ids)))
+    with app.app_context():
+        rows = db.session.execute(query).all()
+    return {row.type_id: unpack(row.data, row.length) for row in rows}
+
+
+def load_region(app: object, region_id: int, since: Optional[date] = None) -> Dict[int, Series]:
+    """type_id -> Series of a region from whichever storage MARKET_HISTORY_STORAGE uses.
+
+    Args:
+        app (object): The Flask app instance.
+        region_id (int): The region.
+        since (date): Only days from this one on, everything when None.
+    """
+    if storage_mode(app) != "rows":
+        return {
+            type_id: values.between(since)
+            for type_id, values in load_many(app, region_id).items()
+        }
+    return _load_rows(app, region_id, since)
+
+
+def _load_rows(
+    app: object, region_id: int, since: Optional[date] = None, type_ids: list = None
+) -> Dict[int, Series]:
+    """type_id -> Series built from the market_history rows of a region"""
+    query = db.select(
+        MarketHistory.typeID, *(getattr(MarketHistory, name) for name in COLUMNS)
+    ).where(MarketHistory.regionID == region_id)
+    if since is not None:
+        query = query.where(MarketHistory.date >= since)
+    if type_ids is not None:
+        query = query.where(MarketHistory.typeID.in_(type_ids))
+    grouped = defaultdict(dict)
+    with app.app_context():
+        for row in db.session.execute(query):
+            # duplicated days collapse to one
+            grouped[row.typeID][row.date] = row._asdict()
+    return {type_id: from_rows(days.values()) for type_id, days in grouped.items()}
+
+
+def append_days(app: object, history_rows: list, label: str = None) -> int:
+    """Append history days to their packed series.
+
+    Args:
+        app (object): The Flask app instance.
+        history_rows (list): market_history style dicts (typeID, regionID,
+            date, average, ...), any number of series mixed.
+        label (str): Printed with the write statistics when given.
+
+    Returns:
+        int: Number of days appended.
+    """
+    grouped = defaultdict(list)
+    for row in history_rows:
+        grouped[(row["regionID"], row["typeID"])].append(row)
+    if not grouped:
+        return 0
+
+    table = MarketSeries.__table__
+    stored = {}
+    with app.app_context():
+        for region_id in {region_id for region_id, _ in grouped}:
+            type_ids = [type_id for key_region, type_id in grouped if key_region == region_id]
+            for row in db.session.execute(
+                db.select(table.c.type_id, table.c.length, table.c.data).where(
+                    table.c.region_id == region_id, table.c.type_id.in_(type_ids)
+                )
+            ):
+                stored[(region_id, row.type_id)] = unpack(row.data, row.length)
+
+    appended, rows = 0, []
+    for (region_id, type_id), days in grouped.items():
+        old = stored.get((region_id, type_id), EMPTY)
+        series = concat(old, from_rows(days))
+        if len(series) == len(old):
+            continue
+        appended += len(series) - len(old)
+        rows.append(_series_row(region_id, type_id, series))
+
+    bulk_upsert(app, MarketSeries, rows, chunk_size=200, label=label)
+    return appended
+
+
+def rebuild(app: object, region_ids: Iterable[int] = None) -> int:
+    """Build the packed series from the market_history rows.
+
+    For switching an existing install to ``packed`` or ``both``. Series are
+    rebuilt from scratch one region at a time.
+
+    Returns:
+        int: Number of series written.
+    """
+    with app.app_context():
+        if region_ids is None:
+            region_ids = db.session.execute(
+                db.select(MarketHistory.regionID).distinct()
+            ).scalars().all()
+        region_ids = list(region_ids)
+
+    written = 0
+    for region_id in region_ids:
+        rows = [
+            _series_row(region_id, type_id, values)
+            for type_id, values in _load_rows(app, region_id).items()
+        ]
+        bulk_upsert(app, MarketSeries, rows, chunk_size=200, label=f"Market series {region_id}")
+        written += len(rows)
+    return written
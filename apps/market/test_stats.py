@@ -0,0 +1,46 @@
+"""Checks of the vectorized market statistics against plain numpy"""
+
+import warnings
+
+import numpy as np
+
+from apps.market.stats import _percentiles, _trend
+
+
+def _matrix():
+    rng = np.random.default_rng(7)
+    matrix = rng.uniform(1, 100, size=(50, 90))
+    matrix[rng.random(matrix.shape) < 0.4] = np.nan
+    matrix[3] = np.nan  # never traded
+    matrix[4, :] = np.nan
+    matrix[4, 10] = 42.0  # traded once
+    return matrix
+
+
+def test_percentiles_match_nanpercentile():
+    matrix = _matrix()
+    percents = (0, 10, 50, 90, 100)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        expected = np.nanpercentile(matrix, percents, axis=1)
+    for percent, value, reference in zip(percents, _percentiles(matrix, percents), expected):
+        np.testing.assert_allclose(value, reference, equal_nan=True, err_msg=f"p{percent}")
+
+
+def test_percentiles_all_nan_rows():
+    p10, p90 = _percentiles(np.full((2, 5), np.nan), (10, 90))
+    assert np.isnan(p10).all() and np.isnan(p90).all()
+
+
+def test_trend_matches_polyfit():
+    matrix = _matrix()
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        trend = _trend(matrix)
+    for row, prices in enumerate(matrix):
+        observed = np.flatnonzero(~np.isnan(prices))
+        if len(observed) < 2:
+            assert np.isnan(trend[row])
+            continue
+        slope = np.polyfit(observed, prices[observed], 1)[0]
+        np.testing.assert_allclose(trend[row], slope / prices[observed].mean())
@@ -0,0 +1,41 @@
+"""Boot time accounting for create_app.
+
+Each worker prints where its startup time went, so a slow boot (spec
+download, database, scheduler) shows up in the logs right away.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """Collects named step durations, in the order they ran"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.steps.append((name, seconds))
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def format(self) -> str:
+        lines = [f"Startup took {self.total() * 1000:.0f} ms"]
+        for name, seconds in self.steps:
+            lines.append(f"  {name:<28} {seconds * 1000:8.1f} ms")
+        return "\n".join(lines)
+
+
+def get_report(app) -> StartupReport:
+    """The report of ``app``, created on first use"""
+    return app.extensions.setdefault("startup_report", StartupReport())
@@ -0,0 +1,204 @@
+"""Bulk writes for the scheduled tasks.
+
+The tasks used to ``db.session.merge(row)`` and commit once per record, which
+is a SELECT and a transaction per row. These helpers execute one INSERT
+for each chunk of plain dicts instead, as an executemany of the chunk's
+rows, turned into upserts with the dialect's own syntax (MySQL
+``ON DUPLICATE KEY UPDATE``, PostgreSQL and SQLite ``ON CONFLICT``), and
+commit once per chunk.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from apps import db
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# bound parameters per statement the drivers accept, for those that fold an
+# executemany into multi-row VALUES
+_MAX_PARAMS = {"sqlite": 32766, "postgresql": 65535}
+
+_SQLITE_WRITES = threading.Lock()
+
+
+class WriteStats(namedtuple("WriteStats", ["rows", "batches", "seconds", "written"],
+                            defaults=(None,))):
+    """Rows written, chunks executed and time spent by one bulk write.
+
+    ``written`` is the rowcount the database reported, for an upsert that
+    keeps existing rows the number of new ones; None when unknown.
+    """
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.rows} rows in {self.batches} batches, "
+            f"{self.seconds:.2f}s ({self.rows_per_second:,.0f} rows/s)"
+        )
+
+
+@contextmanager
+def write_lock(dialect: str):
+    """Serialize writes from task threads on SQLite, which has a single writer.
+
+    Without it threads committing at once wait on the database lock and give
+    up with "database is locked". Other databases lock rows, not files, so
+    this does nothing for them.
+    """
+    if dialect != "sqlite":
+        yield
+        return
+    with _SQLITE_WRITES:
+        yield
+
+
+def _chunks(rows: list, size: int):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _chunk_size(app: object, dialect: str, columns: int, chunk_size) -> int:
+    size = chunk_size or app.config.get("TASK_WRITE_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+    limit = _MAX_PARAMS.get(dialect)
+    if limit:
+        size = min(size, max(1, limit // max(columns, 1)))
+    return size
+
+
+def upsert_statement(dialect: str, table, keys: list, update: list):
+    """INSERT ... ON CONFLICT/ON DUPLICATE KEY for ``table``, values bound at execute.
+
+    Args:
+        dialect (str): SQLAlchemy dialect name.
+        table (Table): The table to write.
+        keys (list): Columns of the primary key or unique index that conflicts.
+        update (list): Columns overwritten on conflict, none means keep the row.
+
+    Raises:
+        NotImplementedError: For dialects without an upsert syntax we know.
+    """
+    if dialect in ("mysql", "mariadb"):
+        stmt = mysql.insert(table)
+        if not update:
+            # a no-op ON DUPLICATE KEY UPDATE counts the kept rows as affected
+            return stmt.prefix_with("IGNORE")
+        return stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in update})
+
+    if dialect in ("postgresql", "sqlite"):
+        module = postgresql if dialect == "postgresql" else sqlite
+        stmt = module.insert(table)
+        if not update:
+            return stmt.on_conflict_do_nothing(index_elements=keys)
+        return stmt.on_conflict_do_update(
+            index_elements=keys, set_={name: stmt.excluded[name] for name in update}
+        )
+
+    raise NotImplementedError(f"No bulk upsert for the {dialect} dialect")
+
+
+def bulk_upsert(
+    app: object,
+    model,
+    rows: list,
+    keys: list = None,
+    update: list = None,
+    chunk_size: int = None,
+    label: str = None,
+) -> WriteStats:
+    """Insert or update ``rows``, one executemany and one commit per chunk.
+
+    Args:
+        app (object): The Flask app instance.
+        model (db.Model): The model whose table is written.
+        rows (list): dicts of column values, all with the same keys.
+        keys (list): Conflict columns, the primary key by default. They need a
+            primary key or unique index in the database.
+        update (list): Columns to overwrite on conflict, by default every
+            column in the rows except ``keys``.
+        chunk_size (int): Rows per chunk, TASK_WRITE_CHUNK_SIZE by default.
+        label (str): Printed with the write statistics when given.
+
+    Returns:
+        WriteStats: rows, batches and seconds.
+    """
+    started = time.perf_counter()
+    if not rows:
+        return WriteStats(0, 0, 0.0, 0)
+
+    table = model.__table__
+    keys = list(keys or (column.name for column in table.primary_key))
+    columns = list(rows[0])
+    if update is None:
+        update = [name for name in columns if name not in keys]
+
+    batches, written = 0, 0
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        size = _chunk_size(app, dialect, len(columns), chunk_size)
+        try:
+            stmt = upsert_statement(dialect, table, keys, update)
+        except NotImplementedError:
+            stmt = None
+
+        for chunk in _chunks(rows, size):
+            with write_lock(dialect):
+                try:
+                    if stmt is None:
+                        for row in chunk:
+                            db.session.merge(model(**row))
+                        written = None
+                    else:
+                        rowcount = db.session.execute(stmt, chunk).rowcount
+                        if written is not None:
+                            written = written + rowcount if rowcount >= 0 else None
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+            batches += 1
+
+    stats = WriteStats(len(rows), batches, time.perf_counter() - started, written)
+    if label:
+        print(f"{label}: {stats}")
+    return stats
+
+
+def bulk_insert(
+    app: object, model, rows: list, chunk_size: int = None, label: str = None
+) -> WriteStats:
+    """Plain INSERT of ``rows``, one executemany per chunk, for tables without a natural key.
+
+    Same arguments and result as ``bulk_upsert``.
+    """
+    started = time.perf_counter()
+    if not rows:
+        return WriteStats(0, 0, 0.0)
+
+    batches = 0
+    with app.app_context():
+        dialect = db.engine.dialect.name
+        size = _chunk_size(app, dialect, len(rows[0]), chunk_size)
+        stmt = insert(model.__table__)
+        for chunk in _chunks(rows, size):
+            with write_lock(dialect):
+                try:
+                    db.session.execute(stmt, chunk)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+            batches += 1
+
+    stats = WriteStats(len(rows), batches, time.perf_counter() - started)
+    if label:
+        print(f"{label}: {stats}")
+    return stats
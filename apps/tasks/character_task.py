@@ -0,0 +1,181 @@
+"""Base class of the tasks that fetch an ESI endpoint per character.
+
+``CharacterTask`` owns what the skill, blueprint and mining ledger tasks
+used to repeat: picking the due characters of this tick, fetching them on a
+bounded thread pool, writing everything fetched in one batch, recording the
+refresh schedule and reporting how long each character took. Subclasses
+only say how to fetch one character and how to write a batch.
+
+A character whose fetch fails is left out of the batch and stays due, the
+others are written as usual. When the failure means its SSO no longer works
+(the token refresh or ESI refused it) the character is invalidated.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from apps import esi
+from apps.authentication.models import Characters
+from .common import invalidate_sso
+from .refresh import due_characters, record_refresh
+from .stagger import character_shard
+
+# ESI statuses that mean the token was revoked or lost its scopes
+AUTH_FAILURE_STATUS = (401, 403)
+
+Outcome = namedtuple("Outcome", ["character", "data", "expires", "error", "auth", "seconds"])
+
+
+class CharacterTask(ABC):
+    """A task fetching ``ENDPOINT`` for each due character.
+
+    Subclasses set ``ENDPOINT``, ``JOB_ID`` and ``LABEL`` and implement
+    ``fetch`` and ``write``, a subclass missing one cannot be instantiated;
+    ``deadlines`` is optional.
+    """
+
+    ENDPOINT = None
+    JOB_ID = None
+    LABEL = None
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.shard = character_shard(scheduler.app, self.ENDPOINT)
+        self.schedule_tasks()
+
+    def schedule_tasks(self) -> None:
+        """Setup task execution schedule"""
+        self.scheduler.add_job(
+            func=self.main,
+            trigger="interval",
+            seconds=self.scheduler.app.config.get("TASK_TICK_SECONDS", 30),
+            id=self.JOB_ID,
+            name=self.JOB_ID,
+            replace_existing=False,
+            max_instances=1
+        )
+
+    def get_all_users(self) -> list:
+        """Gets all characters"""
+        with self.scheduler.app.app_context():
+            character_list = Characters.query.filter_by(sso_is_valid=True).all()
+        return character_list
+
+    def main(self):
+        due = due_characters(self.scheduler.app, self.ENDPOINT)
+        characters = self.shard.take(due)
+        if not characters:
+            # most ticks, quiet to keep the log readable
+            return
+        print(
+            f"Running {self.LABEL} Main: {datetime.now()}, "
+            f"{len(characters)} of {len(due)} due characters in this slot"
+        )
+        self.run(characters)
+
+    @abstractmethod
+    def fetch(self, character) -> tuple:
+        """Fetch ``character``'s data, called from the pool.
+
+        Returns:
+            tuple: (data, expires), expires is ESI's Expires or None.
+        """
+
+    @abstractmethod
+    def write(self, fetched: dict) -> set:
+        """Store a batch of fetched data.
+
+        Args:
+            fetched (dict): character_id -> data from ``fetch``.
+
+        Returns:
+            set: character_ids whose stored data changed.
+        """
+
+    def deadlines(self, fetched: dict) -> dict:
+        """character_id -> latest next refresh, for tasks that know when data will change"""
+        return {}
+
+    def run(self, characters: list) -> dict:
+        """Fetch ``characters``, write what was fetched and schedule their next refresh.
+
+        Returns:
+            dict: character_id -> Outcome.
+        """
+        if not characters:
+            return {}
+        app = self.scheduler.app
+        started = time.perf_counter()
+        esi.tokens.prefetch(characters)
+
+        workers = min(app.config.get("CHARACTER_TASK_WORKERS", 8), len(characters))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.JOB_ID) as pool:
+            outcomes = {
+                outcome.character.character_id: outcome
+                for outcome in pool.map(self._fetch_one, characters)
+            }
+
+        fetched = {
+            character_id: outcome.data
+            for character_id, outcome in outcomes.items()
+            if outcome.error is None
+        }
+        changed = self.write(fetched) if fetched else set()
+        record_refresh(
+            app,
+            self.ENDPOINT,
+            {
+                character_id: (character_id in changed, outcomes[character_id].expires)
+                for character_id in fetched
+            },
+            self.deadlines(fetched) if fetched else None,
+        )
+        for outcome in outcomes.values():
+            if outcome.auth:
+                invalidate_sso(app, character_id=outcome.character.character_id)
+        esi.flush_tokens(app)
+
+        self.report(outcomes, changed, time.perf_counter() - started)
+        return outcomes
+
+    def _fetch_one(self, character) -> Outcome:
+        started = time.perf_counter()
+        data = expires = error = None
+        auth = False
+        try:
+            # a token that cannot be refreshed is the character's SSO, not ESI
+            esi.tokens.access_token(character)
+        except Exception as e:
+            error, auth = e, True
+        else:
+            try:
+                data, expires = self.fetch(character)
+            except Exception as e:
+                error = e
+                auth = getattr(e, "status", None) in AUTH_FAILURE_STATUS
+        seconds = time.perf_counter() - started
+
+        # successes only show in ``report``
+        if error is not None:
+            action = "invalidating user" if auth else "retrying next window"
+            print(
+                f"{self.LABEL}: {character.character_name} failed in {seconds:.2f}s, "
+                f"{action}: {error}"
+            )
+        return Outcome(character, data, expires, error, auth, seconds)
+
+    def report(self, outcomes: dict, changed: set, seconds: float) -> None:
+        """One line per run: counts and how the per-character times spread"""
+        timings = sorted(outcomes.values(), key=lambda outcome: outcome.seconds)
+        failed = sum(1 for outcome in timings if outcome.error is not None)
+        slowest = timings[-1]
+        print(
+            f"{self.LABEL}: {len(timings) - failed} fetched, {len(changed)} changed, "
+            f"{failed} failed in {seconds:.2f}s; per character "
+            f"median {timings[len(timings) // 2].seconds:.2f}s, "
+            f"p95 {timings[int(len(timings) * 0.95)].seconds:.2f}s, "
+            f"slowest {slowest.character.character_name} {slowest.seconds:.2f}s"
+        )
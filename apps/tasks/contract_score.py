@@ -0,0 +1,86 @@
+"""How worth fetching the items of a public contract are.
+
+Fetching items is one ESI call per contract and most contracts interest
+nobody, so the contract item queue is ordered by a score from the
+contract alone (0 to ``MAX_SCORE``):
+
+* price        log scale, 10k ISK scores nothing, 100b ISK everything
+* density      ISK per m3, expensive small items over bulk ore and hulls
+* expiry       contracts about to expire before they are gone for good
+* region       contracts in ``CONTRACT_ITEM_REGIONS`` (the trade hubs)
+* watch        a watched type's name in the title
+
+Contracts under ``CONTRACT_ITEM_LAZY_SCORE`` are only fetched when a run
+has budget left after the others.
+"""
+
+import math
+import re
+from datetime import datetime
+
+from apps import db
+from apps.authentication.models import ContractTrack, InvType
+
+WEIGHTS = {"price": 300, "density": 150, "expiry": 150, "region": 100, "watch": 300}
+MAX_SCORE = sum(WEIGHTS.values())
+
+# contracts run up to 30 days, the last two weeks count towards expiry
+EXPIRY_HORIZON_HOURS = 14 * 24
+
+
+def _scale(value: float, low: float, high: float) -> float:
+    """``value`` mapped from low..high to 0..1, clipped"""
+    return min(max((value - low) / (high - low), 0.0), 1.0)
+
+
+class ContractScorer:
+    """Scores contracts against the watch lists and hub regions at one point in time.
+
+    Args:
+        watched_names (iterable): Type names on any ``ContractTrack`` list.
+        regions (iterable): Region ids counting as relevant.
+        now (datetime): Reference time for expiry, utcnow by default.
+    """
+
+    def __init__(self, watched_names, regions, now: datetime = None):
+        names = sorted({name.lower() for name in watched_names if name}, key=len, reverse=True)
+        self.watch = (
+            re.compile(r"\b(?:" + "|".join(map(re.escape, names)) + r")\b", re.IGNORECASE)
+            if names
+            else None
+        )
+        self.regions = set(regions)
+        self.now = now or datetime.utcnow()
+
+    @classmethod
+    def load(cls, app: object) -> "ContractScorer":
+        """Scorer for the current watch lists and CONTRACT_ITEM_REGIONS"""
+        with app.app_context():
+            names = db.session.execute(
+                db.select(InvType.typeName)
+                .join(ContractTrack, ContractTrack.type_id == InvType.typeID)
+                .distinct()
+            ).scalars().all()
+        return cls(names, app.config.get("CONTRACT_ITEM_REGIONS", ()))
+
+    def score(self, contract) -> int:
+        """Score of a contracts row (dict or row mapping)"""
+        value = max(contract.get("price") or 0.0, contract.get("buyout") or 0.0)
+        score = WEIGHTS["price"] * _scale(math.log10(max(value, 1.0)), 4, 11)
+
+        volume = contract.get("volume") or 0.0
+        if value and volume > 0:
+            score += WEIGHTS["density"] * _scale(math.log10(max(value / volume, 1.0)), 3, 9)
+
+        expires = contract.get("date_expired")
+        if expires is not None:
+            hours = (expires - self.now).total_seconds() / 3600
+            score += WEIGHTS["expiry"] * (1 - _scale(hours, 0, EXPIRY_HORIZON_HOURS))
+
+        if contract.get("region_id") in self.regions:
+            score += WEIGHTS["region"]
+
+        title = contract.get("title")
+        if self.watch is not None and title and self.watch.search(title):
+            score += WEIGHTS["watch"]
+        return int(round(score))
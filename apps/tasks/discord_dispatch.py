@@ -0,0 +1,434 @@
+"""Sends the notification outbox to Discord from its own thread.
+
+The tasks used to open a DM channel (``POST /users/@me/channels``) before
+every message and post from the scheduler thread, ignoring rate limits.
+``DiscordDispatcher`` instead:
+
+* drains ``notification_outbox`` in batches, woken as soon as something is
+  queued in this process and polling every DISCORD_DISPATCH_INTERVAL
+  seconds for the rest;
+* sends everything queued for one user as a single digest message, split
+  between notifications at Discord's 2000 characters; each part's
+  notifications are completed as it is sent, so a retry only sends what
+  did not go out;
+* opens each user's DM channel once and keeps it in ``discord_dm_channels``;
+* waits out Discord's per-route buckets (``X-RateLimit-Bucket``,
+  ``-Remaining``, ``-Reset-After``) and the global limit before sending,
+  and retries 429s after ``retry_after``; a user whose bucket is spent is
+  handed back to the outbox until it resets, so one busy user does not hold
+  up the others and their notifications gather into a bigger digest;
+* leaves other failures to the outbox, which retries with a backoff.
+
+Point DISCORD_API_URL at ``esi_tools.discord_standin`` for load tests.
+"""
+
+import re
+import threading
+import time
+from collections import defaultdict
+
+import httpx
+
+from apps import db
+from apps.authentication.models import (
+    CharacterNotifications,
+    DiscordDmChannel,
+    InvType,
+    NotificationOutbox,
+    Users,
+)
+from .bulk import bulk_upsert
+from .outbox import CONTRACT_MATCH, SP_FARM, WELCOME, on_enqueue, outbox_queue
+from .work_queue import DrainMeter
+
+DEFAULT_API_URL = "https://discord.com/api/v10"
+MESSAGE_LIMIT = 2000
+BATCH_SIZE = 500
+# 429s and 5xx retried in place before the job goes back to the outbox
+MAX_RETRIES = 3
+
+# the enabled_notifications entry a character needs for each kind, None: always sent
+FEATURES = {CONTRACT_MATCH: "contract-task", SP_FARM: "sp-farm-notification", WELCOME: None}
+
+# Discord error codes that will not go away by retrying
+CANNOT_MESSAGE_USER = 50007
+UNKNOWN_CHANNEL = 10003
+
+_MAJOR_PARAMETER = re.compile(r"^/(channels|guilds|webhooks)/(\d+)")
+_SNOWFLAKE = re.compile(r"/\d{5,}")
+
+
+class DiscordError(RuntimeError):
+    """Discord answered with an error"""
+
+    def __init__(self, status: int, code: int = None, message: str = ""):
+        super().__init__(f"Discord request failed with {status} ({code}): {message}")
+        self.status = status
+        self.code = code
+
+
+class RateLimits:
+    """Discord's rate limit buckets as learned from its response headers.
+
+    Routes map to buckets through ``X-RateLimit-Bucket``; until a route has
+    been seen it is its own bucket. Only the dispatcher thread uses it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.routes = {}
+        # bucket -> (remaining, reset at)
+        self.buckets = {}
+        self.global_reset = 0.0
+        self.limited = 0
+
+    @staticmethod
+    def route(method: str, path: str) -> str:
+        """Route key: ids are one route except the major parameter (channel, guild)"""
+        major = _MAJOR_PARAMETER.match(path)
+        rest = _SNOWFLAKE.sub("/{id}", path[major.end():] if major else path)
+        return f"{method} {major.group(0) if major else ''}{rest}"
+
+    def delay(self, route: str) -> float:
+        """Seconds to wait before a request on ``route`` may go out"""
+        now = self.clock()
+        wait = max(self.global_reset - now, 0.0)
+        remaining, reset = self.buckets.get(self.routes.get(route, route), (1, 0.0))
+        if remaining <= 0 and reset > now:
+            wait = max(wait, reset - now)
+        return wait
+
+    def update(self, route: str, response) -> float:
+        """Learn from a response, returns the seconds to wait before a retry on 429"""
+        now = self.clock()
+        headers = response.headers
+        bucket = headers.get("x-ratelimit-bucket")
+        if bucket:
+            self.routes[route] = bucket
+        key = self.routes.get(route, route)
+        if "x-ratelimit-remaining" in headers:
+            reset_after = float(headers.get("x-ratelimit-reset-after") or 0)
+            self.buckets[key] = (int(headers["x-ratelimit-remaining"]), now + reset_after)
+
+        if response.status_code != 429:
+            return 0.0
+        self.limited += 1
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        retry_after = float(body.get("retry_after") or headers.get("retry-after") or 1)
+        if body.get("global") or headers.get("x-ratelimit-global"):
+            self.global_reset = now + retry_after
+        else:
+            self.buckets[key] = (0, now + retry_after)
+        return retry_after
+
+
+def split_message(lines: list, limit: int = MESSAGE_LIMIT) -> list:
+    """Join (key, line) pairs into as few messages under ``limit`` characters as possible.
+
+    Returns:
+        list: (keys, content) per message, the keys of the lines it holds.
+    """
+    messages, keys, current = [], [], ""
+    for key, line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append((keys, current))
+            keys, current = [], ""
+        keys.append(key)
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append((keys, current))
+    return messages
+
+
+class DiscordDispatcher:
+    """Delivers the notification outbox, see the module docstring.
+
+    Args:
+        app (object): The Flask app instance.
+        client (httpx.Client): HTTP client, one for DISCORD_API_URL with the
+            bot token by default.
+    """
+
+    def __init__(self, app, client: httpx.Client = None):
+        self.app = app
+        self.queue = outbox_queue(app)
+        self.client = client or httpx.Client(
+            base_url=app.config.get("DISCORD_API_URL") or DEFAULT_API_URL,
+            headers={"Authorization": f"Bot {app.config.get('DISCORD_BOT_TOKEN')}"},
+            timeout=30,
+        )
+        self.interval = app.config.get("DISCORD_DISPATCH_INTERVAL", 5)
+        self.limits = RateLimits()
+        self.channels = {}
+        self.meter = DrainMeter()
+        self.requests = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # running
+
+    def start(self) -> "DiscordDispatcher":
+        """Dispatch from a daemon thread until ``stop``"""
+        on_enqueue(self.wake)
+        self._thread = threading.Thread(target=self.run, name="discord-dispatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+    def wake(self) -> None:
+        """Dispatch now instead of at the next poll"""
+        self._wake.set()
+
+    def run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                sent = self.dispatch()
+                if not sent:
+                    # batches of a dispatcher that died mid-send
+                    self.queue.requeue_expired()
+            except Exception as e:
+                print(f"Discord dispatcher: Error: {str(e)}")
+                sent = 0
+            if not sent:
+                self._wake.wait(self.interval)
+                self._wake.clear()
+
+    def dispatch(self) -> int:
+        """Send one claimed batch of the outbox.
+
+        Returns:
+            int: Notifications finished (sent, dropped or failed), 0 when
+            nothing was due or every recipient had to wait.
+        """
+        keys = self.queue.claim(BATCH_SIZE)
+        if not keys:
+            return 0
+        with self.app.app_context():
+            jobs = db.session.execute(
+                db.select(NotificationOutbox).where(NotificationOutbox.key.in_(keys))
+            ).scalars().all()
+            for job in jobs:
+                db.session.expunge(job)
+
+        recipients = self.get_recipients(jobs)
+        lines = self.render(jobs)
+        digests, dropped = defaultdict(list), []
+        for job in jobs:
+            discord_user_id = recipients.get(job.key)
+            if discord_user_id and job.key in lines:
+                digests[discord_user_id].append(job)
+            else:
+                dropped.append(job.key)
+        self.queue.cancel(dropped)
+
+        finished = len(dropped)
+        for discord_user_id, user_jobs in digests.items():
+            finished += self.deliver(
+                discord_user_id,
+                split_message([(job.key, lines[job.key]) for job in user_jobs]),
+                keys.token,
+            )
+        return finished
+
+    def deliver(self, discord_user_id: str, messages: list, token: str) -> int:
+        """Send a user's digest, completing the jobs of each message once it is sent.
+
+        When a message cannot go out, it and the ones after it are handed
+        back together: released while the user's bucket is spent, failed or
+        cancelled otherwise. The messages already sent are not repeated.
+
+        Args:
+            messages (list): (job keys, content) from ``split_message``.
+            token (str): The claim of the jobs.
+
+        Returns:
+            int: Jobs finished, see ``dispatch``.
+        """
+        finished = 0
+        for index, (job_keys, content) in enumerate(messages):
+            remaining = [key for keys, _ in messages[index:] for key in keys]
+            wait = self.limits.delay(self.next_route(discord_user_id))
+            if wait:
+                self.queue.release(remaining, token, wait)
+                break
+            try:
+                self.send(discord_user_id, content)
+            except DiscordError as e:
+                if e.code == CANNOT_MESSAGE_USER:
+                    # DMs closed or no shared server, retrying will not help
+                    self.queue.cancel(remaining)
+                else:
+                    self._fail(remaining, str(e), token)
+                finished += len(remaining)
+                break
+            except httpx.HTTPError as e:
+                self._fail(remaining, str(e), token)
+                finished += len(remaining)
+                break
+            self.queue.complete(job_keys, token)
+            self.meter.add(done=len(job_keys))
+            finished += len(job_keys)
+        return finished
+
+    def _fail(self, keys: list, error: str, token: str) -> None:
+        for key in keys:
+            self.queue.fail(key, error, token)
+        self.meter.add(failed=len(keys))
+
+    # recipients and messages
+
+    def get_recipients(self, jobs: list) -> dict:
+        """Discord user per job key, for the jobs whose character wants the notification"""
+        recipients = {job.key: job.discord_user_id for job in jobs if job.discord_user_id}
+        looked_up = [job for job in jobs if not job.discord_user_id]
+        if not looked_up:
+            return recipients
+        with self.app.app_context():
+            rows = db.session.execute(
+                db.select(
+                    CharacterNotifications.character_id,
+                    CharacterNotifications.enabled_notifications,
+                    Users.discord_user_id,
+                )
+                .join(Users, Users.character_id == CharacterNotifications.master_character_id)
+                .where(
+                    CharacterNotifications.character_id.in_(
+                        {job.character_id for job in looked_up}
+                    )
+                )
+            ).all()
+        settings = {character_id: (enabled or "", user) for character_id, enabled, user in rows}
+        for job in looked_up:
+            enabled, discord_user_id = settings.get(job.character_id, ("", None))
+            feature = FEATURES.get(job.kind)
+            if discord_user_id and (feature is None or feature in enabled):
+                recipients[job.key] = discord_user_id
+        return recipients
+
+    def render(self, jobs: list) -> dict:
+        """Message line per job key, jobs of unknown kinds are left out"""
+        type_ids = {
+            type_id
+            for job in jobs
+            if job.kind == CONTRACT_MATCH
+            for type_id in job.payload["type_ids"]
+        }
+        names = {}
+        if type_ids:
+            with self.app.app_context():
+                names = dict(
+                    db.session.execute(
+                        db.select(InvType.typeID, InvType.typeName).where(
+                            InvType.typeID.in_(type_ids)
+                        )
+                    ).all()
+                )
+
+        lines = {}
+        for job in jobs:
+            payload = job.payload or {}
+            if job.kind == CONTRACT_MATCH:
+                found = ", ".join(
+                    str(names.get(type_id, type_id)) for type_id in payload["type_ids"]
+                )
+                lines[job.key] = f"Found a {found} (contract {payload['contract_id']})"
+            elif job.kind == SP_FARM:
+                lines[job.key] = (
+                    f"Hello! {payload['character_name']} is ready to harvest with "
+                    f"{payload['total_sp']:,}!"
+                )
+            elif job.kind == WELCOME:
+                lines[job.key] = payload["content"]
+        return lines
+
+    # Discord
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        """One Discord API call within its rate limits, retrying 429 and 5xx in place"""
+        route = self.limits.route(method, path)
+        for attempt in range(MAX_RETRIES + 1):
+            delay = self.limits.delay(route)
+            if delay:
+                time.sleep(delay)
+            response = self.client.request(method, path, **kwargs)
+            self.requests += 1
+            retry_after = self.limits.update(route, response)
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt == MAX_RETRIES:
+                break
+            time.sleep(retry_after if response.status_code == 429 else 2 ** attempt)
+
+        if response.status_code >= 400:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            raise DiscordError(response.status_code, body.get("code"), body.get("message", ""))
+        return response.json() if response.content else {}
+
+    def next_route(self, discord_user_id: str) -> str:
+        """Route of the next request for a user: opening the channel or a message"""
+        channel_id = self.channels.get(discord_user_id)
+        if channel_id:
+            return self.limits.route("POST", f"/channels/{channel_id}/messages")
+        return self.limits.route("POST", "/users/@me/channels")
+
+    def dm_channel(self, discord_user_id: str) -> str:
+        """Id of the DM channel with a user, opened and stored on first use"""
+        channel_id = self.channels.get(discord_user_id)
+        if channel_id:
+            return channel_id
+        with self.app.app_context():
+            channel_id = db.session.execute(
+                db.select(DiscordDmChannel.channel_id).where(
+                    DiscordDmChannel.discord_user_id == discord_user_id
+                )
+            ).scalar()
+        if not channel_id:
+            channel_id = self.request(
+                "POST", "/users/@me/channels", json={"recipient_id": discord_user_id}
+            )["id"]
+            bulk_upsert(
+                self.app,
+                DiscordDmChannel,
+                [{"discord_user_id": discord_user_id, "channel_id": channel_id}],
+            )
+        self.channels[discord_user_id] = channel_id
+        return channel_id
+
+    def forget_channel(self, discord_user_id: str) -> None:
+        self.channels.pop(discord_user_id, None)
+        with self.app.app_context():
+            db.session.execute(
+                db.delete(DiscordDmChannel).where(DiscordDmChannel.discord_user_id == discord_user_id)
+            )
+            db.session.commit()
+
+    def send(self, discord_user_id: str, content: str) -> None:
+        """Send one message to a user in their DM channel"""
+        channel_id = self.dm_channel(discord_user_id)
+        try:
+            self.request("POST", f"/channels/{channel_id}/messages", json={"content": content})
+        except DiscordError as e:
+            if e.code == UNKNOWN_CHANNEL:
+                # reopened on the retry
+                self.forget_channel(discord_user_id)
+            raise
+
+
+def start_dispatcher(app: object):
+    """Start the dispatcher thread if a bot token is configured, returns it or None"""
+    if not app.config.get("DISCORD_BOT_TOKEN"):
+        print("No DISCORD_BOT_TOKEN, notifications stay in the outbox")
+        return None
+    return DiscordDispatcher(app).start()
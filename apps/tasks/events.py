@@ -0,0 +1,36 @@
+"""In-process events between tasks.
+
+A task that writes data others react to emits an event once its writes
+are committed; interested tasks subscribe when they are loaded instead of
+polling the tables. Handlers run in the emitting thread, one failing
+handler does not stop the others or the emitting task.
+"""
+
+from collections import defaultdict, namedtuple
+
+# payload: list of SpChange, the characters whose total SP changed in a skill sync
+SP_CHANGED = "sp-changed"
+# payload: list of SpChange, every character a skill sync wrote, changed or not;
+# for handlers that must not miss a state when a previous run failed
+SKILLS_SYNCED = "skills-synced"
+
+SpChange = namedtuple("SpChange", ["character_id", "old_sp", "new_sp"])
+
+_handlers = defaultdict(list)
+
+
+def subscribe(event: str, handler) -> None:
+    """Call ``handler(payload)`` whenever ``event`` is emitted"""
+    _handlers[event].append(handler)
+
+
+def emit(event: str, payload) -> int:
+    """Run the handlers of ``event``, returns how many succeeded"""
+    succeeded = 0
+    for handler in _handlers[event]:
+        try:
+            handler(payload)
+            succeeded += 1
+        except Exception as e:
+            print(f"Handler {getattr(handler, '__qualname__', handler)} of {event}: Error: {str(e)}")
+    return succeeded
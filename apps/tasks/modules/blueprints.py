@@ -1,70 +1,106 @@
 """Blueprint Tasks"""
 
-from datetime import datetime
-from apps.authentication.models import Characters, Blueprints
+from apps.authentication.models import Blueprints
 from apps import esi, db
-from ..common import invalidate_sso
+from ..bulk import bulk_upsert
+from ..character_task import CharacterTask
+from ..sync_state import load_hashes, payload_hash, save_hashes
 
+ESI_ENDPOINT = "get_characters_character_id_blueprints"
 
-class BlueprintTasks:
+# compared against the stored rows to find changed blueprints
+COLUMNS = (
+    "location_flag",
+    "location_id",
+    "material_efficiency",
+    "quantity",
+    "runs",
+    "time_efficiency",
+    "type_id",
+)
+
+DELETE_CHUNK_SIZE = 500
+
+
+class BlueprintTasks(CharacterTask):
     """Tasks related to Blueprints"""
 
-    def __init__(self, scheduler):
-        self.scheduler = scheduler
-        self.schedule_tasks()
-
-    def schedule_tasks(self) -> None:
-        """Setup task execution schedule"""
-        self.scheduler.add_job(
-            func=self.main,
-            trigger="interval",
-            seconds=3600,
-            id="blueprint_main",
-            name="blueprint_main",
-            replace_existing=False,
-            max_instances=1
+    ENDPOINT = ESI_ENDPOINT
+    JOB_ID = "blueprint_main"
+    LABEL = "Blueprint"
+
+    def fetch(self, character) -> tuple:
+        return esi.get_esi_all_expires(
+            character, ESI_ENDPOINT, character_id=character.character_id
         )
 
-    def get_all_users(self) -> list:
-        """Gets all characters"""
-        with self.scheduler.app.app_context():
-            character_list = Characters.query.filter_by(sso_is_valid=True).all()
+    def write(self, fetched: dict) -> set:
+        """Apply the blueprints of the characters whose payload hash changed"""
+        app = self.scheduler.app
+        stored_hashes = load_hashes(app, ESI_ENDPOINT, list(fetched))
 
-        return character_list
+        changed = {}
+        new_hashes = {}
+        for character_id, blueprint_data in fetched.items():
+            digest = payload_hash(blueprint_data, sort_key="item_id")
+            if stored_hashes.get(character_id) == digest:
+                continue
+            changed[character_id] = {
+                ld["item_id"]: (character_id,) + tuple(ld[name] for name in COLUMNS)
+                for ld in blueprint_data
+            }
+            new_hashes[character_id] = digest
 
-    def main(self):
-        print(f"Running Blueprint Main: {datetime.now()}")
+        self.apply_diff(changed)
+        save_hashes(app, ESI_ENDPOINT, new_hashes)
+        return set(changed)
 
-        characters = self.get_all_users()
+    def apply_diff(self, fetched: dict) -> None:
+        """Bring the Blueprints rows of the fetched characters in line with ESI.
 
-        for character in characters:
-            print(f"Checking: {character.character_name}", end="")
+        Args:
+            fetched (dict): character_id -> {item_id: row tuple} for every
+                character whose payload changed.
+        """
+        if not fetched:
+            return
+        app = self.scheduler.app
+        table = Blueprints.__table__
 
-            try:
-                # Get Data
-                esi_params = {"character_id": character.character_id}
-                blueprint_data = esi.get_esi(
-                    character, "get_characters_character_id_blueprints", **esi_params
-                )
-            except RuntimeError as e:
-                print(f"Failed to get ESI data, invalidating user: {e}")
-                invalidate_sso(self.scheduler.app, character_id=character.character_id)
-
-            # Save Data
-            for ld in blueprint_data.data:
-                blueprint_row = Blueprints(
-                    character_id=character.character_id,
-                    location_flag=ld["location_flag"],
-                    location_id=ld["location_id"],
-                    material_efficiency=ld["material_efficiency"],
-                    quantity=ld["quantity"],
-                    runs=ld["runs"],
-                    time_efficiency=ld["time_efficiency"],
-                    type_id=ld["type_id"],
+        with app.app_context():
+            stored = {
+                row[0]: tuple(row[1:])
+                for row in db.session.execute(
+                    db.select(
+                        table.c.item_id,
+                        table.c.character_id,
+                        *(table.c[name] for name in COLUMNS),
+                    ).where(table.c.character_id.in_(list(fetched)))
                 )
+            }
+
+        current = {}
+        for items in fetched.values():
+            current.update(items)
 
-                with self.scheduler.app.app_context():
-                    db.session.merge(blueprint_row)
-                    db.session.commit()
+        changed = [
+            dict(zip(("item_id", "character_id") + COLUMNS, (item_id,) + row))
+            for item_id, row in current.items()
+            if stored.get(item_id) != row
+        ]
+        # blueprints moved between two synced characters are in ``current``
+        vanished = [item_id for item_id in stored if item_id not in current]
 
-            print("...done")
+        bulk_upsert(app, Blueprints, changed, label="Blueprints")
+        with app.app_context():
+            for start in range(0, len(vanished), DELETE_CHUNK_SIZE):
+                db.session.execute(
+                    table.delete().where(
+                        table.c.item_id.in_(vanished[start:start + DELETE_CHUNK_SIZE])
+                    )
+                )
+            db.session.commit()
+        print(
+            f"Blueprints: {len(fetched)} characters changed, "
+            f"{len(changed)} upserted, {len(vanished)} deleted"
+        )
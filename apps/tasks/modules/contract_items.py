@@ -1,15 +1,57 @@
-"""Contract Tasks"""
-
+"""Contract Item Tasks"""
+import threading
 from datetime import datetime
-from apps.authentication.models import Characters, Contract, ContractItem
+from apps.authentication.models import Characters, Contract, ContractItem, ContractItemJob
 from apps import esi, db
-from sqlalchemy.orm import aliased
-from sqlalchemy.sql import func
+from esi_tools.async_client import EsiError
+from ..bulk import bulk_upsert
+from ..contract_score import ContractScorer
+from ..watch_index import WATCHES, record_matches
+from ..work_queue import PENDING, Budget, DrainMeter, WorkQueue
+
+ESI_ENDPOINT = "get_contracts_public_items_contract_id"
+
+# only these contract types have items
+ITEM_CONTRACT_TYPES = ("item_exchange", "auction")
+
+# finished, expired or no longer public contracts: nothing left to fetch
+GONE_STATUS = (403, 404)
+
+# seconds a worker may hold a batch before it is handed to another
+CLAIM_LEASE = 600
+
+# what the scorer reads of a contract
+SCORE_COLUMNS = (
+    Contract.id,
+    Contract.region_id,
+    Contract.price,
+    Contract.buyout,
+    Contract.volume,
+    Contract.date_expired,
+    Contract.title,
+)
+
+
+def contract_item_queue(app: object) -> WorkQueue:
+    """The queue of contracts whose items still have to be fetched"""
+    return WorkQueue(app, ContractItemJob, lease=CLAIM_LEASE)
+
+
+def item_job(contract: dict, scorer: ContractScorer) -> dict:
+    """contract_item_jobs row for a contracts row, see ``ContractTasks.contract_row``"""
+    return {
+        "contract_id": contract["id"],
+        "region_id": contract.get("region_id"),
+        "priority": scorer.score(contract),
+    }
 
 
 class ContractItemTasks:
     """Tasks related to Contract Items"""
 
+    # enqueue_missing runs once per process, the sweep queues everything after
+    backfilled = False
+
     def __init__(self, scheduler):
         self.scheduler = scheduler
         self.schedule_tasks()
@@ -18,8 +60,8 @@ class ContractItemTasks:
         """Setup task execution schedule"""
         self.scheduler.add_job(
             func=self.main,
-            # trigger="interval",
-            # seconds=310,
+            trigger="interval",
+            seconds=310,
             id="contract_item_main",
             name="contract_item_main",
             replace_existing=False,
@@ -32,75 +74,172 @@ class ContractItemTasks:
             character_list = Characters.query.filter_by(sso_is_valid=True).all()
         return character_list
 
-    def get_contracts_without_items(self) -> list:
-        """Get contracts without items, we need to get the items"""
-        with self.scheduler.app.app_context():
-            contracts_without_items = Contract.query.filter(
-                Contract.parsed.is_(None)
-            ).all()
-            # .limit(50) \
-
-        return contracts_without_items
+    def enqueue_missing(self, queue: WorkQueue, scorer: ContractScorer) -> int:
+        """Queue open item contracts that have neither a job nor items.
 
-    def update_contract_parsed(self, contract_id: int, parsed_value: bool) -> None:
-        """Update the 'parsed' column for a specific contract"""
+        The sweep queues new contracts as it stores them; this picks up the
+        ones stored before the queue existed, so ``main`` only runs it on the
+        first pass of the process.
+        """
         with self.scheduler.app.app_context():
-            contract = Contract.query.filter_by(id=contract_id).first()
-            if contract:
-                contract.parsed = parsed_value
-                db.session.commit()
-
-    def main(self):
-        print(f"Running Contract Items Main: {datetime.now()}")
-
-        characters = self.get_all_users()
-
-        for character in characters:
-            print(f"Checking items for: {character.character_name}", end="")
-
-            contracts = self.get_contracts_without_items()
-            print(f"ContractCount: {len(contracts)}")
-            for contract in contracts:
-                # Skip check
-                if contract.type not in ["item_exchange", "auction"]:
-                    continue
-                print(f"Checking: {contract.id}")
+            missing = db.session.execute(
+                db.select(*SCORE_COLUMNS).where(
+                    Contract.type.in_(ITEM_CONTRACT_TYPES),
+                    Contract.gone_at.is_(None),
+                    ~db.select(ContractItemJob.contract_id)
+                    .where(ContractItemJob.contract_id == Contract.id)
+                    .exists(),
+                    ~db.select(ContractItem.id)
+                    .where(ContractItem.contract_id == Contract.id)
+                    .exists(),
+                )
+            ).mappings().all()
+        return queue.enqueue([item_job(contract, scorer) for contract in missing])
+
+    def rescore(self, queue: WorkQueue, scorer: ContractScorer) -> int:
+        """Update the priority of pending jobs whose score moved.
+
+        Expiry gets closer and watch lists change between runs, so scores
+        from enqueue time go stale. Returns how many jobs changed.
+        """
+        with self.scheduler.app.app_context():
+            pending = db.session.execute(
+                db.select(ContractItemJob.priority, *SCORE_COLUMNS)
+                .join(Contract, Contract.id == ContractItemJob.contract_id)
+                .where(ContractItemJob.state == PENDING)
+            ).mappings().all()
+        changed = {}
+        for contract in pending:
+            priority = scorer.score(contract)
+            if priority != contract["priority"]:
+                changed[contract["id"]] = priority
+        return queue.reprioritize(changed)
+
+    def fetch_items(self, contract_ids: list) -> tuple:
+        """Items of the claimed contracts.
+
+        Returns:
+            tuple: (item rows, contract ids done, {contract id: error} to retry)
+        """
+        responses = esi.get_esi_many(
+            None, ESI_ENDPOINT, [{"contract_id": contract_id} for contract_id in contract_ids]
+        )
 
-                # Get Data
-                esi_params = {"contract_id": contract.id}
+        item_rows, done, errors = [], [], {}
+        for contract_id, response in zip(contract_ids, responses):
+            if isinstance(response, BaseException):
+                if isinstance(response, EsiError) and response.status in GONE_STATUS:
+                    done.append(contract_id)
+                else:
+                    errors[contract_id] = str(response)
+                continue
+
+            items = response.data or []
+            if int(response.headers.get("x-pages") or 1) > 1:
                 try:
-                    esi_data = esi.get_esi(
-                        character,
-                        "get_contracts_public_items_contract_id",
-                        **esi_params,
-                    )
+                    items = esi.get_esi_all(None, ESI_ENDPOINT, contract_id=contract_id)
                 except Exception as error:
-                    self.update_contract_parsed(contract.id, True)
+                    errors[contract_id] = str(error)
                     continue
 
-                if hasattr(esi_data.data, "error") or not esi_data.data:
-                    self.update_contract_parsed(contract.id, True)
-                    continue
+            for ld in items:
+                item_rows.append(
+                    {
+                        "contract_id": contract_id,
+                        "record_id": ld.get("record_id", None),
+                        "is_blueprint_copy": ld.get("is_blueprint_copy", None),
+                        "is_included": ld.get("is_included", None),
+                        "item_id": ld.get("item_id", None),
+                        "material_efficiency": ld.get("material_efficiency", None),
+                        "quantity": ld.get("quantity", None),
+                        "runs": ld.get("runs", None),
+                        "time_efficiency": ld.get("time_efficiency", None),
+                        "type_id": ld.get("type_id", None),
+                    }
+                )
+            done.append(contract_id)
+        return item_rows, done, errors
+
+    def work(self, queue: WorkQueue, meter: DrainMeter, batch_size: int, budget: Budget,
+             min_priority: int = None) -> None:
+        """Claim, fetch and store batches until nothing is due or the budget is spent"""
+        app, name = self.scheduler.app, threading.current_thread().name
+        while True:
+            granted = budget.take(batch_size)
+            if not granted:
+                return
+            contract_ids = queue.claim(granted, min_priority=min_priority)
+            budget.give_back(granted - len(contract_ids))
+            if not contract_ids:
+                return
+            try:
+                item_rows, done, errors = self.fetch_items(contract_ids)
+                # items before the jobs: a crash in between only refetches them
+                bulk_upsert(app, ContractItem, item_rows, keys=["record_id"])
+                WATCHES.refresh(app)
+                record_matches(app, WATCHES.match(item_rows))
+                queue.complete(done, contract_ids.token)
+            except Exception as e:
+                print(f"  {name}: Error: {str(e)}")
+                done, errors = [], {contract_id: str(e) for contract_id in contract_ids}
+            for contract_id, error in errors.items():
+                queue.fail(contract_id, error, contract_ids.token)
+            meter.add(done=len(done), failed=len(errors))
+
+    def drain(self, queue: WorkQueue, budget: Budget, min_priority: int = None) -> DrainMeter:
+        """Run the workers until the due jobs at or above ``min_priority`` are done"""
+        app = self.scheduler.app
+        workers = app.config.get("CONTRACT_ITEM_WORKERS", 4)
+        batch_size = app.config.get("CONTRACT_ITEM_BATCH_SIZE", 100)
+        meter = DrainMeter()
+        threads = [
+            threading.Thread(
+                target=self.work,
+                args=(queue, meter, batch_size, budget, min_priority),
+                name=f"contract_items_{index}",
+            )
+            for index in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return meter
 
-                # Save Data
-                for ld in esi_data.data:
-                    contract_item_row = ContractItem(
-                        contract_id=contract.id,
-                        record_id=ld.get("record_id", None),
-                        is_blueprint_copy=ld.get("is_blueprint_copy", None),
-                        is_included=ld.get("is_included", None),
-                        item_id=ld.get("item_id", None),
-                        material_efficiency=ld.get("material_efficiency", None),
-                        quantity=ld.get("quantity", None),
-                        runs=ld.get("runs", None),
-                        time_efficiency=ld.get("time_efficiency", None),
-                        type_id=ld.get("type_id", None),
-                    )
-
-                    with self.scheduler.app.app_context():
-                        db.session.merge(contract_item_row)
-                        db.session.commit()
-
-                    self.update_contract_parsed(contract.id, True)
-
-            print("...Done")
+    def main(self):
+        """
+        Contract Items Main
+        """
+        print(f"Running Contract Items Main: {datetime.now()}")
+        app = self.scheduler.app
+        queue = contract_item_queue(app)
+        scorer = ContractScorer.load(app)
+        budget = Budget(app.config.get("CONTRACT_ITEM_BUDGET", 2000))
+        lazy_score = app.config.get("CONTRACT_ITEM_LAZY_SCORE", 300)
+
+        # claims left behind by a stopped run go back to the queue
+        requeued = queue.requeue_expired()
+        queued = 0
+        if not self.backfilled:
+            queued = self.enqueue_missing(queue, scorer)
+            self.backfilled = True
+        rescored = self.rescore(queue, scorer)
+        depth = queue.depth(min_priority=lazy_score)
+        print(
+            f"Contract item queue: {depth['due']} due ({depth['due_priority']} scored "
+            f"{lazy_score}+), {depth['pending']} pending, {depth['claimed']} claimed, "
+            f"{requeued} requeued, {queued} backfilled, {rescored} rescored"
+        )
+
+        meter = self.drain(queue, budget, min_priority=lazy_score)
+        print(f"Contract items, scored {lazy_score}+: {meter}")
+        if budget.remaining and not queue.depth(min_priority=lazy_score)["due_priority"]:
+            # idle: spend what is left of the budget on the low scores
+            meter = self.drain(queue, budget)
+            print(f"Contract items, idle: {meter}")
+
+        depth = queue.depth()
+        print(
+            f"Contract item queue: {depth['due']} due, {depth['pending']} pending, "
+            f"{depth['failed']} failed, {budget.remaining} of the budget unused"
+        )
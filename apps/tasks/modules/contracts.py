@@ -1,15 +1,31 @@
 """Contract Tasks"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from apps.authentication.models import Characters, Contract, MapRegion
+from apps.authentication.models import Characters, Contract, ContractRegionSnapshot, MapRegion
 from apps import esi, db
+from esi_tools.raw import parse_datetime
+from ..bulk import bulk_upsert, write_lock
+from ..contract_score import ContractScorer
+from .contract_items import ITEM_CONTRACT_TYPES, contract_item_queue, item_job
+
+ESI_ENDPOINT = "get_contracts_public_region_id"
+
+# ids per UPDATE when marking contracts gone
+GONE_CHUNK_SIZE = 500
+
 
 class ContractTasks:
     """Tasks related to Contracts"""
-    
+
     def __init__(self, scheduler):
         self.scheduler = scheduler
+        # region_id -> ids of the contracts in its last snapshot
+        self.known = {}
+        # scores new item contracts for the item queue, loaded each run
+        self.scorer = None
         self.schedule_tasks()
-    
+
     def schedule_tasks(self) -> None:
         """Setup task execution schedule"""
         self.scheduler.add_job(
@@ -21,84 +37,191 @@ class ContractTasks:
             replace_existing=False,
             max_instances=1
         )
-    
+
     def get_all_users(self) -> list:
         """Gets all characters"""
         with self.scheduler.app.app_context():
             character_list = Characters.query.filter_by(sso_is_valid=True).all()
         return character_list
-    
+
     def get_all_regions(self) -> list:
         """Gets all regions from the database"""
         with self.scheduler.app.app_context():
             regions = MapRegion.query.all()
         return regions
 
+    def get_known_ids(self, region_id: int) -> set:
+        """Ids of the region's contracts not marked gone, from memory after the first sweep"""
+        if region_id not in self.known:
+            with self.scheduler.app.app_context():
+                self.known[region_id] = set(
+                    db.session.execute(
+                        db.select(Contract.id).where(
+                            Contract.region_id == region_id, Contract.gone_at.is_(None)
+                        )
+                    ).scalars()
+                )
+        return self.known[region_id]
+
+    def get_prioritized_regions(self) -> list:
+        """Regions by contracts in their last snapshot, largest (and never swept) first.
+
+        The largest regions take longest, starting them first keeps them from
+        being the tail of a parallel sweep.
+        """
+        regions = self.get_all_regions()
+        with self.scheduler.app.app_context():
+            sizes = dict(
+                db.session.execute(
+                    db.select(ContractRegionSnapshot.region_id, ContractRegionSnapshot.contracts)
+                ).all()
+            )
+        return sorted(regions, key=lambda region: -sizes.get(region.regionID, float("inf")))
+
+    def contract_row(self, ld: dict, region_id: int, now: datetime) -> dict:
+        """contracts row of an ESI public contract"""
+        return {
+            "id": ld["contract_id"],
+            "buyout": ld.get("buyout", None),
+            "collateral": ld.get("collateral", None),
+            "date_expired": ld["date_expired"],
+            "date_issued": ld["date_issued"],
+            "days_to_complete": ld.get("days_to_complete", None),
+            "end_location_id": ld.get("end_location_id", None),
+            "for_corporation": ld.get("for_corporation", False),
+            "issuer_corporation_id": ld.get("issuer_corporation_id", None),
+            "issuer_id": ld.get("issuer_id", None),
+            "price": ld.get("price", None),
+            "reward": ld.get("reward", None),
+            "start_location_id": ld.get("start_location_id", None),
+            "title": ld.get("title", None),
+            "type": ld.get("type", None),
+            "volume": ld.get("volume", None),
+            "region_id": region_id,
+            "first_seen": now,
+            "gone_at": None,
+        }
+
+    def sweep_region(self, region) -> dict:
+        """Store the contracts of ``region`` that are new since its last snapshot.
+
+        Public contracts cannot be edited, so only unseen ids are written.
+        Known ids missing from the snapshot get ``gone_at`` set. New item
+        contracts are queued for their items, gone ones are dropped from the
+        queue.
+
+        Returns:
+            dict: contracts, new, gone, snapshot, seconds of the sweep and
+            db_seconds spent writing.
+        """
+        app = self.scheduler.app
+        started = time.perf_counter()
+        known = self.get_known_ids(region.regionID)
+        queue = contract_item_queue(app)
+        now = datetime.utcnow()
+
+        pages = esi.get_esi_pages(
+            None,
+            ESI_ENDPOINT,
+            converters={
+                "date_expired": parse_datetime,
+                "date_issued": parse_datetime,
+            },
+            region_id=region.regionID,
+        )
+
+        seen, attempt, snapshot, new, db_seconds = set(), 0, None, 0, 0.0
+        for page in pages:
+            if page.attempt != attempt:
+                # ESI moved to a new snapshot mid-walk and the pages start over
+                seen, attempt = set(), page.attempt
+            snapshot = page.snapshot
+            unseen = [ld for ld in page.data if ld["contract_id"] not in known]
+            seen.update(ld["contract_id"] for ld in page.data)
+            if unseen:
+                written = time.perf_counter()
+                rows = [self.contract_row(ld, region.regionID, now) for ld in unseen]
+                # upsert, not insert: contracts stored before regions were
+                # tracked (or by another worker) get their region set
+                bulk_upsert(app, Contract, rows, update=["region_id", "gone_at"])
+                queue.enqueue(
+                    [item_job(row, self.scorer) for row in rows if row["type"] in ITEM_CONTRACT_TYPES]
+                )
+                known.update(ld["contract_id"] for ld in unseen)
+                new += len(unseen)
+                db_seconds += time.perf_counter() - written
+
+        gone = list(known - seen)
+        written = time.perf_counter()
+        with app.app_context(), write_lock(db.engine.dialect.name):
+            for start in range(0, len(gone), GONE_CHUNK_SIZE):
+                db.session.execute(
+                    db.update(Contract)
+                    .where(Contract.id.in_(gone[start:start + GONE_CHUNK_SIZE]))
+                    .values(gone_at=now)
+                )
+            db.session.commit()
+        queue.cancel(gone)
+        self.known[region.regionID] = seen
+
+        result = {
+            "contracts": len(seen),
+            "new": new,
+            "gone": len(gone),
+            "snapshot": snapshot,
+        }
+        bulk_upsert(
+            app,
+            ContractRegionSnapshot,
+            [
+                {
+                    "region_id": region.regionID,
+                    "snapshot": snapshot,
+                    "swept_at": now,
+                    "contracts": result["contracts"],
+                    "new": result["new"],
+                    "gone": result["gone"],
+                }
+            ],
+        )
+        result["db_seconds"] = db_seconds + time.perf_counter() - written
+        result["seconds"] = time.perf_counter() - started
+        return result
+
     def main(self):
         """
         Contracts Main
         """
         print(f"Running Contracts Main: {datetime.now()}")
-        characters = self.get_all_users()
-        regions = self.get_all_regions()
-        
-        if not characters:
-            print("No valid characters found for API access")
-            return
-        
-        # Use first available character for all regions
-        # (assuming public contract data doesn't require specific character permissions)
-        character = characters[0]
-        
-        for region in regions:
-            print(f"\nProcessing Region: {region.regionName} (ID: {region.regionID})")
-            
-            try:
-                # Get Data for specific region
-                esi_params = {"region_id": region.regionID}
-                contract_data = esi.get_esi(
-                    character, "get_contracts_public_region_id", **esi_params
+        started = time.perf_counter()
+        # public contracts need no token
+        regions = self.get_prioritized_regions()
+        self.scorer = ContractScorer.load(self.scheduler.app)
+        workers = self.scheduler.app.config.get("CONTRACT_SWEEP_WORKERS", 8)
+
+        timings = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="contracts") as pool:
+            futures = {pool.submit(self.sweep_region, region): region for region in regions}
+            for future in as_completed(futures):
+                region = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"  {region.regionName} ({region.regionID}): Error: {str(e)}")
+                    # Continue with the other regions, reload this one's ids next time
+                    self.known.pop(region.regionID, None)
+                    continue
+                timings.append((result["seconds"], region.regionName, result))
+                print(
+                    f"  {region.regionName} ({region.regionID}): {result['contracts']} contracts, "
+                    f"{result['new']} new, {result['gone']} gone in {result['seconds']:.2f}s "
+                    f"(db {result['db_seconds']:.2f}s)"
                 )
-                
-                # Check if we got valid data
-                if contract_data and hasattr(contract_data, 'data') and contract_data.data:
-                    contracts_saved = 0
-                    
-                    # Save Data
-                    for ld in contract_data.data:
-                        contract_row = Contract(
-                            id=ld["contract_id"],
-                            buyout=ld.get("buyout", None),
-                            collateral=ld.get("collateral", None),
-                            date_expired=ld["date_expired"],
-                            date_issued=ld["date_issued"],
-                            days_to_complete=ld.get("days_to_complete", None),
-                            end_location_id=ld.get("end_location_id", None),
-                            for_corporation=ld.get("for_corporation", False),
-                            issuer_corporation_id=ld.get("issuer_corporation_id", None),
-                            issuer_id=ld.get("issuer_id", None),
-                            price=ld.get("price", None),
-                            reward=ld.get("reward", None),
-                            start_location_id=ld.get("start_location_id", None),
-                            title=ld.get("title", None),
-                            type=ld.get("type", None),
-                            volume=ld.get("volume", None),
-                        )
-                        with self.scheduler.app.app_context():
-                            db.session.merge(contract_row)
-                            contracts_saved += 1
-                    
-                    # Commit after processing all contracts for this region
-                    with self.scheduler.app.app_context():
-                        db.session.commit()
-                    
-                    print(f"  Saved {contracts_saved} contracts")
-                else:
-                    print("  No contracts found")
-                    
-            except Exception as e:
-                print(f"  Error: {str(e)}")
-                # Continue with next region even if one fails
-                continue
-        
-        print(f"\nCompleted all regions at: {datetime.now()}")
\ No newline at end of file
+
+        elapsed = time.perf_counter() - started
+        print(
+            f"\nCompleted {len(timings)}/{len(regions)} regions with {workers} workers in "
+            f"{elapsed:.1f}s ({sum(seconds for seconds, _, _ in timings):.1f}s of region time)"
+        )
+        for seconds, name, result in sorted(timings, key=lambda timing: -timing[0])[:5]:
+            print(f"  slowest: {name} {seconds:.2f}s ({result['contracts']} contracts)")
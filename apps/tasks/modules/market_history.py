@@ -1,8 +1,23 @@
 """Market History Tasks"""
 
-from datetime import timedelta
-from apps.authentication.models import MarketHistory, MapRegion, MiningLedger
+import time
+from datetime import datetime, timedelta
+from apps.authentication.models import (
+    MarketHistory,
+    MarketHistoryIndex,
+    MapRegion,
+    MiningLedger,
+)
 from apps import esi, db
+from apps.market import series, stats
+from esi_tools.async_client import EsiError
+from esi_tools.raw import parse_date
+from ..bulk import bulk_insert, bulk_upsert
+
+ESI_ENDPOINT = "get_markets_region_id_history"
+
+# ESI answers these for types that are not traded in a region, retrying is pointless
+NO_HISTORY_STATUS = (400, 404)
 
 
 class MarketHistoryTasks:
@@ -35,55 +50,148 @@ class MarketHistoryTasks:
         """Get unique Type Ids from Mining Ledger"""
         with self.scheduler.app.app_context():
             unique_type_ids = db.session.query(db.distinct(MiningLedger.type_id)).all()
-        return unique_type_ids
-
-    def main(self):
-        print("Running Market History Main")
-
-        from datetime import datetime
-
-        print(f"now = {datetime.now()}")
-
-        item_ids = self.get_unique_type_ids()
-
-        for item_id in item_ids:
-            item_id = item_id[0]
-
-            print(f"Checking item_id, {item_id}")
-            # Check if we have a record and if its expired
-            with self.scheduler.app.app_context():
-                type_id_history = (
-                    db.session.query(MarketHistory)
-                    .filter(MarketHistory.typeID == item_id)
-                    .first()
+        return [type_id for (type_id,) in unique_type_ids if type_id is not None]
+
+    def get_type_ids(self) -> list:
+        """MARKET_HISTORY_TYPES, or the mined types when none are configured"""
+        configured = self.scheduler.app.config.get("MARKET_HISTORY_TYPES")
+        return list(configured or self.get_unique_type_ids())
+
+    def get_stale_pairs(self, region_ids: list, type_ids: list) -> list:
+        """(region_id, type_id, last_date) of every pair due for a fetch.
+
+        A pair is due when it was never checked or its last check is older
+        than MARKET_HISTORY_MAX_AGE_HOURS. Pairs missing from the index take
+        their last_date from market_history, so history stored before the
+        index existed is not fetched twice.
+        """
+        app = self.scheduler.app
+        max_age = timedelta(hours=app.config.get("MARKET_HISTORY_MAX_AGE_HOURS", 24))
+        threshold = datetime.now() - max_age
+
+        with app.app_context():
+            indexed = {
+                (region_id, type_id): (last_date, checked_at)
+                for region_id, type_id, last_date, checked_at in db.session.execute(
+                    db.select(
+                        MarketHistoryIndex.region_id,
+                        MarketHistoryIndex.type_id,
+                        MarketHistoryIndex.last_date,
+                        MarketHistoryIndex.checked_at,
+                    ).where(MarketHistoryIndex.region_id.in_(region_ids))
                 )
+            }
+
+            stored = {}
+            if len(indexed) < len(region_ids) * len(type_ids):
+                stored = {
+                    (region_id, type_id): last_date
+                    for region_id, type_id, last_date in db.session.execute(
+                        db.select(
+                            MarketHistory.regionID,
+                            MarketHistory.typeID,
+                            db.func.max(MarketHistory.date),
+                        )
+                        .where(MarketHistory.regionID.in_(region_ids))
+                        .group_by(MarketHistory.regionID, MarketHistory.typeID)
+                    )
+                }
+
+        pairs = []
+        for region_id in region_ids:
+            for type_id in type_ids:
+                key = (region_id, type_id)
+                if key in indexed:
+                    last_date, checked_at = indexed[key]
+                    if checked_at > threshold:
+                        continue
+                else:
+                    last_date = stored.get(key)
+                pairs.append((region_id, type_id, last_date))
+        return pairs
+
+    def fetch_batch(self, pairs: list) -> tuple:
+        """Fetch the history of ``pairs`` concurrently.
+
+        Args:
+            pairs (list): (region_id, type_id, last_date) tuples.
+
+        Returns:
+            tuple: (history rows newer than each pair's last_date, index rows,
+            number of failed requests).
+        """
+        responses = esi.get_esi_many(
+            None,
+            ESI_ENDPOINT,
+            [{"region_id": region_id, "type_id": type_id} for region_id, type_id, _ in pairs],
+            converters={"date": parse_date},
+        )
 
-            if type_id_history is not None:
-                # Check if the record exists and compare the updated_date, skip if less than 24hrs old
-                if type_id_history.updated_date > (datetime.now() - timedelta(days=1)):
+        now = datetime.now()
+        history_rows, index_rows, failed = [], [], 0
+        for (region_id, type_id, last_date), response in zip(pairs, responses):
+            if isinstance(response, BaseException):
+                if not (isinstance(response, EsiError) and response.status in NO_HISTORY_STATUS):
+                    # left stale, the next run tries again
+                    failed += 1
                     continue
+                days = []
+            else:
+                days = response.data or []
 
-            # Get Data
-            esi_params = {"region_id": 10000002, "type_id": item_id}
+            newest = last_date
+            for day in days:
+                if last_date is not None and day["date"] <= last_date:
+                    continue
+                history_rows.append(
+                    {
+                        "typeID": type_id,
+                        "regionID": region_id,
+                        "average": day["average"],
+                        "date": day["date"],
+                        "highest": day["highest"],
+                        "lowest": day["lowest"],
+                        "order_count": day["order_count"],
+                        "volume": day["volume"],
+                        "updated_date": now,
+                    }
+                )
+                if newest is None or day["date"] > newest:
+                    newest = day["date"]
 
-            market_history_data_query = esi.get_esi(
-                character=None, schema="get_markets_region_id_history", **esi_params
+            index_rows.append(
+                {"region_id": region_id, "type_id": type_id, "last_date": newest, "checked_at": now}
             )
+        return history_rows, index_rows, failed
 
-            market_history_datas = market_history_data_query.data
-
-            for market_history_data in market_history_datas:
-                with self.scheduler.app.app_context():
-                    market_history = MarketHistory(
-                        typeID=item_id,
-                        regionID=10000002,
-                        average=market_history_data["average"],
-                        date=market_history_data["date"],
-                        highest=market_history_data["highest"],
-                        lowest=market_history_data["lowest"],
-                        order_count=market_history_data["order_count"],
-                        volume=market_history_data["volume"],
-                        updated_date=db.func.now(),
-                    )
-                    db.session.merge(market_history)
-                    db.session.commit()
+    def main(self):
+        print(f"Running Market History Main: {datetime.now()}")
+        started = time.perf_counter()
+        app = self.scheduler.app
+
+        region_ids = list(app.config.get("MARKET_HISTORY_REGIONS") or [10000002])
+        pairs = self.get_stale_pairs(region_ids, self.get_type_ids())
+        batch_size = app.config.get("MARKET_HISTORY_BATCH_SIZE", 1000)
+        mode = series.storage_mode(app)
+        print(f"Market history: {len(pairs)} stale (region, type) pairs in {len(region_ids)} regions")
+
+        days, failed, updated_regions = 0, 0, set()
+        for start in range(0, len(pairs), batch_size):
+            history_rows, index_rows, batch_failed = self.fetch_batch(
+                pairs[start:start + batch_size]
+            )
+            updated_regions.update(row["regionID"] for row in history_rows)
+            # index after history, a pair is never marked fresh without its days
+            if mode in ("rows", "both"):
+                bulk_insert(app, MarketHistory, history_rows)
+            if mode in ("packed", "both"):
+                series.append_days(app, history_rows)
+            bulk_upsert(app, MarketHistoryIndex, index_rows)
+            days += len(history_rows)
+            failed += batch_failed
+
+        print(
+            f"Market history: {len(pairs)} pairs, {days} new days, {failed} failed "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+        stats.refresh(app, sorted(updated_regions))
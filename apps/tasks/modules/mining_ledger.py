@@ -1,61 +1,93 @@
 """Mining Ledger Tasks"""
 
-from datetime import datetime
-from apps.authentication.models import Characters, MiningLedger
+from datetime import timedelta
+from apps.authentication.models import MiningLedger
 from apps import esi, db
+from esi_tools.raw import parse_date
+from ..bulk import bulk_upsert
+from ..character_task import CharacterTask
+from ..sync_state import load_high_water, save_high_water
 
+ESI_ENDPOINT = "get_characters_character_id_mining"
 
-class MiningLedgerTasks:
+# unique index of MiningLedger, ESI sends one row per key and day
+NATURAL_KEY = ("character_id", "date", "solar_system_id", "type_id")
+
+
+class MiningLedgerTasks(CharacterTask):
     """Tasks related to the Mining Ledger"""
 
-    def __init__(self, scheduler):
-        self.scheduler = scheduler
-        self.schedule_tasks()
-
-    def schedule_tasks(self) -> None:
-        """Setup task execution schedule"""
-        self.scheduler.add_job(
-            func=self.main,
-            trigger="interval",
-            seconds=3600,
-            id="mining_ledger_main",
-            name="mining_ledger_main",
-            replace_existing=False,
-            max_instances=1
+    ENDPOINT = ESI_ENDPOINT
+    JOB_ID = "mining_ledger_main"
+    LABEL = "Mining Ledger"
+
+    def fetch(self, character) -> tuple:
+        return esi.get_esi_all_expires(
+            character,
+            ESI_ENDPOINT,
+            converters={"date": parse_date},
+            character_id=character.character_id,
         )
 
-    def get_all_users(self) -> list:
-        """Gets all characters"""
-        with self.scheduler.app.app_context():
-            character_list = Characters.query.filter_by(sso_is_valid=True).all()
-        return character_list
-
-    def main(self):
-        print(f"Running Mining Ledger Main: {datetime.now()}")
-
-        characters = self.get_all_users()
-
-        for character in characters:
-            print(f"Checking: {character.character_name}", end="")
-
-            # Get Data
-            esi_params = {"character_id": character.character_id}
-            ledger_data = esi.get_esi(
-                character, "get_characters_character_id_mining", **esi_params
-            )
-
-            # Save Data
-            for ld in ledger_data.data:
-                mining_row = MiningLedger(
-                    character_id=character.character_id,
-                    date=ld["date"],
-                    quantity=ld["quantity"],
-                    solar_system_id=ld["solar_system_id"],
-                    type_id=ld["type_id"],
-                )
+    def write(self, fetched: dict) -> set:
+        """Upsert the new and revised ledger rows, returns the characters that had any"""
+        app = self.scheduler.app
+        revision = timedelta(days=app.config.get("MINING_LEDGER_REVISION_DAYS", 2))
+        marks = load_high_water(app, ESI_ENDPOINT, list(fetched))
+
+        mining_rows = {}
+        new_marks = {}
+        for character_id, ledger_data in fetched.items():
+            if not ledger_data:
+                continue
+
+            # days before the high-water mark minus the revision window are final
+            mark = marks.get(character_id)
+            cutoff = mark - revision if mark else None
+            for ld in ledger_data:
+                if cutoff and ld["date"] < cutoff:
+                    continue
+                key = (character_id, ld["date"], ld["solar_system_id"], ld["type_id"])
+                mining_rows[key] = ld["quantity"]
 
-                with self.scheduler.app.app_context():
-                    db.session.merge(mining_row)
-                    db.session.commit()
+            new_marks[character_id] = max(ld["date"] for ld in ledger_data)
 
-            print("...Done")
+        changed = self.changed_rows(mining_rows)
+        bulk_upsert(
+            app,
+            MiningLedger,
+            changed,
+            keys=list(NATURAL_KEY),
+            update=["quantity"],
+            label="Mining ledger",
+        )
+        save_high_water(app, ESI_ENDPOINT, new_marks)
+        return {row["character_id"] for row in changed}
+
+    def changed_rows(self, mining_rows: dict) -> list:
+        """Rows of ``mining_rows`` that are new or whose quantity changed.
+
+        Args:
+            mining_rows (dict): natural key -> quantity from ESI.
+
+        Returns:
+            list: dicts ready for ``bulk_upsert``.
+        """
+        if not mining_rows:
+            return []
+        table = MiningLedger.__table__
+        with self.scheduler.app.app_context():
+            stored = {
+                tuple(row[:-1]): row[-1]
+                for row in db.session.execute(
+                    db.select(*(table.c[name] for name in NATURAL_KEY), table.c.quantity).where(
+                        table.c.character_id.in_({key[0] for key in mining_rows}),
+                        table.c.date >= min(key[1] for key in mining_rows),
+                    )
+                )
+            }
+        return [
+            dict(zip(NATURAL_KEY, key), quantity=quantity)
+            for key, quantity in mining_rows.items()
+            if stored.get(key) != quantity
+        ]
@@ -1,32 +1,40 @@
 """Notification Tasks"""
 
+from datetime import datetime
 from apps.authentication.models import (
     Characters,
     CharacterNotifications,
     SentNotifications,
     Users,
     SkillSet,
-    Contract,
-    ContractItem,
 )
-from apps import esi, db, discord_client
-from ..common import is_feature_enabled
+from apps import db
+from ..bulk import write_lock
+from ..events import SKILLS_SYNCED, SpChange, subscribe
+from ..outbox import SP_FARM, enqueue, notification
+
+SP_FARM_FEATURE = "sp-farm-notification"
 
 
 class NotificationTasks:
-    """Tasks related to Notifications"""
+    """Tasks related to Notifications.
+
+    SP-farm notifications react to the ``SKILLS_SYNCED`` events the skill
+    sync emits, so nothing is queried between syncs. Every synced character
+    is evaluated, not only those whose SP moved, so a notification a failed
+    run missed goes out on the character's next sync. ``main`` runs once at
+    startup to catch up with the stored skill sets.
+    """
 
     def __init__(self, scheduler):
         self.scheduler = scheduler
         self.schedule_tasks()
-        # self.discord = DiscordOAuth2Session(app)
 
     def schedule_tasks(self) -> None:
         """Setup task execution schedule"""
+        subscribe(SKILLS_SYNCED, self.on_skills_synced)
         self.scheduler.add_job(
             func=self.main,
-            trigger="interval",
-            seconds=320,
             id="notification_main",
             name="notification_main",
             replace_existing=False,
@@ -39,111 +47,157 @@ class NotificationTasks:
             character_list = CharacterNotifications.query.all()
         return character_list
 
-    def send_discord_msg(
-        self, user_id: str, character_name: str, skill_points: int
-    ) -> None:
-        print("sending notification")
-        dm_channel = discord_client.bot_request(
-            "/users/@me/channels", "POST", json={"recipient_id": user_id}
+    def on_skills_synced(self, synced: list) -> int:
+        """Clear and send SP-farm notifications for the characters of ``synced``.
+
+        A character over SP_FARM_THRESHOLD is notified once; the
+        notification clears when its SP drops below the notified amount
+        (it was extracted), and the next crossing notifies again.
+
+        Args:
+            synced (list): SpChange of every character a skill sync wrote.
+
+        Returns:
+            int: Number of notifications queued.
+        """
+        app = self.scheduler.app
+        threshold = app.config.get("SP_FARM_THRESHOLD", 5500000)
+        character_ids = [change.character_id for change in synced]
+        over = {
+            change.character_id: change.new_sp for change in synced if change.new_sp > threshold
+        }
+
+        with app.app_context(), write_lock(db.engine.dialect.name):
+            try:
+                cleared = db.session.execute(
+                    db.update(SentNotifications)
+                    .where(
+                        SentNotifications.character_id.in_(character_ids),
+                        SentNotifications.notification_cleared.is_(False),
+                        SentNotifications.total_sp
+                        > db.select(SkillSet.total_sp)
+                        .where(SkillSet.character_id == SentNotifications.character_id)
+                        .scalar_subquery(),
+                    )
+                    .values(notification_cleared=True)
+                ).rowcount
+                ready = self.get_ready(list(over)) if over else []
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        for character_id, _, character_name, _ in ready:
+            print(f"{character_name} is ready for harvest with sp: {over[character_id]:,}!")
+        # queued before it is recorded: the outbox key drops a second copy,
+        # a recorded notification that never made it to the outbox is lost
+        enqueue(
+            app,
+            [
+                notification(
+                    SP_FARM,
+                    character_id,
+                    over[character_id],
+                    {"character_name": character_name, "total_sp": over[character_id]},
+                    discord_user_id=discord_user_id,
+                )
+                for character_id, _, character_name, discord_user_id in ready
+            ],
         )
-        return discord_client.bot_request(
-            f"/channels/{dm_channel['id']}/messages",
-            "POST",
-            json={
-                "content": f"Hello! {character_name} is ready to harvest with {skill_points:,}!"
-            },
+        recorded = self.record_sent(ready, over)
+        print(
+            f"SP farm: {len(synced)} synced, {len(over)} over {threshold:,}, "
+            f"{len(ready)} notified, {recorded} recorded, {cleared} cleared"
         )
-
-    def should_notifications_be_sent(self, character_id):
-        # reset notification
-        with self.scheduler.app.app_context():
-            notification_count = (
-                SentNotifications.query.filter(
-                    SentNotifications.character_id == character_id
-                )
-                .filter(SentNotifications.notification_cleared == False)
-                .count()
+        return len(ready)
+
+    def get_ready(self, character_ids: list) -> list:
+        """Characters of ``character_ids`` that want the notification and have none uncleared.
+
+        Returns:
+            list: (character_id, master_character_id, character_name, discord_user_id).
+        """
+        uncleared = (
+            db.select(SentNotifications.id)
+            .where(
+                SentNotifications.character_id == CharacterNotifications.character_id,
+                SentNotifications.notification_cleared.is_(False),
             )
-
-        if notification_count > 0:
-            return False
-        else:
-            return True
-
-    def main(self):
-        print("Running Notification Main")
-
-        characters = self.get_all_users()
-
-        for character in characters:
-            # Make sure there's something here
-            if not character.enabled_notifications:
-                continue
-
-            # Have we already sent a notification for this character that needs to be cleared?
-            if not self.should_notifications_be_sent(character.character_id):
-                # reset notification
-                with self.scheduler.app.app_context():
-                    notification_histories = (
-                        SentNotifications.query.filter(
-                            SentNotifications.character_id == character.character_id
-                        )
-                        .filter(SentNotifications.notification_cleared == False)
-                        .all()
-                    )
-
-                    skill_info = SkillSet.query.filter(
-                        SkillSet.character_id == character.character_id
-                    ).one()
-
-                for notification_history in notification_histories:
-                    if notification_history.total_sp == skill_info.total_sp:
-                        continue
-                    if notification_history.total_sp > skill_info.total_sp:
-                        notification_history.notification_cleared = True
-
-                        with self.scheduler.app.app_context():
-                            db.session.merge(notification_history)
-                            db.session.commit()
-                continue
-
-            # If we don't have a discord ID, no point in going on
-            with self.scheduler.app.app_context():
-                user = Users.query.filter(
-                    Users.character_id == character.master_character_id
-                ).first()
-            if not user.discord_user_id:
-                continue
-
-            if character.enabled_notifications == "sp-farm-notification":
-                with self.scheduler.app.app_context():
-                    character_skill_info = SkillSet.query.filter(
-                        SkillSet.character_id == character.character_id
-                    ).one()
-
-                    character_info = Characters.query.filter(
-                        Characters.character_id == character.character_id
-                    ).one()
-
-                if character_skill_info.total_sp > 5500000:
-                    print(
-                        f"{character_info.character_name} is ready for harvest with sp: {character_skill_info.total_sp:,}!"
-                    )
-
-                    # send discord message
-                    self.send_discord_msg(
-                        user.discord_user_id,
-                        character_info.character_name,
-                        character_skill_info.total_sp,
-                    )
-
-                    # save total_sp to SentNotifications
-                    with self.scheduler.app.app_context():
-                        sent_notification = SentNotifications(
-                            character_id=character.character_id,
-                            master_character_id=character.master_character_id,
-                            total_sp=character_skill_info.total_sp,
+            .exists()
+        )
+        return db.session.execute(
+            db.select(
+                CharacterNotifications.character_id,
+                CharacterNotifications.master_character_id,
+                Characters.character_name,
+                Users.discord_user_id,
+            )
+            .join(Users, Users.character_id == CharacterNotifications.master_character_id)
+            .join(Characters, Characters.character_id == CharacterNotifications.character_id)
+            .where(
+                CharacterNotifications.character_id.in_(character_ids),
+                CharacterNotifications.enabled_notifications.contains(SP_FARM_FEATURE),
+                Users.discord_user_id.isnot(None),
+                ~uncleared,
+            )
+        ).all()
+
+    def record_sent(self, ready: list, over: dict) -> int:
+        """Store a SentNotifications row per ready character that still has none uncleared.
+
+        The check and the insert share one transaction holding the
+        characters' CharacterNotifications rows, so a sync running at the
+        same moment records each character once.
+
+        Returns:
+            int: Rows inserted.
+        """
+        if not ready:
+            return 0
+        app = self.scheduler.app
+        character_ids = [character_id for character_id, _, _, _ in ready]
+        with app.app_context(), write_lock(db.engine.dialect.name):
+            try:
+                db.session.execute(
+                    db.select(CharacterNotifications.character_id)
+                    .where(CharacterNotifications.character_id.in_(character_ids))
+                    .with_for_update()
+                ).all()
+                recorded = set(
+                    db.session.execute(
+                        db.select(SentNotifications.character_id)
+                        .where(
+                            SentNotifications.character_id.in_(character_ids),
+                            SentNotifications.notification_cleared.is_(False),
                         )
+                        .with_for_update()
+                    ).scalars()
+                )
+                rows = [
+                    {
+                        "character_id": character_id,
+                        "master_character_id": master_character_id,
+                        "total_sp": over[character_id],
+                        "notification_cleared": False,
+                    }
+                    for character_id, master_character_id, _, _ in ready
+                    if character_id not in recorded
+                ]
+                if rows:
+                    db.session.execute(db.insert(SentNotifications), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return len(rows)
 
-                        db.session.add(sent_notification)
-                        db.session.commit()
+    def main(self):
+        """Evaluate every stored skill set once, for what happened while the app was down"""
+        print(f"Running Notification Main: {datetime.now()}")
+        with self.scheduler.app.app_context():
+            skill_sets = db.session.execute(
+                db.select(SkillSet.character_id, SkillSet.total_sp)
+            ).all()
+        self.on_skills_synced(
+            [SpChange(character_id, None, total_sp) for character_id, total_sp in skill_sets]
+        )
@@ -1,87 +1,169 @@
 """Skill Tasks"""
 
-from datetime import datetime
-from apps.authentication.models import Characters, SkillSet
+from datetime import datetime, timedelta
+from apps.authentication.models import SkillSet, SkillPointHistory, SkillProjection
 from apps import esi, db
-from ..common import invalidate_sso
-
-
-class SkillTasks:
+from esi_tools.cache import expires_at
+from esi_tools.raw import parse_datetime
+from ..bulk import bulk_upsert
+from ..character_task import CharacterTask
+from ..events import SKILLS_SYNCED, SP_CHANGED, SpChange, emit
+
+ESI_ENDPOINT = "get_characters_character_id_skills"
+QUEUE_ENDPOINT = "get_characters_character_id_skillqueue"
+
+# characters over the threshold are refreshed hourly to notice an extraction,
+# the others at least twice before their projected crossing
+DEADLINE_MIN_INTERVAL = timedelta(hours=1)
+
+# ESI caches skills for two minutes, refresh a little after the crossing
+THRESHOLD_CHECK_DELAY = timedelta(minutes=3)
+
+
+def project_crossing(total_sp: int, queue: list, threshold: int, now: datetime):
+    """When ``total_sp`` passes ``threshold`` if the skill queue trains as planned.
+
+    ESI adds a level's SP to ``total_sp`` when it finishes, so the crossing
+    is the finish date of the level that takes the total over.
+
+    Args:
+        total_sp (int): The current total from the skills endpoint.
+        queue (list): Skill queue entries with parsed dates.
+        threshold (int): SP to pass.
+        now (datetime): Naive UTC; levels finished before it count as trained.
+
+    Returns:
+        datetime: naive UTC, or None when already over the threshold, the
+        queue is paused or it ends short of the threshold.
+    """
+    if total_sp > threshold:
+        return None
+    sp = total_sp
+    for entry in sorted(queue, key=lambda entry: entry["queue_position"]):
+        finish = entry.get("finish_date")
+        if finish is None:
+            # paused queues have no dates
+            return None
+        if finish <= now:
+            continue
+        sp += (entry.get("level_end_sp") or 0) - (entry.get("training_start_sp") or 0)
+        if sp > threshold:
+            return finish
+    return None
+
+
+def refresh_deadline(total_sp: int, crossing, threshold: int, now: datetime):
+    """Latest next refresh the SP projection asks for, None when it does not care.
+
+    Right after the crossing at the latest, the regular tick then notices it.
+    """
+    if total_sp > threshold:
+        return now + DEADLINE_MIN_INTERVAL
+    if crossing is None:
+        return None
+    return min(
+        now + max((crossing - now) / 2, DEADLINE_MIN_INTERVAL),
+        crossing + THRESHOLD_CHECK_DELAY,
+    )
+
+
+class SkillTasks(CharacterTask):
     """Tasks related to Skills"""
 
-    def __init__(self, scheduler):
-        self.scheduler = scheduler
-        self.schedule_tasks()
-
-    def schedule_tasks(self) -> None:
-        """Setup task execution schedule"""
-        self.scheduler.add_job(
-            func=self.main,
-            trigger="interval",
-            seconds=3600,
-            id="skill_main",
-            name="skill_main",
-            replace_existing=False,
-        )
+    ENDPOINT = ESI_ENDPOINT
+    JOB_ID = "skill_main"
+    LABEL = "Skill"
 
-    def get_all_users(self) -> list:
-        """Gets all characters"""
+    def get_total_sp(self, character_ids: list) -> dict:
+        """Stored total_sp per character, before this sync writes"""
         with self.scheduler.app.app_context():
-            character_list = Characters.query.filter_by(sso_is_valid=True).all()
-
-        return character_list
-
-    def main(self):
-        print(f"Running Skill Main: {datetime.now()}")
-
-        characters = self.get_all_users()
-
-        for character in characters:
-            print(f"Checking: {character.character_name}", end="")
-
-            # Get Data
-            esi_params = {"character_id": character.character_id}
-            try:
-                skill_data = esi.get_esi(
-                    character, "get_characters_character_id_skills", **esi_params
-                )
-            except RuntimeError as e:
-                print(f"Failed to get ESI data, invalidating user: {e}")
-                invalidate_sso(self.scheduler.app, character_id=character.character_id)
-            ld = skill_data.data
-
-            with self.scheduler.app.app_context():
-                skillset = (
-                    db.session.query(SkillSet)
-                    .filter_by(character_id=character.character_id)
-                    .first()
-                )
-
-            if skillset:
-                # Update the fields
-                skillset.total_sp = ld["total_sp"]
-                skillset.unallocated_sp = ld["unallocated_sp"]
-
-                # Commit the changes
-                with self.scheduler.app.app_context():
-                    try:
-                        db.session.merge(skillset)
-                        db.session.commit()
-                    except Exception as error:
-                        print(f"Failed to commit row: {skillset}, error: {error}")
-
-            else:
-                skill_row = SkillSet(
-                    character_id=character.character_id,
-                    total_sp=ld["total_sp"],
-                    unallocated_sp=ld["unallocated_sp"],
-                )
-
-                with self.scheduler.app.app_context():
-                    try:
-                        db.session.merge(skill_row)
-                        db.session.commit()
-                    except Exception as error:
-                        print(f"Failed to commit row: {skill_row}, error: {error}")
-
-            print("...done")
+            return dict(
+                db.session.execute(
+                    db.select(SkillSet.character_id, SkillSet.total_sp).where(
+                        SkillSet.character_id.in_(character_ids)
+                    )
+                ).all()
+            )
+
+    def fetch(self, character) -> tuple:
+        """Skills and skill queue, the queue is None when it could not be read"""
+        esi_params = {"character_id": character.character_id}
+        response, queue = esi.get_esi_calls(
+            character,
+            [(ESI_ENDPOINT, esi_params), (QUEUE_ENDPOINT, esi_params)],
+            converters={"start_date": parse_datetime, "finish_date": parse_datetime},
+        )
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(queue, Exception):
+            # no projection this time, the regular refresh covers it
+            print(f"No skill queue for {character.character_name}: {queue}")
+            queue = None
+        else:
+            queue = queue.data
+        return (response.data, queue), expires_at(response.headers)
+
+    def write(self, fetched: dict) -> set:
+        """Store the skill sets and SP history, then tell who changed"""
+        app = self.scheduler.app
+        previous_sp = self.get_total_sp(list(fetched))
+        skill_rows = [
+            {
+                "character_id": character_id,
+                "total_sp": skills["total_sp"],
+                "unallocated_sp": skills["unallocated_sp"],
+            }
+            for character_id, (skills, _) in fetched.items()
+        ]
+
+        bulk_upsert(app, SkillSet, skill_rows, keys=["character_id"], label="Skill sets")
+        # one point per day for the SP charts, the last sync of the day wins
+        today = datetime.utcnow().date()
+        bulk_upsert(
+            app,
+            SkillPointHistory,
+            [dict(row, date=today) for row in skill_rows],
+            keys=["character_id", "date"],
+        )
+
+        synced = [
+            SpChange(row["character_id"], previous_sp.get(row["character_id"]), row["total_sp"])
+            for row in skill_rows
+        ]
+        changes = [change for change in synced if change.old_sp != change.new_sp]
+        if changes:
+            emit(SP_CHANGED, changes)
+        emit(SKILLS_SYNCED, synced)
+        return {change.character_id for change in changes}
+
+    def deadlines(self, fetched: dict) -> dict:
+        """Store when each character crosses the threshold.
+
+        Returns:
+            dict: character_id -> latest next refresh, see ``refresh_deadline``.
+        """
+        app = self.scheduler.app
+        threshold = app.config.get("SP_FARM_THRESHOLD", 5500000)
+        now = datetime.utcnow()
+
+        rows, deadlines = [], {}
+        for character_id, (skills, queue) in fetched.items():
+            total_sp = skills["total_sp"]
+            crossing = None
+            if queue is not None:
+                crossing = project_crossing(total_sp, queue, threshold, now)
+            deadline = refresh_deadline(total_sp, crossing, threshold, now)
+            if deadline is not None:
+                deadlines[character_id] = deadline
+            rows.append(
+                {
+                    "character_id": character_id,
+                    "total_sp": total_sp,
+                    "threshold_at": crossing,
+                    "computed_at": now,
+                }
+            )
+        bulk_upsert(app, SkillProjection, rows)
+        projected = sum(1 for row in rows if row["threshold_at"] is not None)
+        print(f"SP projections: {len(rows)} characters, {projected} crossings ahead")
+        return deadlines
@@ -0,0 +1,49 @@
+"""Notifications waiting to be sent.
+
+Tasks that notice something worth telling a user queue it in
+``notification_outbox`` instead of talking to Discord themselves. Every
+notification has a key naming the event (``contract-match:<character>:<contract>``),
+so an event seen twice is still only queued once. Senders drain the
+outbox with the usual ``WorkQueue`` claims.
+"""
+
+from apps.authentication.models import NotificationOutbox
+from .work_queue import WorkQueue
+
+CONTRACT_MATCH = "contract-match"
+SP_FARM = "sp-farm"
+WELCOME = "welcome"
+
+# called after notifications are queued, e.g. to wake a dispatcher
+_listeners = []
+
+
+def on_enqueue(listener) -> None:
+    """Call ``listener()`` whenever notifications are queued in this process"""
+    _listeners.append(listener)
+
+
+def outbox_queue(app: object) -> WorkQueue:
+    """The notification outbox as a work queue"""
+    return WorkQueue(app, NotificationOutbox, max_attempts=8, backoff=30.0, lease=300.0)
+
+
+def notification(kind: str, character_id: int, subject, payload: dict = None,
+                 discord_user_id: str = None) -> dict:
+    """notification_outbox row for ``kind`` about ``subject`` (an id) for a character"""
+    return {
+        "key": f"{kind}:{character_id}:{subject}",
+        "character_id": character_id,
+        "kind": kind,
+        "payload": payload,
+        "discord_user_id": discord_user_id,
+    }
+
+
+def enqueue(app: object, notifications: list) -> int:
+    """Queue notifications, returns how many were new; events queued before are left alone"""
+    queued = outbox_queue(app).enqueue(notifications)
+    if queued:
+        for listener in _listeners:
+            listener()
+    return queued
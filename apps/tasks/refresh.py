@@ -0,0 +1,126 @@
+"""Per character, per endpoint refresh schedule.
+
+Character tasks poll often but only fetch the characters whose
+``RefreshSchedule`` entry is due. After a fetch the next refresh is set
+from how long the character's data has gone unchanged: a character whose
+data just changed is refreshed again soon, one that has not changed in
+days is refreshed about daily. It is never set before ESI's ``Expires``,
+ESI would only answer from its cache until then.
+"""
+
+from datetime import datetime, timedelta
+
+from apps import db
+from apps.authentication.models import Characters, RefreshSchedule
+from .bulk import bulk_upsert
+
+# fraction of the time the data went unchanged before the next refresh
+IDLE_FACTOR = 0.25
+
+
+def next_refresh(now: datetime, expires, changed_at: datetime, shortest: timedelta,
+                 longest: timedelta, deadline=None) -> datetime:
+    """When to refresh next.
+
+    Args:
+        now (datetime): Time of the refresh, naive UTC.
+        expires (datetime): ESI's Expires of the response, None if unknown.
+        changed_at (datetime): Last refresh that found different data.
+        shortest (timedelta): Smallest delay, for characters whose data just changed.
+        longest (timedelta): Largest delay, for characters idle for days.
+        deadline (datetime): Refresh no later than this, the task knows
+            something will change then.
+
+    Returns:
+        datetime: naive UTC.
+    """
+    delay = min(max((now - changed_at) * IDLE_FACTOR, shortest), longest)
+    moment = now + delay
+    if deadline is not None:
+        moment = min(moment, deadline)
+    if expires is not None:
+        moment = max(moment, expires)
+    return moment
+
+
+def due_characters(app: object, endpoint: str) -> list:
+    """Characters with a valid SSO that were never refreshed or are due.
+
+    Args:
+        app (object): The Flask app instance.
+        endpoint (str): ESI operation name of the schedule.
+
+    Returns:
+        list: Characters, detached from the session.
+    """
+    with app.app_context():
+        return db.session.execute(
+            db.select(Characters)
+            .outerjoin(
+                RefreshSchedule,
+                db.and_(
+                    RefreshSchedule.character_id == Characters.character_id,
+                    RefreshSchedule.endpoint == endpoint,
+                ),
+            )
+            .where(
+                Characters.sso_is_valid.is_(True),
+                db.or_(
+                    RefreshSchedule.next_refresh_at.is_(None),
+                    RefreshSchedule.next_refresh_at <= datetime.utcnow(),
+                ),
+            )
+        ).scalars().all()
+
+
+def record_refresh(app: object, endpoint: str, refreshed: dict, deadlines: dict = None) -> dict:
+    """Store the refreshes of ``endpoint`` and schedule the next ones.
+
+    Args:
+        app (object): The Flask app instance.
+        endpoint (str): ESI operation name of the schedule.
+        refreshed (dict): character_id -> (changed, expires) for every
+            character fetched; changed is False when the data was the same
+            as what is stored, expires ESI's Expires or None.
+        deadlines (dict): character_id -> latest next refresh, optional.
+
+    Returns:
+        dict: character_id -> next_refresh_at.
+    """
+    if not refreshed:
+        return {}
+    now = datetime.utcnow()
+    shortest = timedelta(minutes=app.config.get("REFRESH_MIN_MINUTES", 15))
+    longest = timedelta(hours=app.config.get("REFRESH_MAX_HOURS", 24))
+    deadlines = deadlines or {}
+
+    with app.app_context():
+        changed_at = dict(
+            db.session.execute(
+                db.select(RefreshSchedule.character_id, RefreshSchedule.changed_at).where(
+                    RefreshSchedule.endpoint == endpoint,
+                    RefreshSchedule.character_id.in_(list(refreshed)),
+                )
+            ).all()
+        )
+
+    rows = []
+    for character_id, (changed, expires) in refreshed.items():
+        since = now if changed or character_id not in changed_at else changed_at[character_id]
+        rows.append(
+            {
+                "character_id": character_id,
+                "endpoint": endpoint,
+                "next_refresh_at": next_refresh(
+                    now, expires, since, shortest, longest, deadlines.get(character_id)
+                ),
+                "expires_at": expires,
+                "changed_at": since,
+                "refreshed_at": now,
+            }
+        )
+    bulk_upsert(app, RefreshSchedule, rows, keys=["character_id", "endpoint"])
+
+    changed = sum(1 for changed, _ in refreshed.values() if changed)
+    print(f"Refresh {endpoint}: {len(rows)} refreshed, {changed} changed")
+    return {row["character_id"]: row["next_refresh_at"] for row in rows}
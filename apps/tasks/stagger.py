@@ -0,0 +1,66 @@
+"""Spreading a task's characters across its polling window.
+
+Character tasks tick every TASK_TICK_SECONDS, splitting REFRESH_POLL_SECONDS
+into slots. A character always lands in the same slot, picked from a hash
+of its id and the task's endpoint, and is only looked at on its slot's
+tick. A task then handles about 1/slots of its due characters per tick
+instead of all of them at the top of the window, and a character's
+endpoints do not all come up on the same tick.
+"""
+
+import time
+import zlib
+
+
+def slot_of(character_id: int, slots: int, salt: str = "") -> int:
+    """Slot of ``character_id``, stable across processes and restarts"""
+    return zlib.crc32(f"{salt}:{character_id}".encode()) % slots
+
+
+def stable_offset(name: str, seconds: float) -> float:
+    """Offset within ``seconds`` for ``name``, the same on every start"""
+    return zlib.crc32(name.encode()) % 1000 / 1000 * seconds
+
+
+class CharacterShard:
+    """Picks the characters whose slot came up since the previous tick.
+
+    Ticks move with the scheduler's jitter and can be missed while a run is
+    still busy; every slot passed since the last ``take`` is included, so a
+    late tick does not skip characters.
+
+    Args:
+        window (float): Seconds in which every slot comes up once.
+        tick (float): Seconds per slot.
+        salt (str): Spreads the tasks differently, the endpoint name.
+    """
+
+    def __init__(self, window: float, tick: float, salt: str = ""):
+        self.tick = tick
+        self.slots = max(1, int(window // tick))
+        self.salt = salt
+        self.last = None
+
+    def take(self, characters: list, now: float = None) -> list:
+        """The characters of ``characters`` whose slot is up"""
+        current = int((time.time() if now is None else now) // self.tick)
+        last = current - 1 if self.last is None else min(self.last, current)
+        self.last = current
+        passed = current - last
+        if passed >= self.slots:
+            return list(characters)
+        slots = {index % self.slots for index in range(last + 1, current + 1)}
+        return [
+            character
+            for character in characters
+            if slot_of(character.character_id, self.slots, self.salt) in slots
+        ]
+
+
+def character_shard(app: object, salt: str) -> CharacterShard:
+    """``CharacterShard`` with the app's window and tick"""
+    return CharacterShard(
+        app.config.get("REFRESH_POLL_SECONDS", 300),
+        app.config.get("TASK_TICK_SECONDS", 30),
+        salt,
+    )
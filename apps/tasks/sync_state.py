@@ -0,0 +1,92 @@
+"""Per character, per endpoint sync bookkeeping.
+
+``CharacterSyncState`` remembers, for each character and ESI endpoint, a
+hash of the last payload a task stored and the newest date it has seen.
+Tasks use them to skip characters whose data did not change since the
+previous run, or to only touch the part of a ledger ESI can still revise.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+
+from apps import db
+from apps.authentication.models import CharacterSyncState
+from .bulk import bulk_upsert
+
+
+def payload_hash(rows: list, sort_key: str = None) -> str:
+    """Content hash of an ESI list, independent of row and key order.
+
+    Args:
+        rows (list): dicts as returned by ``esi.get_esi_all``.
+        sort_key (str): Field the rows are sorted on before hashing; ESI
+            does not promise a stable order across cache periods.
+
+    Returns:
+        str: hex sha256 of the canonical JSON.
+    """
+    if sort_key:
+        rows = sorted(rows, key=lambda row: row[sort_key])
+    canonical = json.dumps(rows, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _load(app: object, endpoint: str, character_ids: list, column: str) -> dict:
+    if not character_ids:
+        return {}
+    with app.app_context():
+        rows = db.session.execute(
+            db.select(
+                CharacterSyncState.character_id, getattr(CharacterSyncState, column)
+            ).where(
+                CharacterSyncState.endpoint == endpoint,
+                CharacterSyncState.character_id.in_(character_ids),
+            )
+        ).all()
+    return {character_id: value for character_id, value in rows if value is not None}
+
+
+def _save(app: object, endpoint: str, values: dict, column: str) -> None:
+    now = datetime.utcnow()
+    bulk_upsert(
+        app,
+        CharacterSyncState,
+        [
+            {"character_id": character_id, "endpoint": endpoint, column: value, "synced_at": now}
+            for character_id, value in values.items()
+        ],
+        keys=["character_id", "endpoint"],
+    )
+
+
+def load_hashes(app: object, endpoint: str, character_ids: list) -> dict:
+    """Stored payload hashes of ``endpoint``.
+
+    Args:
+        app (object): The Flask app instance.
+        endpoint (str): ESI operation name the hashes belong to.
+        character_ids (list): Characters to look up.
+
+    Returns:
+        dict: character_id -> payload_hash, for characters synced before.
+    """
+    return _load(app, endpoint, character_ids, "payload_hash")
+
+
+def save_hashes(app: object, endpoint: str, hashes: dict) -> None:
+    """Record ``hashes`` (character_id -> payload_hash) as synced now"""
+    _save(app, endpoint, hashes, "payload_hash")
+
+
+def load_high_water(app: object, endpoint: str, character_ids: list) -> dict:
+    """Newest date stored from ``endpoint``, character_id -> date.
+
+    Same arguments as ``load_hashes``.
+    """
+    return _load(app, endpoint, character_ids, "high_water")
+
+
+def save_high_water(app: object, endpoint: str, marks: dict) -> None:
+    """Record ``marks`` (character_id -> date) as synced now"""
+    _save(app, endpoint, marks, "high_water")
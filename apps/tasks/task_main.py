@@ -5,9 +5,14 @@ will qualify if they run or not based on their own schedule. Meaning, some updat
 frequently than others.
 """
 
+from datetime import datetime, timedelta, timezone
 from flask_apscheduler import APScheduler
 import atexit
 
+from apps import esi
+from apps.tasks.discord_dispatch import start_dispatcher
+from apps.tasks.stagger import stable_offset
+
 from apps.tasks.modules import (
     MiningLedgerTasks,
     BlueprintTasks,
@@ -20,6 +25,44 @@ from apps.tasks.modules import (
 )
 
 
+def interval_seconds(job: dict) -> float:
+    """Length of an interval job's interval"""
+    return (
+        job.get("seconds", 0)
+        + job.get("minutes", 0) * 60
+        + job.get("hours", 0) * 3600
+        + job.get("days", 0) * 86400
+    )
+
+
+class StaggeredScheduler:
+    """The scheduler as the tasks see it, spreading their interval jobs.
+
+    Each interval job gets up to ``jitter`` seconds of random delay on every
+    run (never more than half its interval) and a first run at a stable
+    offset within its interval, so jobs sharing an interval do not fire in
+    the same second. One-shot and date jobs are added as they are.
+    """
+
+    def __init__(self, scheduler: APScheduler, jitter: float):
+        self.scheduler = scheduler
+        self.jitter = jitter
+
+    def add_job(self, **job):
+        seconds = interval_seconds(job)
+        if job.get("trigger") == "interval" and seconds:
+            if self.jitter:
+                job.setdefault("jitter", min(self.jitter, seconds / 2))
+            job.setdefault(
+                "next_run_time",
+                datetime.now(timezone.utc) + timedelta(seconds=stable_offset(job["id"], seconds)),
+            )
+        return self.scheduler.add_job(**job)
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+
 class MainTasks:
     """The Main tasks driving class.
 
@@ -33,9 +76,13 @@ class MainTasks:
         # ["skills", "blueprints", "mining_ledger", "notifications", "market_history", "contracts"]
         self.app = app
         self.scheduler = self._configure_scheduler()
+        self._schedule_spec_refresh()
+        self._schedule_metrics()
         self._load_scheduled_tasks()
+        # notifications are sent from their own thread, not the scheduler's
+        self.dispatcher = start_dispatcher(app)
 
-    def _configure_scheduler(self) -> APScheduler:
+    def _configure_scheduler(self) -> StaggeredScheduler:
         """Set up the scheduler to manage tasks."""
         scheduler = APScheduler()
         scheduler.init_app(self.app)
@@ -43,7 +90,51 @@ class MainTasks:
 
         # Shut down the scheduler gracefully when exiting the app
         atexit.register(scheduler.shutdown)
-        return scheduler
+        return StaggeredScheduler(scheduler, self.app.config.get("TASK_JITTER_SECONDS", 10))
+
+    def _schedule_spec_refresh(self) -> None:
+        """Keep the local ESI swagger spec current, so workers boot without downloading it."""
+        hours = self.app.config.get("ESI_SPEC_REFRESH_HOURS", 24)
+        if not hours:
+            return
+        self.scheduler.add_job(
+            func=self.refresh_spec,
+            trigger="interval",
+            hours=hours,
+            id="esi_spec_refresh",
+            name="esi_spec_refresh",
+            replace_existing=False,
+        )
+
+    def refresh_spec(self) -> None:
+        try:
+            if esi.refresh_spec():
+                print(f"ESI spec updated to {esi.spec.version}, used from the next restart")
+        except Exception as e:
+            print(f"Failed to refresh the ESI spec: {e}")
+
+    def _schedule_metrics(self) -> None:
+        """Report how evenly the tasks spread their ESI requests"""
+        minutes = self.app.config.get("TASK_METRICS_MINUTES", 10)
+        if not minutes:
+            return
+        self.scheduler.add_job(
+            func=self.report_metrics,
+            trigger="interval",
+            minutes=minutes,
+            id="task_metrics",
+            name="task_metrics",
+            replace_existing=False,
+        )
+
+    def report_metrics(self) -> None:
+        summary = esi.meter.summary()
+        recent = esi.meter.per_minute()[-10:]
+        print(
+            f"ESI requests, last {esi.meter.window} min: {summary['requests']:,}, "
+            f"{summary['mean']:.1f}/min mean, {summary['peak']}/min peak "
+            f"(peak/mean {summary['peak_ratio']:.2f}), last 10 min: {recent}"
+        )
 
     def _load_scheduled_tasks(self) -> None:
         """Load and initialize tasks based on the provided task names."""
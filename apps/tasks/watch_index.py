@@ -0,0 +1,154 @@
+"""Contract watch matching as contract items are stored.
+
+``WATCHES`` maps each watched type_id to the characters watching it. The
+contract item workers run every batch of new items through it, so a match
+costs a dict lookup per new item instead of a join of all contract items
+against the watch lists. Matches are recorded in ``contract_notify``
+(unique per character and contract) and queued in the notification outbox.
+
+The index reloads when the watch lists change: the web routes invalidate
+it, and a cheap aggregate over ``contract_watch`` catches changes made by
+other processes. Watches new to the index are then matched once against
+the items already stored for open contracts, so a watch added after a
+contract's items were fetched still finds it. On the first load of a
+process every watch is new; repeats are absorbed by ``contract_notify``
+and the outbox keys.
+"""
+
+import threading
+from collections import defaultdict
+
+from apps import db
+from apps.authentication.models import Contract, ContractItem, ContractNotify, ContractTrack
+from .bulk import bulk_upsert
+from .outbox import CONTRACT_MATCH, enqueue, notification
+
+
+class WatchIndex:
+    """type_id -> ids of the characters watching it, shared by all threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._watchers = {}
+        self._signature = None
+
+    def invalidate(self) -> None:
+        """Reload on the next ``refresh``"""
+        with self._lock:
+            self._signature = None
+
+    def refresh(self, app: object) -> bool:
+        """Reload the watch lists if they changed, returns True if reloaded"""
+        with app.app_context():
+            signature = tuple(
+                db.session.execute(
+                    db.select(
+                        db.func.count(),
+                        db.func.sum(ContractTrack.id),
+                        db.func.sum(ContractTrack.type_id),
+                        db.func.sum(ContractTrack.character_id),
+                    )
+                ).one()
+            )
+            if signature == self._signature:
+                return False
+            rows = db.session.execute(
+                db.select(ContractTrack.type_id, ContractTrack.character_id).where(
+                    ContractTrack.type_id.isnot(None)
+                )
+            ).all()
+
+        watchers = defaultdict(set)
+        for type_id, character_id in rows:
+            watchers[type_id].add(character_id)
+        with self._lock:
+            previous = self._watchers
+            self._watchers = {type_id: frozenset(ids) for type_id, ids in watchers.items()}
+            self._signature = signature
+
+        added = {
+            type_id: frozenset(ids - previous.get(type_id, frozenset()))
+            for type_id, ids in watchers.items()
+        }
+        added = {type_id: ids for type_id, ids in added.items() if ids}
+        if added:
+            matched = record_matches(app, self.match_stored(app, added))
+            print(f"Contract watch: {len(added)} newly watched types, {matched} stored matches")
+        return True
+
+    def match_stored(self, app: object, added: dict) -> dict:
+        """Matches of ``added`` (type_id -> character ids) among the stored items of open contracts.
+
+        Returns:
+            dict: Same shape as ``match``.
+        """
+        with app.app_context():
+            rows = db.session.execute(
+                db.select(ContractItem.contract_id, ContractItem.type_id)
+                .join(Contract, Contract.id == ContractItem.contract_id)
+                .where(
+                    ContractItem.type_id.in_(list(added)),
+                    ContractItem.is_included.is_(True),
+                    Contract.gone_at.is_(None),
+                )
+            ).all()
+        matches = defaultdict(set)
+        for contract_id, type_id in rows:
+            for character_id in added[type_id]:
+                matches[(character_id, contract_id)].add(type_id)
+        return {key: sorted(type_ids) for key, type_ids in matches.items()}
+
+    def match(self, item_rows: list) -> dict:
+        """Watches hit by contract item rows.
+
+        Items a contract asks for (``is_included`` false) are not offered
+        by it and do not match.
+
+        Returns:
+            dict: (character_id, contract_id) -> sorted matched type_ids.
+        """
+        watchers = self._watchers
+        matches = defaultdict(set)
+        for item in item_rows:
+            characters = watchers.get(item["type_id"])
+            if not characters or item.get("is_included") is False:
+                continue
+            for character_id in characters:
+                matches[(character_id, item["contract_id"])].add(item["type_id"])
+        return {key: sorted(type_ids) for key, type_ids in matches.items()}
+
+
+WATCHES = WatchIndex()
+
+
+def record_matches(app: object, matches: dict) -> int:
+    """Store matches from ``WatchIndex.match`` and queue their notifications.
+
+    Returns:
+        int: Number of matches written, repeats included.
+    """
+    if not matches:
+        return 0
+    bulk_upsert(
+        app,
+        ContractNotify,
+        [
+            {"character_id": character_id, "contract_id": contract_id}
+            for character_id, contract_id in matches
+        ],
+        keys=["character_id", "contract_id"],
+        update=[],
+    )
+    enqueue(
+        app,
+        [
+            notification(
+                CONTRACT_MATCH,
+                character_id,
+                contract_id,
+                {"contract_id": contract_id, "type_ids": type_ids},
+            )
+            for (character_id, contract_id), type_ids in matches.items()
+        ],
+    )
+    return len(matches)
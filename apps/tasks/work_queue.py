@@ -0,0 +1,326 @@
+"""Database backed work queues for the scheduled tasks.
+
+A queue is a table of job rows with the ``JobMixin`` columns. Jobs move
+``pending`` -> ``claimed`` -> ``done``, or back to ``pending`` with a
+backoff when they fail, until ``failed`` after too many attempts. ``cancelled``
+jobs are dropped without running.
+
+Any number of threads or processes can drain a queue at once. ``claim``
+picks due jobs with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the database
+has it (PostgreSQL, MySQL 8), so workers never wait on each other's rows,
+then stamps them with a claim token in an UPDATE that only touches rows
+still pending. That guard alone keeps claims exclusive on SQLite, where
+writes are serialized anyway.
+
+Claims are leases: a claimed job that is not finished within ``lease``
+seconds (its worker died, the app restarted) goes back to pending on the
+next ``requeue_expired``, so a queue resumes where it stopped; a job out of
+attempts fails there instead of cycling forever. Finishing a job takes its
+claim token, so a worker whose lease expired cannot finish a job another
+worker has claimed since.
+"""
+
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from apps import db
+from .bulk import bulk_upsert, write_lock
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+STATES = (PENDING, CLAIMED, DONE, FAILED, CANCELLED)
+
+_SKIP_LOCKED_DIALECTS = ("postgresql", "mysql", "mariadb")
+
+# keys per UPDATE when finishing or cancelling jobs
+KEY_CHUNK_SIZE = 500
+
+
+class Claim(list):
+    """Job keys claimed together, with the ``token`` that finishes them"""
+
+    def __init__(self, keys=(), token: str = None):
+        super().__init__(keys)
+        self.token = token
+
+
+class WorkQueue:
+    """Claim, finish and count the jobs of one queue table.
+
+    Args:
+        app (object): The Flask app instance.
+        model (db.Model): The job model, with ``JobMixin`` columns.
+        max_attempts (int): Attempts before a job is given up as failed.
+        backoff (float): Seconds before the first retry, doubled per attempt.
+        lease (float): Seconds a claim stays valid.
+    """
+
+    def __init__(self, app, model, max_attempts: int = 5, backoff: float = 60.0,
+                 lease: float = 600.0):
+        self.app = app
+        self.model = model
+        self.key = list(model.__table__.primary_key)[0]
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+
+    def enqueue(self, jobs: list) -> int:
+        """Add job rows (dicts of the model's columns); existing jobs are left alone.
+
+        Returns:
+            int: Jobs actually added, all of them when the driver does not
+            report a rowcount.
+        """
+        now = datetime.utcnow()
+        rows = [dict({"state": PENDING, "next_attempt_at": now}, **job) for job in jobs]
+        stats = bulk_upsert(self.app, self.model, rows, update=[])
+        return stats.rows if stats.written is None else stats.written
+
+    def claim(self, limit: int, min_priority: int = None) -> list:
+        """Claim up to ``limit`` due jobs, highest priority first.
+
+        Args:
+            limit (int): Most jobs to claim.
+            min_priority (int): Leave jobs of a lower priority alone.
+
+        Returns:
+            Claim: the claimed job keys, empty when nothing is due.
+        """
+        model, now = self.model, datetime.utcnow()
+        token = uuid.uuid4().hex
+        with self.app.app_context():
+            dialect = db.engine.dialect.name
+            candidates = (
+                db.select(self.key)
+                .where(model.state == PENDING, model.next_attempt_at <= now)
+                .order_by(model.priority.desc(), model.next_attempt_at)
+                .limit(limit)
+            )
+            if min_priority is not None:
+                candidates = candidates.where(model.priority >= min_priority)
+            if dialect in _SKIP_LOCKED_DIALECTS:
+                candidates = candidates.with_for_update(skip_locked=True)
+
+            with write_lock(dialect):
+                try:
+                    keys = db.session.execute(candidates).scalars().all()
+                    if not keys:
+                        db.session.rollback()
+                        return Claim()
+                    db.session.execute(
+                        db.update(model)
+                        .where(self.key.in_(keys), model.state == PENDING)
+                        .values(
+                            state=CLAIMED,
+                            claim_token=token,
+                            claimed_at=now,
+                            attempts=model.attempts + 1,
+                        )
+                    )
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+
+            # another worker may have won some rows between the select and update
+            return Claim(
+                db.session.execute(
+                    db.select(self.key).where(model.claim_token == token)
+                ).scalars().all(),
+                token,
+            )
+
+    def _finish(self, keys: list, *where, **values) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        with self.app.app_context(), write_lock(db.engine.dialect.name):
+            try:
+                for start in range(0, len(keys), KEY_CHUNK_SIZE):
+                    db.session.execute(
+                        db.update(self.model)
+                        .where(self.key.in_(keys[start:start + KEY_CHUNK_SIZE]), *where)
+                        .values(**values)
+                    )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def complete(self, keys: list, token: str) -> None:
+        """Mark jobs of the claim ``token`` done"""
+        self._finish(
+            keys,
+            self.model.claim_token == token,
+            state=DONE,
+            finished_at=datetime.utcnow(),
+            claim_token=None,
+        )
+
+    def cancel(self, keys: list) -> None:
+        """Drop jobs that no longer need to run, unless already finished"""
+        self._finish(
+            keys,
+            self.model.state.in_((PENDING, CLAIMED)),
+            state=CANCELLED,
+            finished_at=datetime.utcnow(),
+            claim_token=None,
+        )
+
+    def fail(self, key, error: str, token: str) -> bool:
+        """Put a job of the claim ``token`` back with a backoff, or give up on it.
+
+        Returns:
+            bool: True if the job will be retried.
+        """
+        model = self.model
+        with self.app.app_context():
+            attempts = db.session.execute(
+                db.select(model.attempts).where(self.key == key)
+            ).scalar() or 0
+        now = datetime.utcnow()
+        claimed = model.claim_token == token
+        if attempts >= self.max_attempts:
+            self._finish([key], claimed, state=FAILED, finished_at=now, claim_token=None,
+                         last_error=error[:1000])
+            return False
+        delay = self.backoff * 2 ** (attempts - 1)
+        self._finish([key], claimed, state=PENDING, claim_token=None, last_error=error[:1000],
+                     next_attempt_at=now + timedelta(seconds=delay))
+        return True
+
+    def release(self, keys: list, token: str, delay: float = 0.0) -> None:
+        """Hand jobs of the claim ``token`` back untried, due again in ``delay`` seconds"""
+        self._finish(
+            keys,
+            self.model.claim_token == token,
+            state=PENDING,
+            claim_token=None,
+            attempts=self.model.attempts - 1,
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+        )
+
+    def requeue_expired(self) -> int:
+        """Return claims older than the lease to pending, returns how many.
+
+        Jobs already claimed ``max_attempts`` times fail instead, a job that
+        kills its worker or always overruns the lease would cycle forever.
+        """
+        model, now = self.model, datetime.utcnow()
+        expired = (model.state == CLAIMED, model.claimed_at < now - timedelta(seconds=self.lease))
+        with self.app.app_context(), write_lock(db.engine.dialect.name):
+            try:
+                db.session.execute(
+                    db.update(model)
+                    .where(*expired, model.attempts >= self.max_attempts)
+                    .values(
+                        state=FAILED,
+                        finished_at=now,
+                        claim_token=None,
+                        last_error=f"Claim expired after {self.lease:.0f}s, out of attempts",
+                    )
+                )
+                result = db.session.execute(
+                    db.update(model).where(*expired).values(state=PENDING, claim_token=None)
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return result.rowcount
+
+    def reprioritize(self, priorities: dict) -> int:
+        """Set the priority of pending jobs, key -> priority; returns how many"""
+        if not priorities:
+            return 0
+        table = self.model.__table__
+        stmt = (
+            table.update()
+            .where(self.key == db.bindparam("job_key"), table.c.state == PENDING)
+            .values(priority=db.bindparam("job_priority"))
+        )
+        rows = [{"job_key": key, "job_priority": priority} for key, priority in priorities.items()]
+        with self.app.app_context(), write_lock(db.engine.dialect.name):
+            try:
+                for start in range(0, len(rows), KEY_CHUNK_SIZE):
+                    db.session.execute(stmt, rows[start:start + KEY_CHUNK_SIZE])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        return len(rows)
+
+    def depth(self, min_priority: int = None) -> dict:
+        """Number of jobs per state, plus ``due`` for pending jobs that can run now.
+
+        With ``min_priority`` there is also ``due_priority``, the due jobs at
+        or above it.
+        """
+        model = self.model
+        due = db.select(db.func.count()).where(
+            model.state == PENDING, model.next_attempt_at <= datetime.utcnow()
+        )
+        with self.app.app_context():
+            counts = dict(
+                db.session.execute(
+                    db.select(model.state, db.func.count()).group_by(model.state)
+                ).all()
+            )
+            counts["due"] = db.session.execute(due).scalar()
+            if min_priority is not None:
+                counts["due_priority"] = db.session.execute(
+                    due.where(model.priority >= min_priority)
+                ).scalar()
+        names = STATES + ("due",) + (("due_priority",) if min_priority is not None else ())
+        return {name: counts.get(name, 0) for name in names}
+
+
+class Budget:
+    """Jobs a run may still claim, shared by its workers"""
+
+    def __init__(self, total: int):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self, count: int) -> int:
+        """Reserve up to ``count`` jobs, returns how many were granted"""
+        with self._lock:
+            granted = min(count, self.remaining)
+            self.remaining -= granted
+            return granted
+
+    def give_back(self, count: int) -> None:
+        """Return a reservation that was not claimed"""
+        with self._lock:
+            self.remaining += count
+
+
+class DrainMeter:
+    """Jobs finished per second while draining a queue, shared by the workers"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, done: int = 0, failed: int = 0) -> None:
+        with self._lock:
+            self.done += done
+            self.failed += failed
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.done / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.done} done, {self.failed} failed in "
+            f"{time.perf_counter() - self.started:.1f}s ({self.rate:.1f} jobs/s)"
+        )
@@ -0,0 +1,91 @@
+"""Wall clock of an all-regions public contract sweep against the ESI stand-in.
+
+Runs ``ContractTasks.main`` (the real sweep, writes included) over synthetic
+regions served by ``esi_tools.standin`` into a scratch database, once per
+worker count. The second run of each is the steady state: every contract
+is known and only the snapshots are compared.
+
+    python -m benchmarks.contract_sweep --regions 68 --workers 1 8 16 --latency-ms 40
+
+The in-process stand-in generates its pages under the same GIL as the
+sweep. For numbers closer to the real ESI run it on its own and pass its URL:
+
+    python -m esi_tools.standin --port 8099 --latency-ms 40 --contract-pages 2
+    python -m benchmarks.contract_sweep --esi-url http://127.0.0.1:8099/latest
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from flask import Flask
+
+from apps import db, esi
+from apps.authentication.models import MapRegion
+from apps.tasks.modules.contracts import ContractTasks
+from esi_tools.standin import StandInServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="SQLAlchemy URL, a scratch SQLite file by default")
+    parser.add_argument("--regions", type=int, default=68, help="k-space regions have contracts")
+    parser.add_argument("--contract-pages", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--esi-url", help="a stand-in already running, instead of one in-process")
+    args = parser.parse_args()
+
+    server = None
+    if not args.esi_url:
+        server = StandInServer(
+            ("127.0.0.1", 0), latency=args.latency_ms / 1000, contract_pages=args.contract_pages
+        ).start()
+        args.esi_url = server.url
+    # public calls only need the async client settings of the shared EsiAuth
+    esi.operations = {"get_contracts_public_region_id": ("GET", "/contracts/public/{region_id}/")}
+    esi.async_settings = {"base_url": args.esi_url, "concurrency": 20, "user_agent": "benchmark"}
+
+    results = []
+    try:
+        for workers in args.workers:
+            scratch = None
+            url = args.db
+            if not url:
+                scratch = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+                url = f"sqlite:///{scratch}"
+            app = Flask(__name__)
+            app.config.update(SQLALCHEMY_DATABASE_URI=url, CONTRACT_SWEEP_WORKERS=workers)
+            db.init_app(app)
+            with app.app_context():
+                db.drop_all()
+                db.create_all()
+                db.session.add_all(
+                    MapRegion(regionID=10000001 + index, regionName=f"Region {index + 1}")
+                    for index in range(args.regions)
+                )
+                db.session.commit()
+
+            task = ContractTasks.__new__(ContractTasks)
+            task.scheduler, task.known = SimpleNamespace(app=app), {}
+            passes = []
+            for _ in range(2):
+                started = time.perf_counter()
+                task.main()
+                passes.append(time.perf_counter() - started)
+            results.append((workers, passes))
+            if scratch:
+                os.unlink(scratch)
+    finally:
+        if server:
+            server.stop()
+
+    print(f"\n{'workers':>8}{'first sweep':>14}{'steady sweep':>14}")
+    for workers, (first, steady) in results:
+        print(f"{workers:>8}{first:>13.1f}s{steady:>13.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Notification delivery against the Discord stand-in: per-message sends vs the dispatcher.
+
+Queues ``--notifications`` outbox rows spread over ``--users`` Discord users
+in a scratch database, then delivers them twice:
+
+* naive: what the tasks used to do, open the DM channel and post once per
+  notification, no rate limit handling;
+* dispatcher: ``DiscordDispatcher`` with its channel cache, per-user digests
+  and rate limit buckets.
+
+    python -m benchmarks.discord_dispatch --notifications 2000 --users 50 --latency-ms 80
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import httpx
+from flask import Flask
+
+from apps import db
+from apps.authentication.models import NotificationOutbox
+from apps.tasks.discord_dispatch import DiscordDispatcher
+from apps.tasks.outbox import WELCOME, enqueue, notification
+from esi_tools.discord_standin import DiscordStandInServer
+
+
+def make_app(url: str) -> Flask:
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=url, DISCORD_BOT_TOKEN="benchmark")
+    db.init_app(app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def queue(app: Flask, notifications: int, users: int) -> None:
+    enqueue(
+        app,
+        [
+            notification(
+                WELCOME,
+                index % users,
+                index,
+                {"content": f"Notification {index}"},
+                discord_user_id=str(100000000 + index % users),
+            )
+            for index in range(notifications)
+        ],
+    )
+
+
+def naive(app: Flask, client: httpx.Client) -> dict:
+    delivered = failed = 0
+    with app.app_context():
+        jobs = db.session.execute(db.select(NotificationOutbox)).scalars().all()
+    for job in jobs:
+        channel = client.post(
+            "/users/@me/channels", json={"recipient_id": job.discord_user_id}
+        )
+        if channel.status_code != 200:
+            failed += 1
+            continue
+        message = client.post(
+            f"/channels/{channel.json()['id']}/messages", json={"content": job.payload["content"]}
+        )
+        if message.status_code == 200:
+            delivered += 1
+        else:
+            failed += 1
+    return {"delivered": delivered, "failed": failed}
+
+
+def dispatcher(app: Flask, client: httpx.Client) -> dict:
+    sender = DiscordDispatcher(app, client=client)
+    while True:
+        if sender.dispatch():
+            continue
+        depth = sender.queue.depth()
+        if not depth["pending"] + depth["claimed"]:
+            break
+        # every recipient is waiting for a rate limit bucket
+        time.sleep(0.1)
+    return {"delivered": sender.meter.done, "failed": sender.meter.failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notifications", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=80)
+    args = parser.parse_args()
+
+    results = []
+    for name, deliver in (("naive", naive), ("dispatcher", dispatcher)):
+        server = DiscordStandInServer(("127.0.0.1", 0), latency=args.latency_ms / 1000).start()
+        scratch = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+        try:
+            app = make_app(f"sqlite:///{scratch}")
+            queue(app, args.notifications, args.users)
+            client = httpx.Client(
+                base_url=server.url, headers={"Authorization": "Bot benchmark"}, timeout=30
+            )
+            started = time.perf_counter()
+            outcome = deliver(app, client)
+            elapsed = time.perf_counter() - started
+            results.append((name, elapsed, outcome, dict(server.stats)))
+        finally:
+            server.stop()
+            os.unlink(scratch)
+
+    print(
+        f"\n{'':>11}{'seconds':>9}{'delivered':>11}{'failed':>8}{'requests':>10}"
+        f"{'messages':>10}{'429s':>6}"
+    )
+    for name, elapsed, outcome, stats in results:
+        print(
+            f"{name:>11}{elapsed:>9.1f}{outcome['delivered']:>11}{outcome['failed']:>8}"
+            f"{stats['requests']:>10}{stats['messages']:>10}{stats['rate_limited']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
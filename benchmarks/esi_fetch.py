@@ -0,0 +1,69 @@
+"""Market order fetch throughput against the local ESI stand-in.
+
+Starts ``esi_tools.standin`` in-process (synthetic data, or fixtures recorded
+with ``python -m esi_tools.standin --record``) and pulls every order page of
+a few regions through ``AsyncEsiClient``, reporting pages, rows and requests
+per second. Latency and error injection make the numbers comparable to the
+real ESI without depending on it.
+
+    python -m benchmarks.esi_fetch --regions 5 --latency-ms 40 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import time
+
+from esi_tools.async_client import AsyncEsiClient
+from esi_tools.standin import StandInServer
+
+REGIONS = [10000002, 10000043, 10000032, 10000030, 10000042, 10000016, 10000033, 10000064]
+
+
+async def fetch(base_url, regions, concurrency):
+    async with AsyncEsiClient(base_url=base_url, concurrency=concurrency, backoff=0.05) as client:
+        results = await asyncio.gather(
+            *(
+                client.fetch_pages("/markets/{region_id}/orders/", region_id=region_id,
+                                   order_type="all")
+                for region_id in regions
+            )
+        )
+        return results, client.governor.throttled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--regions", type=int, default=4)
+    parser.add_argument("--market-pages", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--fixtures", help="replay recorded responses from this directory")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        ("127.0.0.1", 0),
+        fixtures=args.fixtures,
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        market_pages=args.market_pages,
+    ).start()
+    try:
+        started = time.perf_counter()
+        results, throttled = asyncio.run(
+            fetch(server.url, REGIONS[: args.regions], args.concurrency)
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        server.stop()
+
+    pages = sum(len(region) for region in results)
+    rows = sum(len(page.data) for region in results for page in region)
+    print(f"{args.regions} regions, {pages} pages, {rows:,} orders in {elapsed:.2f}s")
+    print(f"  {pages / elapsed:,.1f} pages/s  {rows / elapsed:,.0f} rows/s  "
+          f"{server.requests / elapsed:,.1f} requests/s  ({server.requests} requests, "
+          f"{throttled} error limit pauses)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Rows/second decoded: pyswagger models vs the raw JSON fast path.
+
+Decodes synthetic market order pages (1000 orders each, like ESI) through
+the same pyswagger response esipy uses, then through ``esi_tools.raw``.
+Runs offline; pass ``--spec`` to use the stored ESI spec instead of the
+embedded market orders schema.
+
+    python -m benchmarks.raw_decode --pages 20
+"""
+
+import argparse
+import json
+import random
+import tempfile
+import time
+import os
+
+from esi_tools import raw
+from esi_tools.swagger import SpecStore
+
+ORDER_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "required": [
+            "duration", "is_buy_order", "issued", "location_id", "min_volume",
+            "order_id", "price", "range", "system_id", "type_id",
+            "volume_remain", "volume_total",
+        ],
+        "properties": {
+            "duration": {"type": "integer", "format": "int32"},
+            "is_buy_order": {"type": "boolean"},
+            "issued": {"type": "string", "format": "date-time"},
+            "location_id": {"type": "integer", "format": "int64"},
+            "min_volume": {"type": "integer", "format": "int32"},
+            "order_id": {"type": "integer", "format": "int64"},
+            "price": {"type": "number", "format": "double"},
+            "range": {"type": "string", "enum": ["station", "region", "solarsystem", "1", "2", "3", "4", "5", "10", "20", "30", "40"]},
+            "system_id": {"type": "integer", "format": "int32"},
+            "type_id": {"type": "integer", "format": "int32"},
+            "volume_remain": {"type": "integer", "format": "int32"},
+            "volume_total": {"type": "integer", "format": "int32"},
+        },
+    },
+}
+
+SPEC = {
+    "swagger": "2.0",
+    "info": {"title": "benchmark", "version": "0"},
+    "host": "esi.evetech.net",
+    "basePath": "/latest",
+    "schemes": ["https"],
+    "paths": {
+        "/markets/{region_id}/orders/": {
+            "get": {
+                "operationId": "get_markets_region_id_orders",
+                "parameters": [
+                    {"name": "region_id", "in": "path", "required": True, "type": "integer"},
+                    {"name": "page", "in": "query", "type": "integer"},
+                ],
+                "responses": {"200": {"description": "orders", "schema": ORDER_SCHEMA}},
+            }
+        }
+    },
+}
+
+
+def make_page(rows: int) -> bytes:
+    orders = [
+        {
+            "duration": 90,
+            "is_buy_order": random.random() < 0.5,
+            "issued": "2024-05-%02dT%02d:%02d:11Z" % (random.randint(1, 28), random.randint(0, 23), random.randint(0, 59)),
+            "location_id": 60003760,
+            "min_volume": 1,
+            "order_id": 6000000000 + i,
+            "price": round(random.uniform(1, 1e9), 2),
+            "range": "region",
+            "system_id": 30000142,
+            "type_id": random.randint(18, 60000),
+            "volume_remain": random.randint(1, 10000),
+            "volume_total": 10000,
+        }
+        for i in range(rows)
+    ]
+    return json.dumps(orders).encode()
+
+
+def load_app(spec_path):
+    if spec_path:
+        return SpecStore(spec_path).load_app()
+    from pyswagger import App
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as handle:
+        json.dump(SPEC, handle)
+    try:
+        app = App.load(handle.name)
+        app.prepare()
+    finally:
+        os.unlink(handle.name)
+    return app
+
+
+def bench(name, pages, rows, decode):
+    started = time.perf_counter()
+    for page in pages:
+        decode(page)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<34} {rows / elapsed:>12,.0f} rows/s  ({elapsed:.2f}s)")
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=1000, help="orders per page")
+    parser.add_argument("--spec", help="path of a stored ESI swagger spec")
+    args = parser.parse_args()
+
+    app = load_app(args.spec)
+    pages = [make_page(args.rows) for _ in range(args.pages)]
+    total = args.pages * args.rows
+
+    def pyswagger_models(page):
+        _, response = app.op["get_markets_region_id_orders"](region_id=10000002, page=1)
+        response.raw_body_only = False
+        response.apply_with(status=200, raw=page, header={})
+        return [order.price for order in response.data]
+
+    converters = {"issued": raw.parse_datetime}
+    fields = list(ORDER_SCHEMA["items"]["properties"])
+
+    print(f"{args.pages} pages x {args.rows} orders, orjson: {raw.loads is not json.loads}")
+    before = bench("pyswagger models (before)", pages, total, pyswagger_models)
+    bench("json.loads", pages, total, json.loads)
+    after = bench("raw.decode -> dicts (after)", pages, total, lambda p: raw.decode(p, converters=converters))
+    bench("raw.decode -> tuples", pages, total, lambda p: raw.decode(p, fields, converters))
+    print(f"speedup: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
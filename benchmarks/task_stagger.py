@@ -0,0 +1,126 @@
+"""ESI requests per minute of the character tasks: hourly bursts vs staggered ticks.
+
+Simulates ``--hours`` of the skills, blueprints and mining ledger tasks for
+``--characters`` characters on a fake clock, no ESI or database involved:
+
+* hourly: what the tasks used to do, every character of every task at the
+  top of the hour;
+* staggered: ticks every TASK_TICK_SECONDS with the scheduler's jitter,
+  each taking its ``CharacterShard`` of the characters due on the
+  ``next_refresh`` schedule. ``--active`` of the characters change on
+  every refresh, the others every ``--idle-hours``.
+
+Requests are counted per minute with ``RequestMeter`` over the last
+``--hours``, after an hour of warm-up; the report shows the mean and peak
+minute and their ratio (1.0 is perfectly flat).
+
+    python -m benchmarks.task_stagger --characters 2000 --hours 6
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from apps.tasks.refresh import next_refresh
+from apps.tasks.stagger import CharacterShard
+from esi_tools.async_client import RequestMeter
+
+# task -> (requests per character, ESI cache time in seconds)
+TASKS = {
+    "get_characters_character_id_skills": (2, 120),
+    "get_characters_character_id_blueprints": (1, 3600),
+    "get_characters_character_id_mining": (1, 600),
+}
+
+START = datetime(2026, 1, 1)
+
+
+def hourly(characters: list, hours: int) -> RequestMeter:
+    meter = RequestMeter(window=hours * 60)
+    end = START.timestamp() + (hours + 1) * 3600
+    for hour in range(hours + 1):
+        moment = START.timestamp() + hour * 3600
+        for requests, _ in TASKS.values():
+            meter.add(requests * len(characters), now=moment)
+    meter.add(0, now=end - 1)
+    return meter
+
+
+def staggered(characters: list, hours: int, args) -> RequestMeter:
+    meter = RequestMeter(window=hours * 60)
+    rng = random.Random(1)
+    shortest = timedelta(minutes=args.min_minutes)
+    longest = timedelta(hours=args.max_hours)
+    active = set(rng.sample([c.character_id for c in characters], int(len(characters) * args.active)))
+    # when the idle characters last changed before the simulation starts
+    last_change = {
+        c.character_id: START - timedelta(hours=rng.uniform(0, args.idle_hours))
+        for c in characters
+    }
+
+    # next tick of each task, the first at a random offset like the scheduler's
+    ticks = {endpoint: rng.uniform(0, args.tick) for endpoint in TASKS}
+    shards = {endpoint: CharacterShard(args.window, args.tick, endpoint) for endpoint in TASKS}
+    schedule = {endpoint: {} for endpoint in TASKS}
+    end = (hours + 1) * 3600
+
+    while True:
+        endpoint, offset = min(ticks.items(), key=lambda item: item[1])
+        if offset >= end:
+            break
+        now = START + timedelta(seconds=offset)
+        requests, cache_seconds = TASKS[endpoint]
+        entries = schedule[endpoint]
+        due = [c for c in characters if entries.get(c.character_id, (None, None))[0] is None
+               or entries[c.character_id][0] <= now]
+        for character in shards[endpoint].take(due, now=now.timestamp()):
+            meter.add(requests, now=now.timestamp())
+            _, changed_at = entries.get(
+                character.character_id, (None, last_change[character.character_id])
+            )
+            if (character.character_id in active
+                    or now - changed_at >= timedelta(hours=args.idle_hours)):
+                changed_at = now
+            entries[character.character_id] = (
+                next_refresh(now, now + timedelta(seconds=cache_seconds), changed_at,
+                             shortest, longest),
+                changed_at,
+            )
+        ticks[endpoint] = offset + args.tick + rng.uniform(0, args.jitter)
+    meter.add(0, now=(START + timedelta(seconds=end - 1)).timestamp())
+    return meter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--characters", type=int, default=2000)
+    parser.add_argument("--hours", type=int, default=6)
+    parser.add_argument("--active", type=float, default=0.1)
+    parser.add_argument("--idle-hours", type=float, default=48)
+    parser.add_argument("--window", type=int, default=300, help="REFRESH_POLL_SECONDS")
+    parser.add_argument("--tick", type=int, default=30, help="TASK_TICK_SECONDS")
+    parser.add_argument("--jitter", type=int, default=10, help="TASK_JITTER_SECONDS")
+    parser.add_argument("--min-minutes", type=int, default=15, help="REFRESH_MIN_MINUTES")
+    parser.add_argument("--max-hours", type=int, default=24, help="REFRESH_MAX_HOURS")
+    args = parser.parse_args()
+
+    characters = [SimpleNamespace(character_id=100000 + index) for index in range(args.characters)]
+    print(f"\n{'':>11}{'requests':>10}{'per hour':>10}{'mean/min':>10}{'peak/min':>10}"
+          f"{'peak/mean':>11}{'idle min':>10}")
+    for name, meter in (
+        ("hourly", hourly(characters, args.hours)),
+        ("staggered", staggered(characters, args.hours, args)),
+    ):
+        end = (START + timedelta(hours=args.hours + 1)).timestamp() - 1
+        summary = meter.summary(now=end)
+        idle = sum(1 for count in meter.per_minute(now=end) if not count)
+        print(
+            f"{name:>11}{summary['requests']:>10,}{summary['requests'] / args.hours:>10,.0f}"
+            f"{summary['mean']:>10.1f}{summary['peak']:>10,}{summary['peak_ratio']:>11.2f}"
+            f"{idle:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Rows/second written by the scheduled tasks: merge-per-row vs bulk upsert.
+
+Builds the rows each task writes (from the ESI stand-in's synthetic data)
+and saves them twice into a scratch database: the old way, one
+``db.session.merge`` and commit per row in its own app context, and through
+``apps.tasks.bulk``. The second pass of each runs over existing rows, which
+is the steady state of an hourly task.
+
+    python -m benchmarks.task_writes --db sqlite:////tmp/bench.sqlite3
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+from flask import Flask
+
+from apps import db
+from apps.authentication.models import (
+    Blueprints,
+    Contract,
+    ContractItem,
+    MarketHistory,
+    MiningLedger,
+    SkillSet,
+)
+from apps.tasks.bulk import WriteStats, bulk_insert, bulk_upsert
+from esi_tools.raw import parse_date, parse_datetime
+from esi_tools.standin import StandInServer
+
+import time
+
+
+def synthetic(server, path, **query):
+    status, body, _, _ = server.synthetic(path, {k: str(v) for k, v in query.items()})
+    return json.loads(body) if body else []
+
+
+def task_rows(server, characters, regions):
+    """(task, model, rows, upsert keys or None for plain inserts)"""
+    skills, blueprints, mining = [], [], []
+    for character_id in range(90000001, 90000001 + characters):
+        data = synthetic(server, f"/characters/{character_id}/skills/")
+        skills.append({"character_id": character_id, "total_sp": data["total_sp"],
+                       "unallocated_sp": data["unallocated_sp"]})
+        for row in synthetic(server, f"/characters/{character_id}/blueprints/"):
+            blueprints.append(dict(row, character_id=character_id))
+        for row in synthetic(server, f"/characters/{character_id}/mining/"):
+            mining.append(dict(row, character_id=character_id, date=parse_date(row["date"])))
+
+    contracts, items = [], []
+    for region_id in regions:
+        for row in synthetic(server, f"/contracts/public/{region_id}/"):
+            contracts.append({
+                "id": row["contract_id"], "buyout": row.get("buyout"),
+                "collateral": row.get("collateral"),
+                "date_expired": parse_datetime(row["date_expired"]),
+                "date_issued": parse_datetime(row["date_issued"]),
+                "days_to_complete": row.get("days_to_complete"),
+                "end_location_id": row.get("end_location_id"),
+                "for_corporation": row.get("for_corporation", False),
+                "issuer_corporation_id": row.get("issuer_corporation_id"),
+                "issuer_id": row.get("issuer_id"), "price": row.get("price"),
+                "reward": row.get("reward"), "start_location_id": row.get("start_location_id"),
+                "title": row.get("title"), "type": row.get("type"), "volume": row.get("volume"),
+            })
+        for contract in contracts[-200:]:
+            for row in synthetic(server, f"/contracts/public/items/{contract['id']}/"):
+                items.append({
+                    "contract_id": contract["id"], "record_id": row["record_id"],
+                    "is_blueprint_copy": row.get("is_blueprint_copy"),
+                    "is_included": row["is_included"], "item_id": row.get("item_id"),
+                    "material_efficiency": row.get("material_efficiency"),
+                    "quantity": row["quantity"], "runs": row.get("runs"),
+                    "time_efficiency": row.get("time_efficiency"), "type_id": row["type_id"],
+                })
+
+    history = []
+    for type_id in (34, 35, 36):
+        for row in synthetic(server, "/markets/10000002/history/", type_id=type_id):
+            history.append(dict(row, typeID=type_id, regionID=10000002,
+                                date=parse_date(row["date"]),
+                                updated_date=parse_datetime("2024-01-01T00:00:00Z")))
+
+    return [
+        ("skills", SkillSet, skills, ["character_id"]),
+        ("blueprints", Blueprints, blueprints, ["item_id"]),
+        ("mining_ledger", MiningLedger, mining, None),
+        ("market_history", MarketHistory, history, None),
+        ("contracts", Contract, contracts, ["id"]),
+        ("contract_items", ContractItem, items, ["record_id"]),
+    ]
+
+
+def merge_per_row(app, model, rows, keys):
+    started = time.perf_counter()
+    for row in rows:
+        with app.app_context():
+            if keys and keys != [column.name for column in model.__table__.primary_key]:
+                # natural key that isn't the primary key, what skills.py used to do
+                existing = model.query.filter_by(**{key: row[key] for key in keys}).first()
+                if existing:
+                    for name, value in row.items():
+                        setattr(existing, name, value)
+                    db.session.commit()
+                    continue
+            db.session.merge(model(**row))
+            db.session.commit()
+    return WriteStats(len(rows), len(rows), time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="SQLAlchemy URL, a scratch SQLite file by default")
+    parser.add_argument("--characters", type=int, default=5)
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    scratch = None
+    if not args.db:
+        scratch = tempfile.NamedTemporaryFile(suffix=".sqlite3", delete=False).name
+        args.db = f"sqlite:///{scratch}"
+
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=args.db, TASK_WRITE_CHUNK_SIZE=args.chunk_size)
+    db.init_app(app)
+
+    server = StandInServer(("127.0.0.1", 0), contract_pages=1)
+    tables = task_rows(server, args.characters, [10000002, 10000043][: args.regions])
+    server.server_close()
+
+    print(f"{'task':<16}{'rows':>8}{'merge rows/s':>16}{'bulk rows/s':>16}{'speedup':>10}")
+    try:
+        for name, model, rows, keys in tables:
+            results = []
+            for write in ("merge", "bulk"):
+                with app.app_context():
+                    db.drop_all()
+                    db.create_all()
+                passes = []
+                for _ in range(2):
+                    if write == "merge":
+                        passes.append(merge_per_row(app, model, rows, keys))
+                    elif keys is None:
+                        passes.append(bulk_insert(app, model, rows))
+                    else:
+                        passes.append(bulk_upsert(app, model, rows, keys=keys))
+                seconds = sum(stats.seconds for stats in passes)
+                results.append(2 * len(rows) / seconds if seconds else 0.0)
+            print(f"{name:<16}{len(rows):>8}{results[0]:>16,.0f}{results[1]:>16,.0f}"
+                  f"{results[1] / results[0]:>9.1f}x")
+    finally:
+        if scratch:
+            os.unlink(scratch)
+
+
+if __name__ == "__main__":
+    main()
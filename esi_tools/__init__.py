@@ -0,0 +1,5 @@
+"""Shared ESI plumbing used by the Flask app and the standalone market scripts.
+
+Nothing in here imports Flask or the app models, so ``market_dumper`` and
+``update_markets_refined.py`` can use it without booting the web app.
+"""
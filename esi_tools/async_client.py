@@ -0,0 +1,436 @@
+"""Asyncio ESI client for fanning out many requests.
+
+esipy blocks a thread per request, which is fine for a handful of calls but
+not for hundreds of market or contract pages. ``AsyncEsiClient`` runs them on
+one event loop over a pooled ``httpx`` connection, bounded by a semaphore,
+retried with backoff and throttled by ``ErrorLimitGovernor`` before ESI's
+error limit runs out.
+
+Operations are addressed by the same names esipy uses
+(``get_markets_region_id_orders`` ...), resolved from the swagger spec::
+
+    async with AsyncEsiClient(operations=load_operations(spec)) as client:
+        res = await client.request("get_markets_region_id_history",
+                                   region_id=10000002, type_id=34)
+
+Paginated operations are walked with ``paginate``: the first page tells how
+many there are (``X-Pages``), the others are requested concurrently and
+yielded as they arrive::
+
+        async for page in client.paginate("get_contracts_public_region_id",
+                                          region_id=10000002):
+            save(page.data)
+
+ESI serves every page of a list from one snapshot, identified by its
+``Last-Modified`` header. If the snapshot changes half way (the cache expired
+between two pages) the walk starts over, so consumers must be idempotent
+(upserts by key) or use ``fetch_pages`` which only returns a consistent set.
+"""
+
+import asyncio
+import functools
+import logging
+import random
+import re
+import ssl
+import threading
+import time
+from collections import deque, namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import certifi
+import httpx
+
+from esi_tools.cache import CachedResponse, expires_in, make_key
+from esi_tools.raw import convert, loads
+
+LOGGER = logging.getLogger(__name__)
+
+ESI_BASE_URL = "https://esi.evetech.net/latest"
+RETRY_STATUSES = {420, 500, 502, 503, 504}
+
+EsiResponse = namedtuple("EsiResponse", ["status", "headers", "data", "url"])
+EsiPage = namedtuple("EsiPage", ["page", "pages", "data", "headers", "snapshot", "attempt"])
+
+_PATH_PARAM = re.compile(r"{(\w+)}")
+
+
+class EsiError(RuntimeError):
+    """An ESI request failed after all retries"""
+
+    def __init__(self, url: str, status: int, message: str = ""):
+        super().__init__(f"ESI request {url} failed with {status}: {message}")
+        self.url = url
+        self.status = status
+
+
+class SnapshotError(EsiError):
+    """The pages of a list kept coming from different snapshots"""
+
+
+def snapshot_of(headers) -> Optional[str]:
+    """What identifies the ESI snapshot a page was served from"""
+    return headers.get("last-modified") or headers.get("expires")
+
+
+@functools.lru_cache(maxsize=None)
+def ssl_context() -> ssl.SSLContext:
+    """One verified TLS context for every client.
+
+    Loading the CA bundle takes tens of milliseconds of CPU; a client per
+    region or per task run would pay it each time, under the GIL.
+    """
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+def load_operations(spec: dict) -> Dict[str, Tuple[str, str]]:
+    """Map operation ids to ``(METHOD, path)`` from a swagger spec dict"""
+    operations = {}
+    for path, methods in spec.get("paths", {}).items():
+        for method, operation in methods.items():
+            if isinstance(operation, dict) and "operationId" in operation:
+                operations[operation["operationId"]] = (method.upper(), path)
+    return operations
+
+
+def operations_from_app(app) -> Dict[str, Tuple[str, str]]:
+    """Same mapping as ``load_operations`` from an already parsed pyswagger App"""
+    return {
+        name: (op.method.upper(), op.path)
+        for name, op in app.op.items()
+        if getattr(op, "path", None)
+    }
+
+
+class ErrorLimitGovernor:
+    """Keeps us away from the ESI error limit.
+
+    ESI answers every request with ``X-ESI-Error-Limit-Remain`` (errors left
+    in the window) and ``X-ESI-Error-Limit-Reset`` (seconds until the window
+    resets). Once the remaining budget drops to ``threshold`` every request
+    waits for the reset instead of risking a 420 ban.
+    """
+
+    def __init__(self, threshold: int = 20):
+        self.threshold = threshold
+        self.remain = None
+        self.reset_at = 0.0
+        self.throttled = 0
+
+    def update(self, headers) -> None:
+        remain = headers.get("x-esi-error-limit-remain")
+        reset = headers.get("x-esi-error-limit-reset")
+        if remain is None or reset is None:
+            return
+        self.remain = int(remain)
+        self.reset_at = time.monotonic() + int(reset)
+
+    async def wait(self) -> None:
+        while self.remain is not None and self.remain <= self.threshold:
+            delay = self.reset_at - time.monotonic()
+            if delay <= 0:
+                self.remain = None
+                break
+            self.throttled += 1
+            LOGGER.warning("ESI error limit at %s, pausing %.1fs", self.remain, delay)
+            await asyncio.sleep(delay + random.uniform(0, 1))
+
+
+class RequestMeter:
+    """Requests sent per minute, over the last ``window`` minutes.
+
+    Shared by every client like the governor, so the scheduler can report
+    how evenly the tasks spread their calls.
+    """
+
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.total = 0
+        self._minutes = deque()
+        self._lock = threading.Lock()
+
+    def add(self, count: int = 1, now: Optional[float] = None) -> None:
+        minute = int((time.time() if now is None else now) // 60)
+        with self._lock:
+            self.total += count
+            if self._minutes and self._minutes[-1][0] == minute:
+                self._minutes[-1][1] += count
+            else:
+                self._minutes.append([minute, count])
+            while self._minutes[0][0] <= minute - self.window:
+                self._minutes.popleft()
+
+    def per_minute(self, now: Optional[float] = None) -> List[int]:
+        """Requests of each of the last ``window`` minutes, oldest first"""
+        current = int((time.time() if now is None else now) // 60)
+        with self._lock:
+            counts = dict((minute, count) for minute, count in self._minutes)
+        return [counts.get(minute, 0) for minute in range(current - self.window + 1, current + 1)]
+
+    def summary(self, now: Optional[float] = None) -> dict:
+        """requests, mean and peak per minute, and peak / mean (1.0 is perfectly flat)"""
+        counts = self.per_minute(now)
+        requests = sum(counts)
+        mean = requests / len(counts)
+        peak = max(counts)
+        return {
+            "requests": requests,
+            "mean": mean,
+            "peak": peak,
+            "peak_ratio": peak / mean if mean else 0.0,
+        }
+
+
+class AsyncEsiClient:
+    """Concurrent ESI client.
+
+    Args:
+        operations (dict): ``load_operations`` output, needed to call by name.
+        base_url (str): ESI root, swap for a local stand-in when benchmarking.
+        concurrency (int): Maximum requests in flight (and pooled connections).
+        retries (int): Attempts after the first for timeouts, 5xx and 420.
+        backoff (float): Base delay of the exponential backoff, in seconds.
+        timeout (float): Per request timeout, in seconds.
+        user_agent (str): Sent with every request, CCP asks for a contact.
+        cache (EsiResponseCache): Optional shared response cache.
+        governor (ErrorLimitGovernor): Shared error limit state.
+        meter (RequestMeter): Counts the requests sent, optional.
+    """
+
+    def __init__(
+        self,
+        operations: Optional[dict] = None,
+        base_url: str = ESI_BASE_URL,
+        concurrency: int = 20,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30,
+        user_agent: str = "eve-blue-zoo",
+        cache=None,
+        governor: Optional[ErrorLimitGovernor] = None,
+        meter: Optional[RequestMeter] = None,
+    ):
+        self.operations = operations or {}
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.cache = cache
+        self.governor = governor or ErrorLimitGovernor()
+        self.meter = meter
+
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        limits = httpx.Limits(
+            max_connections=self.concurrency, max_keepalive_connections=self.concurrency
+        )
+        self._client = httpx.AsyncClient(
+            verify=ssl_context(),
+            limits=limits,
+            timeout=self.timeout,
+            headers={"User-Agent": self.user_agent, "Accept": "application/json"},
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._client.aclose()
+        self._client = None
+
+    def resolve(self, operation: str, params: dict) -> Tuple[str, dict]:
+        """Build the URL and query string of ``operation``.
+
+        ``operation`` is an esipy operation id, or a raw path such as
+        ``/markets/{region_id}/orders/``. Parameters used in the path are
+        removed, the rest becomes the query string.
+        """
+        if operation.startswith("/"):
+            path = operation
+        else:
+            try:
+                method, path = self.operations[operation]
+            except KeyError:
+                raise KeyError(f"Unknown ESI operation '{operation}'") from None
+            if method != "GET":
+                raise ValueError(f"Only GET operations are supported, not {operation}")
+
+        query = dict(params)
+        path = _PATH_PARAM.sub(lambda match: str(query.pop(match.group(1))), path)
+        query.setdefault("datasource", "tranquility")
+        return self.base_url + path, query
+
+    async def request(self, operation: str, token: Optional[str] = None,
+                      converters: Optional[dict] = None, **params) -> EsiResponse:
+        """GET ``operation`` and decode its JSON body.
+
+        Args:
+            operation (str): Operation id or raw path.
+            token (str): Access token for authenticated endpoints.
+            converters (dict): field -> callable applied to list rows, see
+                ``esi_tools.raw.decode``.
+            **params: Path and query parameters.
+
+        Raises:
+            EsiError: When ESI keeps failing or answers with a client error.
+        """
+        url, query = self.resolve(operation, params)
+        res = await self._get(url, query, token)
+        if res.status_code >= 400:
+            raise EsiError(url, res.status_code, res.content[:200])
+        data = loads(res.content) if res.content else None
+        if converters and isinstance(data, list):
+            convert(data, converters)
+        return EsiResponse(res.status_code, res.headers, data, url)
+
+    async def paginate(self, operation: str, token: Optional[str] = None,
+                       converters: Optional[dict] = None, snapshot_retries: int = 2,
+                       **params):
+        """Yield every page of ``operation`` as an ``EsiPage``, as they arrive.
+
+        Page 1 comes first, the rest in completion order. When a page belongs
+        to another snapshot than page 1 (or ``X-Pages`` changed) the pending
+        pages are dropped and the walk starts over, with ``attempt`` increased.
+
+        Raises:
+            EsiError: A page failed.
+            SnapshotError: The snapshot still changed after ``snapshot_retries``.
+        """
+        for attempt in range(snapshot_retries + 1):
+            first = await self.request(operation, token=token, converters=converters,
+                                       page=1, **params)
+            pages = int(first.headers.get("x-pages") or 1)
+            snapshot = snapshot_of(first.headers)
+            yield EsiPage(1, pages, first.data or [], first.headers, snapshot, attempt)
+
+            async def fetch(page):
+                return page, await self.request(operation, token=token,
+                                                converters=converters, page=page, **params)
+
+            tasks = [asyncio.ensure_future(fetch(page)) for page in range(2, pages + 1)]
+            drifted = None
+            try:
+                for future in asyncio.as_completed(tasks):
+                    page, res = await future
+                    if (snapshot_of(res.headers) != snapshot
+                            or int(res.headers.get("x-pages") or pages) != pages):
+                        drifted = page
+                        break
+                    yield EsiPage(page, pages, res.data or [], res.headers, snapshot, attempt)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            if drifted is None:
+                return
+            LOGGER.warning("%s page %d is from another snapshot than page 1, starting over",
+                           first.url, drifted)
+
+        raise SnapshotError(first.url, 0, f"snapshot changed {snapshot_retries + 1} times")
+
+    async def fetch_pages(self, operation: str, token: Optional[str] = None,
+                          converters: Optional[dict] = None, snapshot_retries: int = 2,
+                          **params) -> List[EsiPage]:
+        """All pages of one consistent snapshot, in page order"""
+        pages = {}
+        async for page in self.paginate(operation, token=token, converters=converters,
+                                        snapshot_retries=snapshot_retries, **params):
+            if page.page == 1:
+                pages = {}
+            pages[page.page] = page
+        return [pages[number] for number in sorted(pages)]
+
+    async def gather(self, calls: Iterable[Tuple[str, dict]], token: Optional[str] = None,
+                     return_exceptions: bool = True,
+                     converters: Optional[dict] = None) -> List:
+        """Run ``(operation, params)`` calls concurrently, results keep the input order"""
+        return await asyncio.gather(
+            *(
+                self.request(operation, token=token, converters=converters, **params)
+                for operation, params in calls
+            ),
+            return_exceptions=return_exceptions,
+        )
+
+    async def _get(self, url: str, query: dict, token: Optional[str]) -> CachedResponse:
+        """Cached, throttled and retried GET"""
+        # the token is left out of the key, the character id is part of the URL
+        key = make_key(url, query) if self.cache is not None else None
+        # the cache is SQLite shared with other processes: a lock wait on the
+        # loop would stall every request in flight
+        cached = await asyncio.to_thread(self.cache.get, key) if key else None
+        headers = {}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if cached is not None:
+            if expires_in(cached.headers) >= 0:
+                return cached
+            if cached.headers.get("etag"):
+                headers["If-None-Match"] = cached.headers["etag"]
+
+        res = await self._send(url, query, headers)
+
+        if res.status_code == 304 and cached is not None:
+            cached.headers.update(
+                {name: res.headers[name] for name in ("Expires", "Date", "ETag") if name in res.headers}
+            )
+            response = cached
+        else:
+            response = CachedResponse(res.status_code, res.headers, res.content, str(res.url))
+
+        if key and response.status_code == 200 and expires_in(response.headers) >= 0:
+            await asyncio.to_thread(self.cache.set, key, response, expires_in(response.headers))
+        return response
+
+    async def _send(self, url: str, query: dict, headers: dict) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self.governor.wait()
+            if self.meter is not None:
+                self.meter.add()
+            try:
+                async with self._semaphore:
+                    res = await self._client.get(url, params=query, headers=headers)
+            except httpx.TransportError as error:
+                if attempt >= self.retries:
+                    raise EsiError(url, 0, str(error)) from error
+                LOGGER.warning("[failure #%d] %s: %s", attempt + 1, url, error)
+            else:
+                self.governor.update(res.headers)
+                if res.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return res
+                LOGGER.warning("[failure #%d] %s %d", attempt + 1, url, res.status_code)
+
+            attempt += 1
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff))
+
+
+def run(coro):
+    """Run ``coro`` to completion from synchronous code (scheduler threads, scripts)"""
+    return asyncio.run(coro)
+
+
+def iterate(factory):
+    """Consume an async iterator from synchronous code.
+
+    ``factory`` is called with no arguments inside a private event loop and
+    returns the async iterator (usually an ``async with`` client around
+    ``paginate``). Outstanding requests make progress while the loop waits
+    for the next item.
+    """
+    loop = asyncio.new_event_loop()
+    iterator = factory()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
@@ -0,0 +1,388 @@
+"""Persistent ESI response cache.
+
+Responses are kept in one SQLite file so every gunicorn worker and the
+standalone scripts share what ESI already told us is fresh. The cache speaks
+the ``esipy`` cache interface (``get``/``set``/``invalidate``), which lets
+``EsiClient`` handle ``Expires`` and ``If-None-Match`` for us, and
+``conditional_get`` gives plain ``requests`` callers the same behaviour.
+
+Entries are not dropped when they expire: a stale entry still carries the
+ETag needed to turn the next download into a 304. Space is bounded instead,
+evicting the least recently used entries once ``max_bytes`` is exceeded.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+from requests.structures import CaseInsensitiveDict
+
+try:
+    from esipy.cache import BaseCache
+except ImportError:  # market_dumper does not install esipy
+    BaseCache = object
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "bluezoo-esi-cache.sqlite3")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Same shape as esipy.client.CachedResponse, esipy only reads the attributes
+CachedResponse = namedtuple("CachedResponse", ["status_code", "headers", "content", "url"])
+
+# LRU order only needs to be roughly right, this saves a write on most hits
+ACCESS_RESOLUTION = 60
+
+COUNTERS = ("hits", "revalidated", "misses", "bytes_served", "bytes_stored", "evictions")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def expires_in(headers) -> float:
+    """Seconds left before the ``Expires`` header, negative when stale or missing."""
+    expires = headers.get("expires") if headers else None
+    if not expires:
+        return -1
+    try:
+        return parsedate_to_datetime(expires).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return -1
+
+
+def expires_at(headers):
+    """The ``Expires`` header as a naive UTC datetime, None when missing or invalid.
+
+    pyswagger responses (``esi.get_esi``) keep a list of values per header,
+    the first one is used.
+    """
+    expires = (headers.get("expires") or headers.get("Expires")) if headers else None
+    if isinstance(expires, (list, tuple)):
+        expires = expires[0] if expires else None
+    if not expires:
+        return None
+    try:
+        return parsedate_to_datetime(expires).astimezone(timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_key(url: str, params=None) -> str:
+    """Cache key for a plain GET of ``url`` with ``params``."""
+    items = sorted((str(k), str(v)) for k, v in (params or {}).items())
+    return _digest(repr(("GET", url, items)))
+
+
+def _digest(data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def _normalize_key(key) -> str:
+    """Turn an esipy cache key into a stable string.
+
+    esipy keys are ``(url, headers, path, query)`` built from frozensets, whose
+    pickled form changes between processes. Sorting makes the key identical
+    in every worker, and the bearer token is dropped so a token refresh does
+    not orphan a character's cached responses (the character id is already
+    part of the URL).
+    """
+    if isinstance(key, str):
+        return key
+    url, headers, path, query = key
+    headers = sorted(
+        repr(item) for item in headers if str(item[0]).lower() != "authorization"
+    )
+    return _digest(
+        repr((url, headers, sorted(map(repr, path)), sorted(map(repr, query))))
+    )
+
+
+class EsiResponseCache(BaseCache):
+    """SQLite backed, size bounded LRU cache for ESI responses.
+
+    Args:
+        path (str): Location of the SQLite file, shared by all processes.
+        max_bytes (int): Upper bound for the stored payloads.
+        flush_interval (float): How often the in-process counters are folded
+            into the shared totals.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, flush_interval=5.0):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.flush_interval = flush_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}  # stale keys handed out for revalidation -> digest
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._last_flush = time.monotonic()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    # Connection handling
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread and per process (gunicorn forks workers)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    # esipy interface
+
+    def get(self, key, default=None):
+        """Return the cached response for ``key``.
+
+        Expired entries are still returned so esipy can revalidate them with
+        their ETag; whether that ends in a 304 is settled in ``set``.
+        """
+        key = _normalize_key(key)
+        row = self._connection().execute(
+            "SELECT value, size, digest, expires_at, last_access FROM entries WHERE key = ?",
+            (key,),
+        ).fetchone()
+
+        if row is None:
+            self._count(misses=1)
+            return default
+
+        value, size, digest, expires_at, last_access = row
+        now = time.time()
+        if now - last_access > ACCESS_RESOLUTION:
+            self._connection().execute(
+                "UPDATE entries SET last_access = ? WHERE key = ?", (now, key)
+            )
+        if expires_at > now:
+            self._count(hits=1, bytes_served=size)
+        else:
+            with self._lock:
+                self._pending[key] = digest
+
+        status_code, headers, content, url = pickle.loads(value)
+        return CachedResponse(status_code, CaseInsensitiveDict(headers), content, url)
+
+    def set(self, key, value, expire=300):
+        """Store a response, ``expire`` is the number of seconds it is fresh."""
+        key = _normalize_key(key)
+        blob = pickle.dumps(
+            (value.status_code, dict(value.headers), value.content, value.url),
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        digest = _digest(value.content or b"")
+        size = len(blob)
+        now = time.time()
+
+        with self._lock:
+            pending_digest = self._pending.pop(key, None)
+        if pending_digest == digest:
+            # 304 Not Modified, esipy hands back our own body with new headers
+            self._count(revalidated=1, bytes_served=size)
+        else:
+            self._count(misses=int(pending_digest is not None), bytes_stored=size)
+
+        with self._transaction() as conn:
+            old = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (key, value, size, digest, expires_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, blob, size, digest, now + (expire or 0), now),
+            )
+            self._adjust(conn, "stored_bytes", size - (old[0] if old else 0))
+            evicted = self._evict(conn)
+        if evicted:
+            self._count(evictions=evicted)
+
+    def invalidate(self, key):
+        key = _normalize_key(key)
+        with self._lock:
+            if self._pending.pop(key, None) is not None:
+                self._count(misses=1)
+
+        with self._transaction() as conn:
+            old = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._adjust(conn, "stored_bytes", -old[0])
+
+    # Housekeeping
+
+    def _evict(self, conn) -> int:
+        """Drop least recently used entries until we fit in ``max_bytes``."""
+        stored = self._read(conn, "stored_bytes")
+        evicted = 0
+        while stored > self.max_bytes:
+            rows = conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                stored -= size
+                evicted += 1
+                if stored <= self.max_bytes:
+                    break
+        if evicted:
+            self._set(conn, "stored_bytes", stored)
+        return evicted
+
+    def _count(self, **deltas) -> None:
+        with self._lock:
+            for name, delta in deltas.items():
+                self._counters[name] += delta
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Fold this process' counters into the shared totals."""
+        with self._lock:
+            counters, self._counters = self._counters, dict.fromkeys(COUNTERS, 0)
+            self._last_flush = time.monotonic()
+        if not any(counters.values()):
+            return
+        with self._transaction() as conn:
+            for name, delta in counters.items():
+                if delta:
+                    self._adjust(conn, name, delta)
+
+    @staticmethod
+    def _read(conn, name) -> int:
+        row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _set(conn, name, value) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value)
+        )
+
+    @staticmethod
+    def _adjust(conn, name, delta) -> None:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, delta),
+        )
+
+    def stats(self) -> dict:
+        """Hit/miss/byte counters summed over every process using the file.
+
+        A 304 revalidation counts as a hit, it saved the download.
+        """
+        self.flush()
+        conn = self._connection()
+        totals = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        stats = {name: totals.get(name, 0) for name in COUNTERS}
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        stats["stored_bytes"] = totals.get("stored_bytes", 0)
+        lookups = stats["hits"] + stats["revalidated"] + stats["misses"]
+        stats["hit_ratio"] = (
+            (stats["hits"] + stats["revalidated"]) / lookups if lookups else 0.0
+        )
+        return stats
+
+    def clear(self) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM counters")
+        with self._lock:
+            self._pending.clear()
+            self._counters = dict.fromkeys(COUNTERS, 0)
+
+
+class _Transaction:
+    """``BEGIN IMMEDIATE`` so concurrent writers queue on the busy timeout."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def conditional_get(session, url, params=None, cache=None, **kwargs) -> CachedResponse:
+    """GET ``url`` through ``cache`` with the same rules esipy applies.
+
+    Fresh entries are returned without touching the network, stale ones are
+    revalidated with ``If-None-Match`` and a 304 refreshes their headers.
+
+    Args:
+        session (requests.Session): Session used for the request.
+        url (str): Absolute URL.
+        params (dict): Query string parameters.
+        cache (EsiResponseCache): Cache to use, ``None`` disables caching.
+        **kwargs: Passed on to ``session.get`` (timeout, headers...).
+
+    Returns:
+        CachedResponse: status_code, headers, content and url.
+    """
+    if cache is None:
+        res = session.get(url, params=params, **kwargs)
+        return CachedResponse(res.status_code, res.headers, res.content, res.url)
+
+    key = make_key(url, params)
+    cached = cache.get(key)
+    headers = dict(kwargs.pop("headers", None) or {})
+    if cached is not None:
+        if expires_in(cached.headers) >= 0:
+            return cached
+        if cached.headers.get("etag"):
+            headers["If-None-Match"] = cached.headers["etag"]
+
+    res = session.get(url, params=params, headers=headers, **kwargs)
+
+    if res.status_code == 304 and cached is not None:
+        cached.headers.update(
+            {name: res.headers[name] for name in ("Expires", "Date", "ETag") if name in res.headers}
+        )
+        response = cached
+    else:
+        response = CachedResponse(res.status_code, res.headers, res.content, res.url)
+
+    timeout = expires_in(response.headers)
+    if response.status_code == 200 and timeout >= 0:
+        cache.set(key, response, timeout)
+    elif response.status_code == 200 and cached is not None:
+        # Nothing left to revalidate with, drop the old body
+        cache.invalidate(key)
+    return response
@@ -0,0 +1,241 @@
+"""Local Discord API stand-in for notification load tests.
+
+Answers the two bot calls the notification dispatcher makes, opening a DM
+channel (``POST /users/@me/channels``) and posting a message
+(``POST /channels/{id}/messages``), and enforces rate limits the way
+Discord does:
+
+* per-route buckets, sent as ``X-RateLimit-Limit``, ``-Remaining``,
+  ``-Reset``, ``-Reset-After`` and ``-Bucket``; messages are limited per
+  channel (5 per 5 seconds by default), DM opens per bot;
+* a global limit per bot (50 requests per second by default);
+* 429 with ``retry_after`` (and ``global``) once a limit is exceeded.
+
+It counts requests, messages and 429s, served as JSON at ``GET /_stats``::
+
+    python -m esi_tools.discord_standin --port 8098 --latency-ms 80
+    DISCORD_API_URL=http://127.0.0.1:8098/api/v10
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+LOGGER = logging.getLogger(__name__)
+
+_PREFIX = re.compile(r"^/api(/v\d+)?")
+_MESSAGES = re.compile(r"^/channels/(\d+)/messages$")
+
+
+class Bucket:
+    """``limit`` requests per ``period`` seconds, the window starts at the first one"""
+
+    def __init__(self, name: str, limit: int, period: float):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self.used = 0
+        self.reset = 0.0
+
+    def take(self, now: float):
+        """``(allowed, remaining, reset_after)`` for a request at ``now``"""
+        if now >= self.reset:
+            self.used, self.reset = 0, now + self.period
+        if self.used >= self.limit:
+            return False, 0, self.reset - now
+        self.used += 1
+        return True, self.limit - self.used, self.reset - now
+
+
+class DiscordStandInServer(ThreadingHTTPServer):
+    """The stand-in HTTP server, see the module docstring.
+
+    Args:
+        address (tuple): ``(host, port)``, port 0 picks a free one.
+        latency (float): Mean added latency per request, in seconds.
+        message_limit (tuple): (requests, seconds) per channel for messages.
+        channel_limit (tuple): (requests, seconds) for opening DM channels.
+        global_limit (int): Requests per second over all routes.
+        closed_rate (float): Share of users whose DMs are closed (403, 50007).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8098), latency=0.0, message_limit=(5, 5.0),
+                 channel_limit=(10, 10.0), global_limit=50, closed_rate=0.0):
+        super().__init__(address, DiscordStandInHandler)
+        self.latency = latency
+        self.message_limit = message_limit
+        self.channel_limit = channel_limit
+        self.global_bucket = Bucket("global", global_limit, 1.0)
+        self.closed_rate = closed_rate
+        self.buckets = {}
+        self.stats = {"requests": 0, "channels_opened": 0, "messages": 0, "rate_limited": 0}
+        # channel id -> recipient, and the messages each recipient got
+        self.recipients = {}
+        self.inbox = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """API root of the stand-in, what DISCORD_API_URL should be set to"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v10"
+
+    def start(self) -> "DiscordStandInServer":
+        """Serve from a daemon thread, for benchmarks running in-process"""
+        threading.Thread(target=self.serve_forever, name="discord-standin", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def bucket(self, key: str, name: str, limit: tuple) -> Bucket:
+        if key not in self.buckets:
+            self.buckets[key] = Bucket(name, *limit)
+        return self.buckets[key]
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def closed(self, recipient_id: str) -> bool:
+        digest = int(hashlib.sha1(recipient_id.encode()).hexdigest()[:8], 16)
+        return digest / 0xFFFFFFFF < self.closed_rate
+
+
+class DiscordStandInHandler(BaseHTTPRequestHandler):
+    server_version = "discord-standin"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/_stats":
+            with self.server._lock:
+                return self.reply(200, dict(self.server.stats))
+        self.reply(404, {"message": "404: Not Found", "code": 0})
+
+    def do_POST(self):
+        server = self.server
+        server.count("requests")
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.reply(400, {"message": "400: Bad Request", "code": 50109})
+        if not self.headers.get("Authorization", "").startswith("Bot "):
+            return self.reply(401, {"message": "401: Unauthorized", "code": 0})
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        path = _PREFIX.sub("", urlsplit(self.path).path).rstrip("/")
+        messages = _MESSAGES.match(path)
+        if path == "/users/@me/channels":
+            key, limit = "channels", server.channel_limit
+        elif messages:
+            key, limit = f"messages:{messages.group(1)}", server.message_limit
+        else:
+            return self.reply(404, {"message": "404: Not Found", "code": 0})
+
+        now = time.monotonic()
+        with server._lock:
+            allowed_global, _, global_reset = server.global_bucket.take(now)
+            bucket = server.bucket(key, key.split(":")[0], limit)
+            allowed, remaining, reset_after = (
+                bucket.take(now) if allowed_global else (True, bucket.limit, 0.0)
+            )
+        headers = {
+            "X-RateLimit-Limit": str(bucket.limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}",
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+            "X-RateLimit-Bucket": hashlib.sha1(bucket.name.encode()).hexdigest()[:16],
+        }
+        if not allowed_global:
+            server.count("rate_limited")
+            headers = {"X-RateLimit-Global": "true", "Retry-After": f"{global_reset:.3f}"}
+            return self.reply(429, {"message": "You are being rate limited.",
+                                    "retry_after": round(global_reset, 3), "global": True}, headers)
+        if not allowed:
+            server.count("rate_limited")
+            headers["Retry-After"] = f"{reset_after:.3f}"
+            return self.reply(429, {"message": "You are being rate limited.",
+                                    "retry_after": round(reset_after, 3), "global": False}, headers)
+
+        if messages:
+            with server._lock:
+                recipient = server.recipients.get(messages.group(1))
+            if recipient is None:
+                return self.reply(404, {"message": "Unknown Channel", "code": 10003}, headers)
+            if server.closed(recipient):
+                return self.reply(403, {"message": "Cannot send messages to this user",
+                                        "code": 50007}, headers)
+            with server._lock:
+                server.inbox.setdefault(recipient, []).append(body.get("content", ""))
+            server.count("messages")
+            return self.reply(200, {"id": str(random.getrandbits(62)),
+                                    "channel_id": messages.group(1),
+                                    "content": body.get("content", "")}, headers)
+
+        recipient = str(body.get("recipient_id", ""))
+        channel_id = str(int(hashlib.sha1(recipient.encode()).hexdigest()[:15], 16))
+        with server._lock:
+            server.recipients[channel_id] = recipient
+        server.count("channels_opened")
+        self.reply(200, {"id": channel_id, "type": 1,
+                         "recipients": [{"id": recipient}]}, headers)
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Local Discord API stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency")
+    parser.add_argument("--message-limit", type=int, nargs=2, default=[5, 5],
+                        metavar=("REQUESTS", "SECONDS"), help="messages per channel")
+    parser.add_argument("--global-limit", type=int, default=50, help="requests per second")
+    parser.add_argument("--closed-rate", type=float, default=0.0,
+                        help="share of users with closed DMs")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    server = DiscordStandInServer(
+        (args.host, args.port),
+        latency=args.latency_ms / 1000,
+        message_limit=tuple(args.message_limit),
+        global_limit=args.global_limit,
+        closed_rate=args.closed_rate,
+    )
+    LOGGER.info("Discord stand-in listening on %s", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
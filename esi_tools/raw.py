@@ -0,0 +1,67 @@
+"""Raw JSON decoding of ESI responses.
+
+pyswagger turns every row of a response into a schema object, validating and
+converting each field on the way. For a market order page that is a thousand
+objects of a dozen fields, which costs far more CPU than the download. The
+helpers here decode a raw body with orjson straight into plain dicts or
+tuples; the async client decodes every response this way.
+"""
+
+import json
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:  # pragma: no cover - orjson is optional
+    loads = json.loads
+
+
+def parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    """ESI timestamps (``2024-05-01T12:00:00Z``) to naive UTC datetimes"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value[:-1] if value.endswith("Z") else value)
+
+
+def parse_date(value: Optional[str]) -> Optional[date]:
+    """ESI dates (``2024-05-01``) to ``date``"""
+    if not value:
+        return None
+    return date.fromisoformat(value)
+
+
+def convert(rows: List[dict], converters: Dict[str, Callable]) -> List[dict]:
+    """Apply ``converters`` (field -> callable) to decoded rows, in place"""
+    for name, converter in converters.items():
+        for row in rows:
+            if name in row:
+                row[name] = converter(row[name])
+    return rows
+
+
+def decode(
+    raw: Optional[bytes],
+    fields: Optional[Sequence[str]] = None,
+    converters: Optional[Dict[str, Callable]] = None,
+) -> List:
+    """Decode a JSON list body.
+
+    Args:
+        raw (bytes): The response body, empty for 204 answers.
+        fields (list): If given, rows become tuples of these fields
+            (missing ones are None), otherwise the decoded dicts are kept.
+        converters (dict): field -> callable applied to the values, e.g.
+            ``{"issued": parse_datetime}``.
+
+    Returns:
+        list: dicts or tuples, in the order ESI sent them.
+    """
+    if not raw:
+        return []
+    rows = convert(loads(raw), converters or {})
+    if fields is None:
+        return rows
+    return [tuple(map(row.get, fields)) for row in rows]
@@ -0,0 +1,591 @@
+"""Local ESI stand-in for offline runs and reproducible benchmarks.
+
+A small threaded HTTP server answering the ESI operations we use (character
+skills, skill queue, blueprints, mining and wallet, public contracts and
+their items, market orders and history) with the headers ESI sends:
+``Expires``, ``Last-Modified``, ``ETag`` (and 304 on ``If-None-Match``),
+``X-Pages`` and the ``X-ESI-Error-Limit-*`` pair, including 420 once the
+error budget is spent. It also answers the SSO token endpoint so token
+refreshes work offline.
+
+Responses come from fixture files when one exists for the request, otherwise
+they are generated, deterministically from the path parameters. In record
+mode a missing fixture is fetched once from the real ESI and stored, so a
+benchmark can replay real data on a laptop::
+
+    python -m esi_tools.standin --port 8099 --fixtures fixtures/esi --record
+    python -m esi_tools.standin --port 8099 --fixtures fixtures/esi --latency-ms 40 --error-rate 0.01
+
+Point the app at it with ``ESI_BASE_URL=http://127.0.0.1:8099/latest``, the
+async client with ``AsyncEsiClient(base_url=...)``, and a plain esipy client
+with ``transport_adapter=StandInAdapter(...)``.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import secrets
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+UPSTREAM_URL = "https://esi.evetech.net"
+ESI_HOST = "esi.evetech.net"
+ERROR_LIMIT = 100
+ERROR_WINDOW = 60
+
+_VERSION_PREFIX = re.compile(r"^/(latest|dev|legacy|v\d+)(?=/)")
+# query parameters that don't change the answer
+_IGNORED_QUERY = {"datasource", "token", "language"}
+
+
+def _seed(*parts) -> int:
+    return zlib.crc32(repr(parts).encode())
+
+
+def _iso(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# -- synthetic data -----------------------------------------------------------
+
+
+def _skills(rng, character_id):
+    skills = [
+        {
+            "skill_id": 3300 + index,
+            "skillpoints_in_skill": rng.choice([0, 250, 1415, 8000, 45255, 256000]),
+            "trained_skill_level": rng.randint(0, 5),
+            "active_skill_level": rng.randint(0, 5),
+        }
+        for index in range(rng.randint(60, 240))
+    ]
+    return {
+        "skills": skills,
+        "total_sp": sum(skill["skillpoints_in_skill"] for skill in skills),
+        "unallocated_sp": rng.choice([0, 0, 0, 50000]),
+    }
+
+
+def _skillqueue(rng, character_id):
+    start = datetime.utcnow() - timedelta(hours=rng.randint(1, 48))
+    queue = []
+    for position in range(rng.randint(0, 12)):
+        finish = start + timedelta(hours=rng.randint(2, 240))
+        level_start = rng.choice([0, 250, 1415, 8000, 45255])
+        queue.append(
+            {
+                "skill_id": rng.randint(3300, 3500),
+                "finished_level": rng.randint(1, 5),
+                "queue_position": position,
+                "start_date": _iso(start),
+                "finish_date": _iso(finish),
+                "level_start_sp": level_start,
+                "level_end_sp": level_start * 5 + 250,
+                "training_start_sp": level_start,
+            }
+        )
+        start = finish
+    return queue
+
+
+def _blueprints(rng, character_id):
+    return [
+        {
+            "item_id": character_id * 10000 + index,
+            "location_flag": rng.choice(["Hangar", "Deliveries", "AssetSafety"]),
+            "location_id": 60003760,
+            "material_efficiency": rng.randint(0, 10),
+            "quantity": rng.choice([-1, -2, 1]),
+            "runs": rng.choice([-1, 10, 300]),
+            "time_efficiency": rng.choice([0, 10, 20]),
+            "type_id": rng.randint(680, 50000),
+        }
+        for index in range(rng.randint(5, 2500))
+    ]
+
+
+def _mining(rng, character_id):
+    today = date.today()
+    return [
+        {
+            "date": (today - timedelta(days=day)).isoformat(),
+            "quantity": rng.randint(100, 50000),
+            "solar_system_id": rng.choice([30000142, 30002187, 30045349]),
+            "type_id": rng.choice([1230, 1228, 1224, 18, 45490, 46675]),
+        }
+        for day in range(30)
+        for _ in range(rng.randint(0, 3))
+    ]
+
+
+def _wallet(rng, character_id):
+    return round(rng.uniform(0, 5e10), 2)
+
+
+def _contracts(rng, region_id, count):
+    now = datetime.utcnow()
+    contracts = []
+    for index in range(count):
+        issued = now - timedelta(minutes=rng.randint(1, 40000))
+        kind = rng.choice(["item_exchange", "item_exchange", "auction", "courier"])
+        contract = {
+            "contract_id": region_id % 100000 * 100000 + index,
+            "date_issued": _iso(issued),
+            "date_expired": _iso(issued + timedelta(days=rng.choice([1, 3, 7, 14, 30]))),
+            "days_to_complete": 0,
+            "for_corporation": rng.random() < 0.1,
+            "issuer_corporation_id": rng.randint(98000000, 98999999),
+            "issuer_id": rng.randint(90000000, 2120000000),
+            "price": round(rng.uniform(1e5, 5e10), 2),
+            "start_location_id": 60003760,
+            "end_location_id": 60003760,
+            "title": "",
+            "type": kind,
+            "volume": round(rng.uniform(0.01, 1e6), 2),
+        }
+        if kind == "auction":
+            contract["buyout"] = contract["price"] * 2
+        if kind == "courier":
+            contract.update(collateral=contract["price"], reward=round(contract["price"] / 100, 2),
+                            days_to_complete=rng.choice([1, 3, 7]), price=0)
+        contracts.append(contract)
+    return contracts
+
+
+def _contract_items(rng, contract_id):
+    items = []
+    for index in range(rng.randint(1, 12)):
+        item = {
+            "record_id": contract_id * 100 + index,
+            "is_included": rng.random() < 0.95,
+            "is_singleton": False,
+            "quantity": rng.choice([1, 1, 1, 5, 100, 10000]),
+            "type_id": rng.randint(18, 60000),
+        }
+        if rng.random() < 0.3:
+            item.update(
+                item_id=contract_id * 1000 + index,
+                is_blueprint_copy=rng.random() < 0.7,
+                material_efficiency=rng.randint(0, 10),
+                time_efficiency=rng.choice([0, 10, 20]),
+                runs=rng.choice([-1, 1, 10, 100]),
+                is_singleton=True,
+            )
+        items.append(item)
+    return items
+
+
+def _orders(rng, region_id, count):
+    now = datetime.utcnow()
+    return [
+        {
+            "duration": rng.choice([1, 3, 7, 14, 30, 90]),
+            "is_buy_order": rng.random() < 0.4,
+            "issued": _iso(now - timedelta(minutes=rng.randint(1, 129600))),
+            "location_id": 60003760,
+            "min_volume": 1,
+            "order_id": 5000000000 + region_id % 100000 * 1000000 + index,
+            "price": round(rng.uniform(0.01, 2e9), 2),
+            "range": rng.choice(["station", "region", "solarsystem", "5", "10"]),
+            "system_id": 30000142,
+            "type_id": rng.randint(18, 60000),
+            "volume_remain": rng.randint(1, 100000),
+            "volume_total": 100000,
+        }
+        for index in range(count)
+    ]
+
+
+def _history(rng, region_id, type_id):
+    today = date.today()
+    price = rng.uniform(1, 1e8)
+    rows = []
+    for day in range(400, 0, -1):
+        price *= rng.uniform(0.97, 1.03)
+        rows.append(
+            {
+                "date": (today - timedelta(days=day)).isoformat(),
+                "average": round(price, 2),
+                "highest": round(price * rng.uniform(1, 1.05), 2),
+                "lowest": round(price * rng.uniform(0.95, 1), 2),
+                "order_count": rng.randint(1, 5000),
+                "volume": rng.randint(1, 10 ** 7),
+            }
+        )
+    return rows
+
+
+class Route:
+    """One operation the stand-in answers.
+
+    ``build(rng, **path_params)`` returns the full body, ``page_size`` splits
+    lists into ``X-Pages`` pages, ``expires`` is ESI's cache time in seconds.
+    """
+
+    def __init__(self, name, path, expires, build, page_size=None):
+        self.name = name
+        self.pattern = re.compile(
+            "^" + re.sub(r"{(\w+)}", r"(?P<\1>\\d+)", path) + "$"
+        )
+        self.expires = expires
+        self.build = build
+        self.page_size = page_size
+
+
+class StandInServer(ThreadingHTTPServer):
+    """The stand-in HTTP server, see the module docstring.
+
+    Args:
+        address (tuple): ``(host, port)``, port 0 picks a free one.
+        fixtures (str): Directory of recorded responses, None for synthetic only.
+        record (bool): Fetch and store missing fixtures from ``upstream``.
+        upstream (str): The real ESI root.
+        latency (float): Mean added latency per request, in seconds.
+        error_rate (float): Share of requests answered with a 502/503/504.
+        strict (bool): Answer 404 instead of generating missing fixtures.
+        market_pages (int): Pages of synthetic market orders per region.
+        contract_pages (int): Pages of synthetic public contracts per region.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8099), fixtures=None, record=False,
+                 upstream=UPSTREAM_URL, latency=0.0, error_rate=0.0, strict=False,
+                 market_pages=10, contract_pages=3):
+        super().__init__(address, StandInHandler)
+        self.fixtures = fixtures
+        self.record = record
+        self.upstream = upstream.rstrip("/")
+        self.latency = latency
+        self.error_rate = error_rate
+        self.strict = strict
+
+        self.routes = [
+            Route("get_characters_character_id_skills", "/characters/{character_id}/skills/",
+                  120, _skills),
+            Route("get_characters_character_id_skillqueue",
+                  "/characters/{character_id}/skillqueue/", 120, _skillqueue),
+            Route("get_characters_character_id_blueprints",
+                  "/characters/{character_id}/blueprints/", 3600, _blueprints, 1000),
+            Route("get_characters_character_id_mining", "/characters/{character_id}/mining/",
+                  600, _mining, 1000),
+            Route("get_characters_character_id_wallet", "/characters/{character_id}/wallet/",
+                  120, _wallet),
+            Route("get_contracts_public_region_id", "/contracts/public/{region_id}/", 1800,
+                  lambda rng, region_id: _contracts(rng, region_id, contract_pages * 1000), 1000),
+            Route("get_contracts_public_items_contract_id",
+                  "/contracts/public/items/{contract_id}/", 3600, _contract_items, 100),
+            Route("get_markets_region_id_orders", "/markets/{region_id}/orders/", 300,
+                  lambda rng, region_id: _orders(rng, region_id, market_pages * 1000), 1000),
+            Route("get_markets_region_id_history", "/markets/{region_id}/history/", 3600,
+                  lambda rng, region_id, type_id: _history(rng, region_id, type_id)),
+        ]
+
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._errors = []
+        self._bodies = {}
+        self._session = requests.Session()
+
+    @property
+    def url(self) -> str:
+        """ESI root of the stand-in, what ``ESI_BASE_URL`` should be set to"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/latest"
+
+    def start(self) -> "StandInServer":
+        """Serve from a daemon thread, for benchmarks running in-process"""
+        threading.Thread(target=self.serve_forever, name="esi-standin", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    # error limit, per server like ESI does per IP
+
+    def error_limit(self):
+        """``(remain, reset)`` of the current error window"""
+        now = time.time()
+        window_start = now - now % ERROR_WINDOW
+        with self._lock:
+            self._errors = [moment for moment in self._errors if moment >= window_start]
+            remain = ERROR_LIMIT - len(self._errors)
+        return remain, int(window_start + ERROR_WINDOW - now) + 1
+
+    def count_error(self) -> None:
+        with self._lock:
+            self._errors.append(time.time())
+
+    # fixtures
+
+    def fixture_path(self, path, query):
+        key = path + "?" + "&".join(f"{name}={value}" for name, value in sorted(query.items()))
+        digest = hashlib.sha1(key.encode()).hexdigest()[:20]
+        slug = path.strip("/").replace("/", "_") or "root"
+        slug = re.sub(r"_\d+", "_n", slug)
+        return os.path.join(self.fixtures, slug, digest + ".json")
+
+    def load_fixture(self, path, query):
+        if not self.fixtures:
+            return None
+        try:
+            with open(self.fixture_path(path, query), encoding="utf-8") as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
+
+    def record_fixture(self, version, path, query, headers):
+        """Fetch ``path`` from the real ESI and store it, None on failure"""
+        url = f"{self.upstream}/{version}{path}"
+        forward = {name: value for name, value in headers.items()
+                   if name.lower() in ("authorization", "user-agent", "accept-language")}
+        res = self._session.get(url, params=dict(query, datasource="tranquility"),
+                                headers=forward, timeout=60)
+        if res.status_code >= 500:
+            return None
+
+        expires = 300
+        if "Expires" in res.headers and "Date" in res.headers:
+            expires = max(0, int((parsedate_to_datetime(res.headers["Expires"])
+                                  - parsedate_to_datetime(res.headers["Date"])).total_seconds()))
+        fixture = {
+            "url": url,
+            "query": query,
+            "status": res.status_code,
+            "expires": expires,
+            "pages": int(res.headers["X-Pages"]) if "X-Pages" in res.headers else None,
+            "recorded_at": int(time.time()),
+            "body": res.text,
+        }
+        target = self.fixture_path(path, query)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = target + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as handle:
+            json.dump(fixture, handle)
+        os.replace(tmp, target)
+        LOGGER.info("Recorded %s -> %s", url, target)
+        return fixture
+
+    def synthetic(self, path, query):
+        """``(status, body, expires, pages)`` for a known operation, None otherwise.
+
+        ``pages`` is None for operations that aren't paginated.
+        """
+        for route in self.routes:
+            match = route.pattern.match(path)
+            if not match:
+                continue
+            params = {name: int(value) for name, value in match.groupdict().items()}
+            if route.name == "get_markets_region_id_history":
+                if "type_id" not in query:
+                    return 400, json.dumps({"error": "Missing type_id"}), 0, None
+                params["type_id"] = int(query["type_id"])
+            if route.name == "get_contracts_public_items_contract_id" and \
+                    params["contract_id"] % 17 == 0:
+                # finished or expired contracts answer 204
+                return 204, "", route.expires, None
+
+            key = (route.name, tuple(sorted(params.items())))
+            with self._lock:
+                body = self._bodies.get(key)
+            if body is None:
+                body = route.build(random.Random(_seed(*key)), **params)
+                with self._lock:
+                    self._bodies[key] = body
+
+            if route.page_size is None:
+                return 200, json.dumps(body), route.expires, None
+            pages = max(1, -(-len(body) // route.page_size))
+            page = int(query.get("page", 1))
+            if page > pages:
+                return 404, json.dumps({"error": "Requested page does not exist!"}), 0, pages
+            start = (page - 1) * route.page_size
+            return 200, json.dumps(body[start:start + route.page_size]), route.expires, pages
+        return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server_version = "esi-standin"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s - %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        with server._lock:
+            server.requests += 1
+
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        parts = urlsplit(self.path)
+        query = {name: value for name, value in parse_qsl(parts.query)
+                 if name not in _IGNORED_QUERY}
+        match = _VERSION_PREFIX.match(parts.path)
+        version = match.group(1) if match else "latest"
+        path = parts.path[match.end():] if match else parts.path
+
+        remain, reset = server.error_limit()
+        if remain <= 0:
+            return self.reply(420, {"error": "This software has exceeded the error limit for ESI."},
+                              head=head)
+        if server.error_rate and random.random() < server.error_rate:
+            server.count_error()
+            return self.reply(
+                random.choice([502, 503, 504]),
+                {"error": "The datasource tranquility is temporarily unavailable"},
+                head=head,
+            )
+
+        # page 1 is the default, both spellings share a fixture
+        if query.get("page") == "1":
+            del query["page"]
+        fixture = server.load_fixture(path, query)
+        if fixture is None and server.record:
+            try:
+                fixture = server.record_fixture(version, path, query, self.headers)
+            except requests.RequestException as error:
+                LOGGER.warning("Recording %s failed: %s", path, error)
+        if fixture is not None:
+            status, body = fixture["status"], fixture["body"]
+            expires, pages = fixture["expires"], fixture["pages"]
+        else:
+            generated = None if server.strict else server.synthetic(path, query)
+            if generated is None:
+                return self.reply(404, {"error": "Not found"}, head=head)
+            status, body, expires, pages = generated
+
+        # ESI serves a snapshot per cache period, aligned for all pages
+        now = time.time()
+        snapshot = now - now % expires if expires else now
+        etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+        headers = {
+            "ETag": etag,
+            "Expires": formatdate(snapshot + expires, usegmt=True),
+            "Last-Modified": formatdate(snapshot, usegmt=True),
+        }
+        if pages is not None:
+            headers["X-Pages"] = str(pages)
+
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            return self.reply(304, None, headers, head=True)
+        if status >= 400:
+            server.count_error()
+        self.reply(status, body, headers, head=head)
+
+    def do_POST(self):
+        """SSO token endpoint: every refresh token is valid"""
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+        if urlsplit(self.path).path.rstrip("/") != "/v2/oauth/token":
+            return self.reply(404, {"error": "Not found"})
+        self.reply(200, {
+            "access_token": "standin-" + secrets.token_hex(16),
+            "expires_in": 1199,
+            "token_type": "Bearer",
+            "refresh_token": form.get("refresh_token") or secrets.token_hex(16),
+        })
+
+    def reply(self, status, body, headers=None, head=False):
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+        payload = (body or "").encode()
+        remain, reset = self.server.error_limit()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", "0" if status in (204, 304) else str(len(payload)))
+        self.send_header("X-ESI-Error-Limit-Remain", str(max(remain, 0)))
+        self.send_header("X-ESI-Error-Limit-Reset", str(reset))
+        self.send_header("X-ESI-Request-ID", secrets.token_hex(16))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head and status not in (204, 304):
+            self.wfile.write(payload)
+
+
+class StandInAdapter(HTTPAdapter):
+    """Requests transport adapter sending ESI and SSO calls to the stand-in.
+
+    For esipy, whose operations carry the real ESI URL:
+    ``EsiClient(transport_adapter=StandInAdapter("http://127.0.0.1:8099/latest"))``.
+    """
+
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        parts = urlsplit(base_url)
+        self.scheme, self.netloc = parts.scheme, parts.netloc
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.netloc in (ESI_HOST, "login.eveonline.com"):
+            request.url = urlunsplit((self.scheme, self.netloc) + tuple(parts[2:]))
+        return super().send(request, **kwargs)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Local ESI stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--fixtures", help="directory of recorded responses")
+    parser.add_argument("--record", action="store_true",
+                        help="fetch missing fixtures from the real ESI and store them")
+    parser.add_argument("--upstream", default=UPSTREAM_URL)
+    parser.add_argument("--strict", action="store_true",
+                        help="404 instead of synthetic data when no fixture exists")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests answered with 502/503/504")
+    parser.add_argument("--market-pages", type=int, default=10)
+    parser.add_argument("--contract-pages", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.record and not args.fixtures:
+        parser.error("--record needs --fixtures")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    server = StandInServer(
+        (args.host, args.port),
+        fixtures=args.fixtures,
+        record=args.record,
+        upstream=args.upstream,
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        strict=args.strict,
+        market_pages=args.market_pages,
+        contract_pages=args.contract_pages,
+    )
+    print(f"ESI stand-in on {server.url} (fixtures: {args.fixtures or 'none'}, "
+          f"record: {args.record})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.requests} requests")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
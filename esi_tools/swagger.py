@@ -0,0 +1,229 @@
+"""Local, version-pinned copy of the ESI swagger spec.
+
+``EsiApp().get_latest_swagger`` downloads and parses the full spec (plus the
+SSO metadata and signing keys for ``EsiSecurity``) every time a worker or
+script starts. ``SpecStore`` keeps all of it on disk instead:
+
+* ``<path>``             the swagger.json as downloaded
+* ``<path>.meta.json``   version, ETag, checksum, SSO endpoints and JWKS
+* ``<path>.pickle``      the prepared pyswagger ``App``
+
+Only ``refresh()`` touches the network; it is run by the CLI
+(``python -m esi_tools.swagger refresh`` or ``flask esi-spec refresh``), the
+scheduled refresh job, or once on a first boot with no spec on disk. Loading
+unpickles the prepared app, which takes milliseconds, and rebuilds the pickle
+when the spec checksum or the Python version no longer match.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import requests
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SPEC_URL = "https://esi.evetech.net/latest/swagger.json"
+DEFAULT_SPEC_PATH = os.path.join(tempfile.gettempdir(), "bluezoo-esi-swagger.json")
+SSO_METADATA_URL = "https://login.eveonline.com/.well-known/oauth-authorization-server"
+
+_PICKLE_FORMAT = 1
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Write ``data`` so readers see either the old or the new file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".esi-spec-")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+class SpecStore:
+    """On-disk swagger spec, SSO metadata and prepared pyswagger app.
+
+    Args:
+        path (str): Where the swagger.json is kept, sidecar files go next to it.
+        url (str): Where ``refresh()`` downloads the spec from.
+        user_agent (str): Sent with the refresh requests.
+    """
+
+    def __init__(self, path: str = DEFAULT_SPEC_PATH, url: str = DEFAULT_SPEC_URL,
+                 user_agent: str = "eve-blue-zoo"):
+        self.path = path
+        self.url = url or DEFAULT_SPEC_URL
+        self.user_agent = user_agent
+        self.meta_path = path + ".meta.json"
+        self.pickle_path = path + ".pickle"
+        # seconds spent in each step of the last load, for the startup report
+        self.timings = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) and os.path.exists(self.meta_path)
+
+    def meta(self) -> dict:
+        """Version, checksum and SSO data of the stored spec, {} if none"""
+        try:
+            with open(self.meta_path, "rb") as handle:
+                return json.loads(handle.read())
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def version(self):
+        return self.meta().get("version")
+
+    def refresh(self, force: bool = False) -> bool:
+        """Download the spec, SSO endpoints and JWKS if the spec changed.
+
+        Args:
+            force (bool): Ignore the stored ETag and download regardless.
+
+        Returns:
+            bool: True if a new spec was stored.
+        """
+        session = requests.Session()
+        session.headers.update({"User-Agent": self.user_agent, "Accept": "application/json"})
+
+        meta = self.meta()
+        headers = {}
+        if not force and self.exists() and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+
+        res = session.get(self.url, headers=headers, timeout=60)
+        if res.status_code == 304:
+            LOGGER.info("ESI spec %s is up to date", meta.get("version"))
+            return False
+        res.raise_for_status()
+
+        content = res.content
+        digest = hashlib.sha256(content).hexdigest()
+        if not force and digest == meta.get("sha256") and os.path.exists(self.path):
+            return False
+        spec = json.loads(content)
+
+        sso = session.get(SSO_METADATA_URL, timeout=30)
+        sso.raise_for_status()
+        sso_endpoints = sso.json()
+        jwks = session.get(sso_endpoints["jwks_uri"], timeout=30)
+        jwks.raise_for_status()
+
+        _write_atomic(self.path, content)
+        _write_atomic(
+            self.meta_path,
+            json.dumps(
+                {
+                    "url": self.url,
+                    "version": spec.get("info", {}).get("version"),
+                    "etag": res.headers.get("ETag"),
+                    "sha256": digest,
+                    "fetched_at": int(time.time()),
+                    "sso_endpoints": sso_endpoints,
+                    "jwks": jwks.json(),
+                },
+                indent=2,
+            ).encode(),
+        )
+        # build the pickle now so the next worker boot doesn't have to
+        self._build_app(digest)
+        LOGGER.info("Stored ESI spec %s from %s", spec.get("info", {}).get("version"), self.url)
+        return True
+
+    def load_app(self):
+        """The prepared pyswagger ``App`` for the stored spec.
+
+        Downloads the spec first if none is stored yet.
+        """
+        self.timings = {}
+        started = time.perf_counter()
+        if not self.exists():
+            self.refresh()
+            self.timings["download"] = time.perf_counter() - started
+            started = time.perf_counter()
+
+        digest = self.meta().get("sha256")
+        app = self._load_pickle(digest)
+        if app is not None:
+            self.timings["unpickle"] = time.perf_counter() - started
+            return app
+
+        app = self._build_app(digest)
+        self.timings["parse"] = time.perf_counter() - started
+        return app
+
+    def sso_kwargs(self) -> dict:
+        """``EsiSecurity`` keyword arguments that skip its SSO discovery calls"""
+        meta = self.meta()
+        if not meta.get("sso_endpoints") or not meta.get("jwks"):
+            return {}
+        return {"sso_endpoints": meta["sso_endpoints"], "jwks_key": meta["jwks"]}
+
+    def _pickle_tag(self, digest: str) -> tuple:
+        return (_PICKLE_FORMAT, digest, sys.version_info[:2])
+
+    def _load_pickle(self, digest: str):
+        try:
+            with open(self.pickle_path, "rb") as handle:
+                tag, app = pickle.load(handle)
+        except FileNotFoundError:
+            return None
+        except Exception as error:  # stale or truncated pickle, rebuild it
+            LOGGER.warning("Ignoring ESI spec pickle %s: %s", self.pickle_path, error)
+            return None
+        if tag != self._pickle_tag(digest):
+            return None
+        return app
+
+    def _build_app(self, digest: str):
+        from pyswagger import App
+
+        app = App.load(self.path)
+        # host and basePath come from the spec itself, not from the file path
+        app.prepare()
+        try:
+            _write_atomic(
+                self.pickle_path,
+                pickle.dumps((self._pickle_tag(digest), app), protocol=pickle.HIGHEST_PROTOCOL),
+            )
+        except (OSError, pickle.PicklingError) as error:
+            LOGGER.warning("Could not pickle ESI spec to %s: %s", self.pickle_path, error)
+        return app
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Manage the local ESI swagger spec")
+    parser.add_argument("command", choices=["refresh", "show"])
+    parser.add_argument("--path", default=os.getenv("ESI_SPEC_PATH", DEFAULT_SPEC_PATH))
+    parser.add_argument("--url", default=os.getenv("ESI_SWAGGER_JSON", DEFAULT_SPEC_URL))
+    parser.add_argument("--force", action="store_true", help="download even if unchanged")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    store = SpecStore(args.path, args.url, os.getenv("ESI_USER_AGENT", "eve-blue-zoo"))
+    if args.command == "refresh":
+        changed = store.refresh(force=args.force)
+        print(f"ESI spec {store.version} {'updated' if changed else 'unchanged'}: {store.path}")
+    else:
+        meta = store.meta()
+        if not meta:
+            print(f"No ESI spec stored at {store.path}")
+            return 1
+        print(f"ESI spec {meta['version']} from {meta['url']}, fetched "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['fetched_at']))}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
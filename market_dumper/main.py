@@ -1,6 +1,7 @@
 import os
+import sys
+import asyncio
 import argparse
-import requests
 from datetime import datetime
 from typing import List, Set
 from dotenv import load_dotenv
@@ -18,9 +19,13 @@ from sqlalchemy import (
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import SQLAlchemyError
-import time
 import logging
 
+# esi_tools lives at the repository root, shared with the web app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from esi_tools.cache import EsiResponseCache, DEFAULT_CACHE_PATH  # noqa: E402
+from esi_tools.async_client import AsyncEsiClient, EsiError, run  # noqa: E402
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -151,8 +156,11 @@ class EVEMarketCollector:
         # Create tables if they don't exist
         Base.metadata.create_all(self.engine)
 
-        # ESI API base URL
-        self.esi_base_url = "https://esi.evetech.net/latest"
+        # ESI API base URL, point it at a local stand-in (esi_tools.standin) to benchmark
+        self.esi_base_url = os.getenv("ESI_BASE_URL", "https://esi.evetech.net/latest")
+
+        # Responses are cached on disk, shared with the web app and other scripts
+        self.cache = EsiResponseCache(os.getenv("ESI_CACHE_PATH", DEFAULT_CACHE_PATH))
 
     def get_null_faction_regions(self) -> List[int]:
         """Get list of region IDs where factionID is NULL."""
@@ -167,52 +175,35 @@ class EVEMarketCollector:
             logger.info(f"Found {len(region_ids)} regions with NULL factionID")
             return region_ids
 
-    def fetch_market_orders(self, region_id: int) -> List[dict]:
-        """Fetch all market orders for a given region, handling pagination."""
-        all_orders = []
-        page = 1
-
-        while True:
-            url = f"{self.esi_base_url}/markets/{region_id}/orders/"
-            params = {"datasource": "tranquility", "order_type": "all", "page": page}
-
-            try:
-                logger.info(
-                    f"Fetching market orders for region {region_id}, page {page}"
-                )
-                response = requests.get(url, params=params, timeout=30)
-
-                if response.status_code == 404:
-                    logger.warning(f"Region {region_id} not found in ESI")
-                    break
-
-                response.raise_for_status()
-
-                orders = response.json()
-                if not orders:
-                    break
-
-                all_orders.extend(orders)
-
-                # Check if there are more pages
-                pages_header = response.headers.get("X-Pages", "1")
-                total_pages = int(pages_header)
-
-                if page >= total_pages:
-                    break
-
-                page += 1
-
-                # Be nice to the API
-                time.sleep(0.1)
-
-            except requests.exceptions.RequestException as e:
-                logger.error(
-                    f"Error fetching orders for region {region_id}, page {page}: {e}"
-                )
-                break
-
-        logger.info(f"Fetched {len(all_orders)} total orders for region {region_id}")
+    def esi_client(self) -> AsyncEsiClient:
+        """Async ESI client sharing the on-disk response cache."""
+        return AsyncEsiClient(
+            base_url=self.esi_base_url,
+            concurrency=int(os.getenv("ESI_CONCURRENCY", 20)),
+            user_agent=os.getenv("ESI_USER_AGENT", "eve-blue-zoo market_dumper"),
+            cache=self.cache,
+        )
+
+    async def fetch_market_orders(self, client: AsyncEsiClient, region_id: int) -> List[dict]:
+        """Fetch all market orders for a given region, pages after the first in parallel."""
+        logger.info(f"Fetching market orders for region {region_id}")
+        try:
+            pages = await client.fetch_pages(
+                "/markets/{region_id}/orders/",
+                region_id=region_id,
+                order_type="all",
+            )
+        except EsiError as e:
+            if e.status == 404:
+                logger.warning(f"Region {region_id} not found in ESI")
+            else:
+                logger.error(f"Error fetching orders for region {region_id}: {e}")
+            return []
+
+        all_orders = [order for page in pages for order in page.data]
+        logger.info(
+            f"Fetched {len(all_orders)} total orders in {len(pages)} pages for region {region_id}"
+        )
         return all_orders
 
     def save_market_orders(self, orders: List[dict], region_id: int):
@@ -288,16 +279,21 @@ class EVEMarketCollector:
     def download_all_market_orders(self):
         """Download market orders for all regions with NULL factionID."""
         region_ids = self.get_null_faction_regions()
+        run(self._download_regions(region_ids))
+        logger.info(f"ESI cache: {self.cache.stats()}")
 
-        for region_id in region_ids:
-            logger.info(f"Processing region {region_id}")
-            orders = self.fetch_market_orders(region_id)
+    async def _download_regions(self, region_ids: List[int]):
+        """Fetch regions concurrently, saving each one as soon as it arrives."""
+        async with self.esi_client() as client:
 
-            if orders:
-                self.save_market_orders(orders, region_id)
+            async def download(region_id):
+                logger.info(f"Processing region {region_id}")
+                orders = await self.fetch_market_orders(client, region_id)
+                if orders:
+                    # keep the event loop free for the other regions
+                    await asyncio.to_thread(self.save_market_orders, orders, region_id)
 
-            # Be nice to the API
-            time.sleep(1)
+            await asyncio.gather(*(download(region_id) for region_id in region_ids))
 
     def get_blueprint_type_ids(self) -> Set[int]:
         """Get all blueprint type IDs from IndustryActivityProduct."""
@@ -2,7 +2,6 @@
 from sqlalchemy.exc import IntegrityError
 from tqdm import tqdm
 from datetime import datetime
-from esipy import EsiApp, EsiClient, EsiSecurity
 from dotenv import dotenv_values
 from genericpath import exists
 import logging
@@ -21,6 +20,11 @@ from sqlalchemy import (
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from esi_tools.cache import EsiResponseCache, DEFAULT_CACHE_PATH
+from esi_tools.swagger import SpecStore, DEFAULT_SPEC_PATH
+from esi_tools.raw import parse_datetime
+from esi_tools.async_client import ESI_BASE_URL, AsyncEsiClient, operations_from_app, run
+
 # logger setup
 logger = logging.getLogger(__name__)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -76,19 +80,26 @@ Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 session = Session()
 
-esi_app = EsiApp()
-esiapp = esi_app.get_latest_swagger
-
-esisecurity = EsiSecurity(
-    redirect_uri=config["ESI_CALLBACK"],
-    client_id=config["ESI_CLIENT_ID"],
-    secret_key=config["ESI_SECRET_KEY"],
-    headers={"User-Agent": "merriam@gmail.com"},
+# local spec shared with the web app, refreshed by it or `python -m esi_tools.swagger refresh`
+esispec = SpecStore(
+    config.get("ESI_SPEC_PATH") or DEFAULT_SPEC_PATH,
+    config.get("ESI_SWAGGER_JSON"),
+    user_agent=config["ESI_USER_AGENT"],
 )
+esiapp = esispec.load_app()
+logger.info("ESI spec %s loaded: %s", esispec.version, esispec.timings)
 
-esiclient = EsiClient(
-    security=esisecurity, cache=None, headers={"User-Agent": config["ESI_USER_AGENT"]}
-)
+# same on-disk cache as the web app, pages still fresh there are not re-downloaded
+esicache = EsiResponseCache(config.get("ESI_CACHE_PATH") or DEFAULT_CACHE_PATH)
+
+
+def esi_client():
+    return AsyncEsiClient(
+        operations=operations_from_app(esiapp),
+        base_url=config.get("ESI_BASE_URL") or ESI_BASE_URL,
+        cache=esicache,
+        user_agent=config["ESI_USER_AGENT"],
+    )
 
 
 def get_region_id_by_date():
@@ -106,29 +117,20 @@ def get_region_name(region_id):
 
 
 def get_market_data(region_id):
-    op = esiapp.op["get_markets_region_id_orders"](
-        region_id=region_id,
-        page=1,
-        order_type="all",
-    )
-    res = esiclient.head(op)
-
-    if res.status == 200:
-        number_of_page = res.header["X-Pages"][0]
-        print(f"Market Pages: {number_of_page}")
-        operations = []
-        for page in range(1, number_of_page + 1):
-            operations.append(
-                esiapp.op["get_markets_region_id_orders"](
-                    region_id=region_id,
-                    page=page,
-                    order_type="all",
-                )
+    """All order pages of the region, from one consistent ESI snapshot"""
+
+    async def fetch():
+        async with esi_client() as client:
+            return await client.fetch_pages(
+                "get_markets_region_id_orders",
+                converters={"issued": parse_datetime},
+                region_id=region_id,
+                order_type="all",
             )
-        results = esiclient.multi_request(operations)
-        return results
-    else:
-        return []
+
+    pages = run(fetch())
+    print(f"Market Pages: {len(pages)}")
+    return pages
 
 
 def save_market_data_bulk(response_data_list):
@@ -139,18 +141,18 @@ def save_market_data_bulk(response_data_list):
     for data in response_data_list:
         try:
             new_order = MarketOrder(
-                duration=data.duration,
-                is_buy_order=data.is_buy_order,
-                issued=data.issued,
-                location_id=data.location_id,
-                min_volume=data.min_volume,
-                order_id=data.order_id,
-                price=data.price,
-                range=data.range,
-                system_id=data.system_id,
-                type_id=data.type_id,
-                volume_remain=data.volume_remain,
-                volume_total=data.volume_total,
+                duration=data["duration"],
+                is_buy_order=data["is_buy_order"],
+                issued=data["issued"],
+                location_id=data["location_id"],
+                min_volume=data["min_volume"],
+                order_id=data["order_id"],
+                price=data["price"],
+                range=data["range"],
+                system_id=data["system_id"],
+                type_id=data["type_id"],
+                volume_remain=data["volume_remain"],
+                volume_total=data["volume_total"],
             )
             session.merge(new_order)
             insert_count += 1
@@ -184,8 +186,7 @@ def get_orders_for_region(region_id):
     market_datas = get_market_data(region_id)
 
     print(f"Storing orders for region: {get_region_name(region_id)}")
-    for market_data in tqdm(market_datas, desc="Processing market data"):
-        _, response = market_data
+    for response in tqdm(market_datas, desc="Processing market data"):
         order_count += len(response.data)
 
         # Save Market Data in bulk
@@ -194,6 +195,7 @@ def get_orders_for_region(region_id):
     update_region_timestamp(region_id)
 
     print(f"Total order count: {order_count}, total insert count: {insert_count}")
+    print(f"ESI cache: {esicache.stats()}")
 
 
 if __name__ == "__main__":